@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import requests
+
+
+class CacheRecord(object):
+    """Cache activity of the requests sent within a record() block"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.entries = []
+
+    @property
+    def cached(self):
+        """True when every response came from the cache"""
+        return self.hits > 0 and self.misses == 0
+
+
+class ResponseCache(object):
+    """Persistent cache of HTTP responses.
+
+    Responses are stored on disk, one file per URL, together with
+    their ETag and Last-Modified headers so they can be revalidated
+    using conditional requests. When the size of the cache exceeds
+    max_size bytes, the least recently used entries are removed.
+
+    Entries created inside a record() block are not written until
+    save() is called with them. This allows to store them only once
+    the data built from these responses is safe in the database.
+    """
+
+    # Headers needed to rebuild a response from the cache
+    HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+    def __init__(self, dirpath, max_size=512 * 1024 * 1024):
+        self.dirpath = dirpath
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sizes = {}
+        self._total = 0
+
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        for name in os.listdir(self.dirpath):
+            if name.endswith('.tmp'):
+                continue
+
+            self._sizes[name] = os.path.getsize(self._path(name))
+            self._total += self._sizes[name]
+
+    @contextmanager
+    def record(self):
+        rec = CacheRecord()
+        self._local.record = rec
+
+        try:
+            yield rec
+        finally:
+            self._local.record = None
+
+    def get(self, url):
+        name = self._key(url)
+
+        with self._lock:
+            if name not in self._sizes:
+                return None
+
+            try:
+                with open(self._path(name), 'rb') as f:
+                    entry = json.loads(f.readline())
+                    entry['body'] = f.read()
+
+                # Keep track of the last time it was used
+                os.utime(self._path(name), None)
+            except (IOError, OSError, ValueError):
+                return None
+        return entry
+
+    def set(self, url, response):
+        entry = {'url' : url,
+                 'headers' : dict((h, response.headers[h]) for h in self.HEADERS
+                                  if h in response.headers),
+                 'body' : response.content}
+
+        rec = self._record()
+
+        if rec:
+            rec.entries.append(entry)
+        else:
+            self.save([entry])
+
+    def save(self, entries):
+        for entry in entries:
+            self._write(entry)
+
+        with self._lock:
+            self._evict()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+        rec = self._record()
+
+        if rec:
+            rec.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+        rec = self._record()
+
+        if rec:
+            rec.misses += 1
+
+    def _record(self):
+        return getattr(self._local, 'record', None)
+
+    def _write(self, entry):
+        name = self._key(entry['url'])
+        path = self._path(name)
+        tmp = path + '.%s.%s.tmp' % (os.getpid(),
+                                     threading.current_thread().ident)
+
+        meta = {'url' : entry['url'], 'headers' : entry['headers']}
+
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(meta) + '\n')
+            f.write(entry['body'])
+
+        with self._lock:
+            os.rename(tmp, path)
+            self._total -= self._sizes.get(name, 0)
+            self._sizes[name] = os.path.getsize(path)
+            self._total += self._sizes[name]
+
+    def _evict(self):
+        if self._total <= self.max_size:
+            return
+
+        entries = []
+
+        for name in self._sizes.keys():
+            try:
+                entries.append((os.path.getmtime(self._path(name)), name))
+            except OSError:
+                # Already removed by another process
+                self._total -= self._sizes.pop(name)
+
+        for _, name in sorted(entries):
+            if self._total <= self.max_size:
+                break
+
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+            self._total -= self._sizes.pop(name)
+
+    def _key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.dirpath, name)
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that revalidates GET requests against a ResponseCache.
+
+    Cached responses are revalidated sending If-None-Match and
+    If-Modified-Since headers. When the server replies with
+    '304 Not Modified', the response is rebuilt from the cache.
+    """
+
+    def __init__(self, cache, **kwargs):
+        super(CachingAdapter, self).__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingAdapter, self).send(request, **kwargs)
+
+        entry = self.cache.get(request.url)
+
+        if entry:
+            headers = entry['headers']
+
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        response = super(CachingAdapter, self).send(request, **kwargs)
+
+        if response.status_code == 304 and entry:
+            self.cache.hit()
+
+            response.status_code = 200
+            response.reason = 'OK'
+            response.headers.update(entry['headers'])
+            response.encoding = 'utf-8'
+            response._content = entry['body']
+            response._content_consumed = True
+        elif response.status_code == 200:
+            self.cache.miss()
+
+            if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+                self.cache.set(request.url, response)
+
+        return response
@@ -0,0 +1,1099 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import datetime
+import email.utils
+import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+import dateutil.parser
+import requests
+from sqlalchemy import bindparam, event
+from sqlalchemy.sql import func
+
+from pullpo.backends import Backend, BackendError
+from pullpo.backends.cache import ResponseCache, CachingAdapter
+from pullpo.backends.replay import RecordingAdapter
+from pullpo.db.bulk import bulk_insert, bulk_upsert
+from pullpo.db.model import Forge, User, Event, Repository, PullRequest,\
+    CrawlState
+
+
+class RateLimitExceeded(BackendError):
+    """Rate limit exceeded error"""
+
+
+class ServerError(BackendError):
+    """Server error that persisted after retrying the request"""
+
+
+def parse_timestamp(ts):
+    """Convert a timestamp into a naive datetime.
+
+    Dates like 'YYYY-MM-DDTHH:MM:SSZ', optionally with fractions
+    of second, are converted slicing the string. Any other format
+    is parsed by dateutil. Fractions and time zones are discarded.
+    """
+    if ts is None:
+        return None
+    elif isinstance(ts, datetime.datetime):
+        return ts.replace(tzinfo=None)
+    elif len(ts) >= 20 and ts[10] == 'T' and ts[19] in 'Z.' and ts[-1] == 'Z':
+        try:
+            return datetime.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                                     int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+        except ValueError:
+            pass
+    return dateutil.parser.parse(ts).replace(tzinfo=None)
+
+
+class RateLimitScheduler(object):
+    """Schedule requests according to the rate limits of a server.
+
+    The budget of each token is read from the Remaining and Reset
+    headers of its responses, named after HEADER_PREFIX. Requests are
+    sent using the token with the largest budget left. Once that budget
+    falls below 'threshold' times the limit, requests are spaced so
+    the remaining ones last until the reset time. When every token
+    is exhausted, the scheduler sleeps until the earliest reset.
+
+    When several processes share the same tokens, 'share' is the
+    number of them, so each one only uses its part of the budget.
+    """
+
+    HEADER_PREFIX = 'X-RateLimit-'
+
+    # Seconds added to reset times to cover rounding and clock drifts
+    RESET_MARGIN = 1
+
+    def __init__(self, tokens=None, threshold=0.5, share=1):
+        self.tokens = list(tokens or [None])
+        self.threshold = threshold
+        self.share = max(share, 1)
+        self.requests = 0
+        self.waited = 0.0
+        self.started = time.time()
+
+        self._budgets = dict((token, {'limit' : None,
+                                      'remaining' : None,
+                                      'reset' : None})
+                             for token in self.tokens)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def throughput(self):
+        """Requests sent per hour"""
+        elapsed = max(time.time() - self.started, 1)
+        return self.requests * 3600.0 / elapsed
+
+    def acquire(self):
+        """Wait for the next request slot and return the token to use"""
+        with self._lock:
+            now = time.time()
+            token, wait = self._select(now)
+
+            # Requests are spaced from the last slot given
+            start = max(now + wait, self._next)
+            self._next = start + self._interval(token, start)
+            self.requests += 1
+
+        delay = start - time.time()
+
+        if delay > 0:
+            with self._lock:
+                self.waited += delay
+            time.sleep(delay)
+        return token
+
+    def update(self, token, response):
+        headers = response.headers
+        prefix = self.HEADER_PREFIX
+
+        if prefix + 'Remaining' not in headers:
+            return
+
+        reset = int(headers.get(prefix + 'Reset', 0))
+
+        # Translate the reset time to the local clock
+        date = email.utils.parsedate_tz(headers.get('Date', ''))
+
+        if date:
+            reset += time.time() - email.utils.mktime_tz(date)
+
+        with self._lock:
+            budget = self._budgets[token]
+            budget['limit'] = int(headers.get(prefix + 'Limit', 0))
+            budget['remaining'] = int(headers[prefix + 'Remaining'])
+            budget['reset'] = reset + self.RESET_MARGIN
+
+    def is_exhausted(self, response):
+        return response.status_code in (403, 429) and \
+            response.headers.get(self.HEADER_PREFIX + 'Remaining') == '0'
+
+    def retry_after(self, response):
+        """Seconds to wait requested by a secondary rate limit"""
+        if response.status_code not in (403, 429):
+            return None
+
+        value = response.headers.get('Retry-After')
+        return int(value) if value and value.isdigit() else None
+
+    def _select(self, now):
+        available = []
+
+        for token in self.tokens:
+            budget = self._budgets[token]
+
+            if budget['remaining'] is None or budget['reset'] <= now:
+                # Unknown or renewed budget
+                return token, 0
+            elif budget['remaining'] > 0:
+                available.append((budget['remaining'], token))
+
+        if available:
+            return max(available)[1], 0
+
+        # All tokens exhausted; wait for the first one to be renewed
+        token = min(self.tokens, key=lambda t: self._budgets[t]['reset'])
+        return token, self._budgets[token]['reset'] - now
+
+    def _interval(self, token, start):
+        budget = self._budgets[token]
+
+        if budget['remaining'] is None or not budget['limit']:
+            return 0
+
+        remaining = budget['remaining'] / float(self.share)
+
+        if remaining >= budget['limit'] * self.threshold / self.share:
+            return 0
+
+        return max(budget['reset'] - start, 0) / max(remaining, 1)
+
+
+class ScheduledAdapter(requests.adapters.BaseAdapter):
+    """HTTP adapter that sends requests through a RateLimitScheduler.
+
+    Requests rejected because of the rate limit are sent again once
+    the scheduler finds a token with budget left, up to 'retries' times.
+    Responses with a status in RETRY_STATUSES, sent by overloaded
+    servers and proxies, are retried the same number of times,
+    doubling the wait each time. The token given by the scheduler is
+    set on each request by 'authorize'.
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    # Seconds waited before the first retry of a server error
+    BACKOFF = 1
+
+    def __init__(self, adapter, scheduler, retries=5, authorize=None):
+        super(ScheduledAdapter, self).__init__()
+        self.adapter = adapter
+        self.scheduler = scheduler
+        self.retries = retries
+        self.authorize = authorize or self._authorize
+        self.retried = 0
+
+    def send(self, request, **kwargs):
+        backoff = self.BACKOFF
+
+        for attempt in range(self.retries + 1):
+            token = self.scheduler.acquire()
+
+            if token:
+                self.authorize(request, token)
+
+            response = self.adapter.send(request, **kwargs)
+            self.scheduler.update(token, response)
+
+            if attempt == self.retries:
+                break
+
+            retry_after = self.scheduler.retry_after(response)
+
+            if self.scheduler.is_exhausted(response):
+                pass
+            elif retry_after:
+                time.sleep(retry_after)
+            elif response.status_code in self.RETRY_STATUSES:
+                time.sleep(backoff)
+                backoff *= 2
+            else:
+                break
+            self.retried += 1
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+    def _authorize(self, request, token):
+        request.headers['Authorization'] = 'Bearer ' + token
+
+
+# Returned instead of the data of a pull request
+# that did not change since it was stored
+UNCHANGED = object()
+
+
+# Updates and sizes of a stored pull request
+Fingerprint = namedtuple('Fingerprint', ['updated_at', 'comments_count',
+                                         'review_comments_count',
+                                         'events_count', 'last_event_id'])
+
+
+# User of the platforms whose clients don't provide user objects
+ForgeUser = namedtuple('ForgeUser', ['login', 'email', 'avatar_url',
+                                     'url', 'type'])
+
+
+class PullRequestData(object):
+    """Pull request and its sub-collections retrieved from a server.
+
+    'issue' is the item of the listing the pull request was found
+    on and 'pr' the pull request itself, which can be the same one.
+    The names of the sub-collections served from the response
+    cache, which did not change since they were stored, are
+    kept in 'cached'. When only the events after the newest one
+    stored were retrieved, 'events' has the new ones and
+    'skipped_events' the number of stored ones.
+    """
+
+    def __init__(self, issue, pr):
+        self.issue = issue
+        self.pr = pr
+        self.merged = False
+        self.comments = []
+        self.review_comments = []
+        self.commits = []
+        self.events = []
+        self.skipped_events = 0
+        self.skipped_event_pages = 0
+        self.cache_entries = []
+        self.cached = set()
+
+
+class UserCache(object):
+    """Least recently used cache of the users stored.
+
+    Maps logins to the rows of the users, keeping up to 'size'
+    of them. When 'complete' is set, every stored user is in the
+    cache, so logins not found belong to new users. Users marked
+    as dirty, whose changes are not stored yet, are kept until
+    clean() is called.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.complete = False
+        self._users = OrderedDict()
+        self._dirty = set()
+
+    def __contains__(self, login):
+        return login in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, login):
+        row = self._users.pop(login, None)
+
+        if row is not None:
+            self._users[login] = row
+        return row
+
+    def set(self, login, row):
+        self._users.pop(login, None)
+        self._users[login] = row
+        self._evict()
+
+    def mark_dirty(self, login):
+        self._dirty.add(login)
+
+    def dirty(self):
+        """Rows of the users marked as dirty"""
+        return [self._users[login] for login in self._dirty]
+
+    def clean(self):
+        self._dirty.clear()
+        self._evict()
+
+    def clear(self):
+        self._users.clear()
+        self._dirty.clear()
+        self.complete = False
+
+    def _evict(self):
+        # The most recently used user is never removed
+        while len(self._users) > self.size:
+            older = islice(self._users, len(self._users) - 1)
+            login = next((login for login in older
+                          if login not in self._dirty), None)
+
+            if login is None:
+                return
+
+            del self._users[login]
+            self.complete = False
+
+
+class ForgeBackend(Backend):
+    """Core shared by the backends of the code review platforms.
+
+    The core sends the requests of the HTTP session 'http' through a
+    RateLimitScheduler, which spaces them and retries the rejected
+    ones, and through a ResponseCache when 'cache_path' is given.
+    Pull requests are retrieved by 'workers' threads while the
+    previous ones are mapped into the session. The crawl state, the
+    users, the fingerprints and the events of the pull requests are
+    stored the same way for every platform.
+
+    Subclasses map the data of a platform. They list the pull requests
+    of a repository (_fetch, usually with _crawl), retrieve each one
+    together with its sub-collections (_hydrate_pull_request) and map
+    it into the model objects (_fetch_pull_request and _event_row).
+    Users are given to the core as objects with the attributes of
+    ForgeUser, like the users of github3.
+
+    Subclasses set 'url' to the URL of their instance before calling
+    this constructor. Ids and logins are only unique within a forge,
+    so repositories, pull requests and users are stored under the
+    forge of that URL.
+
+    Responses can be recorded on a ResponseArchive ('record') and
+    served again, without the server, by passing a ReplayAdapter
+    ('adapter').
+    """
+
+    # Name of the platform on messages
+    LABEL = None
+
+    ISSUES_PER_PAGE = 100
+    USERS_PER_PAGE = 5000
+
+    # Columns of the users kept in the cache
+    USER_FIELDS = ('name', 'email', 'avatar_url', 'url', 'type')
+
+    # Scheduler of the requests sent to the platform
+    SCHEDULER = RateLimitScheduler
+
+    # Errors retrieving a pull request that don't stop the crawl
+    SKIPPED_ERRORS = (ServerError,)
+
+    # Requests sent, at least, to retrieve a listed pull request
+    # and its sub-collections
+    HYDRATION_REQUESTS = 1
+
+    def __init__(self, name, session, http, tokens=None, workers=1,
+                 cache_path=None, cache_size=512 * 1024 * 1024, share=1,
+                 users_cache_size=10000, adapter=None, record=None):
+        super(ForgeBackend, self).__init__(name)
+
+        self.http = http
+        self.users = UserCache(users_cache_size)
+        self.session = session
+        self.forge_id = None
+        self._users_loaded = False
+        self._cache_entries = []
+        self.workers = max(workers, 1)
+        self.skipped_issues = 0
+        self.saved_requests = 0
+        self.unchanged_prs = 0
+        self.new_events = 0
+        self.skipped_events = 0
+        self.skipped_event_pages = 0
+        self._fingerprints = {}
+        self._pending_events = []
+        self._pending_children = []
+
+        if cache_path:
+            self.cache = ResponseCache(cache_path, cache_size)
+        else:
+            self.cache = None
+
+        # A given adapter, like a ReplayAdapter, replaces the server.
+        # Otherwise, keep one connection per worker alive
+        if adapter is None and self.cache:
+            adapter = CachingAdapter(self.cache, pool_maxsize=self.workers)
+        elif adapter is None:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+
+        if record is not None:
+            adapter = RecordingAdapter(adapter, record)
+
+        self.scheduler = self.SCHEDULER(tokens, share=share)
+        self.adapter = ScheduledAdapter(adapter, self.scheduler,
+                                        authorize=self._authorize)
+
+        self.http.mount('https://', self.adapter)
+        self.http.mount('http://', self.adapter)
+
+        event.listen(self.session, 'after_commit', self._save_cache)
+        event.listen(self.session, 'after_rollback', self._discard_cache)
+        event.listen(self.session, 'before_commit', self._insert_events)
+        event.listen(self.session, 'after_rollback', self._discard_events)
+        event.listen(self.session, 'before_commit', self._upsert_children)
+        event.listen(self.session, 'after_rollback', self._discard_children)
+        event.listen(self.session, 'after_commit', self._reset_pending)
+        event.listen(self.session, 'after_rollback', self._reset_pending)
+        event.listen(self.session, 'before_commit', self._flush_users)
+
+    def fetch(self, owner, repository=None, since=None, newest=False):
+        repositories = self._fetch_repositories_list(owner, repository)
+
+        self._load_forge()
+        self._load_users()
+
+        for repo in repositories:
+            for r in self._fetch(owner, repo, since, newest):
+                yield r
+
+        self._write_users()
+
+    def repositories(self, owner):
+        """List the repositories of an owner"""
+        return self._fetch_repositories_list(owner)
+
+    def reset(self):
+        """Forget the objects cached from the session.
+
+        Call it after rolling back the session, as the objects
+        created since the last commit are no longer valid.
+        """
+        self.forge_id = None
+        self.users.clear()
+        self._users_loaded = False
+        self._pending_events = []
+        self._pending_children = []
+
+    def _fetch_repositories_list(self, owner, repository=None):
+        raise NotImplementedError
+
+    def _fetch(self, owner, repository, since=None, newest=False):
+        raise NotImplementedError
+
+    def _is_pull_request(self, item):
+        return True
+
+    def _hydrate_pull_request(self, item):
+        """PullRequestData of a listed item, UNCHANGED or None.
+
+        Called by the workers, so it must not touch the session.
+        """
+        raise NotImplementedError
+
+    def _fetch_pull_request(self, data):
+        """Map a PullRequestData into the session"""
+        raise NotImplementedError
+
+    def _event_row(self, event):
+        raise NotImplementedError
+
+    def _event_id(self, event):
+        raise NotImplementedError
+
+    def _updated_at(self, item):
+        return item.updated_at
+
+    def _item_number(self, item):
+        return item.number
+
+    def _authorize(self, request, token):
+        request.headers['Authorization'] = 'Bearer ' + token
+
+    def _crawl(self, db_repo, state, since, page, items):
+        """Retrieve and store the pull requests of a listing.
+
+        Items are sorted by update date, as sent from 'page' on, so
+        the crawl state is advanced past each item processed.
+        """
+        processed = 0
+        item = None
+
+        for item, result in self._hydrate_items(items):
+            processed += 1
+
+            try:
+                data = result()
+
+                if data is UNCHANGED:
+                    self._count_skipped(item, data)
+                    self._update_crawl(state, item, page, processed)
+                    continue
+
+                # Check if the item is a pull request
+                if not data:
+                    self._count_skipped(item, data)
+                    continue
+
+                db_pr = self._store_pull_request(data, db_repo)
+                self._update_crawl(state, item, page, processed)
+                yield db_pr
+            except self.SKIPPED_ERRORS, e:
+                msg = "Cannot retrieve pull request #%s. Skipping it. Error: %s\n" \
+                    % (self._item_number(item), str(e))
+                sys.stderr.write(msg)
+
+        self._complete_crawl(state, db_repo, since, item)
+
+    def _start_crawl(self, db_repo, since, newest):
+        """Find where the crawl of a repository has to start.
+
+        Returns the state of the crawl, the date since issues have
+        to be retrieved and the first page of the issues listing.
+        Crawls sorted by newest issues first are resumed on the page
+        following the last one stored. Otherwise, crawls start on the
+        date of the last issue stored.
+        """
+        state = self._fetch_crawl_state(db_repo)
+        page = 1
+
+        if since:
+            pass
+        elif not state.completed and state.newest and newest and state.page:
+            since = state.since
+            page = state.page + 1
+        elif state.updated_at:
+            since = state.updated_at
+        elif not state.id:
+            # Repositories stored before crawls were tracked
+            since = self._last_pull_request_date(db_repo)
+
+        if page == 1:
+            state.since = since
+            state.newest = newest
+            state.page = 0
+
+        state.completed = False
+
+        return state, since, page
+
+    def _load_forge(self):
+        if self.forge_id is not None:
+            return
+
+        forge = Forge().as_unique(self.session, url=self.url)
+
+        if not forge.id:
+            forge.kind = self.name
+            self.session.flush()
+
+        self.forge_id = forge.id
+
+    def _store_repository(self, owner, full_name, name, url):
+        db_repo = Repository().as_unique(self.session,
+                                         owner=owner,
+                                         repository=full_name,
+                                         forge_id=self.forge_id)
+
+        # Pull requests are linked using the id of the repository
+        if not db_repo.id:
+            db_repo.name = name
+            db_repo.url = url
+            self.session.flush()
+        return db_repo
+
+    def _fetch_crawl_state(self, db_repo):
+        state = CrawlState().as_unique(self.session, repo_id=db_repo.id)
+        state.repository = db_repo
+        return state
+
+    def _last_pull_request_date(self, db_repo):
+        if not db_repo.id:
+            return None
+
+        return self.session.query(func.max(PullRequest.updated_at)).\
+            filter(PullRequest.repo_id == db_repo.id).scalar()
+
+    def _update_crawl(self, state, issue, page, processed):
+        # Issues up to this one will be stored with the pull request
+        if state.newest:
+            state.page = page - 1 + processed // self.ISSUES_PER_PAGE
+        else:
+            state.updated_at = self.unmarshal_timestamp(self._updated_at(issue))
+
+    def _complete_crawl(self, state, db_repo, since, last_issue):
+        if state.newest:
+            self.session.flush()
+            state.updated_at = self._last_pull_request_date(db_repo)
+        elif last_issue:
+            state.updated_at = self.unmarshal_timestamp(self._updated_at(last_issue))
+
+        if not state.updated_at:
+            state.updated_at = since
+
+        state.since = None
+        state.page = 0
+        state.completed = True
+
+    def _load_fingerprints(self, db_repo, numbers=None):
+        """Updates and sizes of the stored pull requests.
+
+        Every pull request of the repository is loaded or, if given,
+        the ones in 'numbers'. Their stored update date can't be used
+        to filter them, as the pull requests updated since the last
+        crawl are the ones listed again. Pull requests stored before
+        their sub-collections were counted are left out, so they are
+        always retrieved.
+        """
+        if not db_repo.id:
+            return {}
+
+        query = self.session.query(PullRequest.number,
+                                   PullRequest.updated_at,
+                                   PullRequest.comments_count,
+                                   PullRequest.review_comments_count,
+                                   PullRequest.events_count,
+                                   PullRequest.last_event_id).\
+            filter(PullRequest.repo_id == db_repo.id,
+                   PullRequest.events_count != None)
+
+        if numbers:
+            query = query.filter(PullRequest.number.in_(numbers))
+
+        return dict((row[0], Fingerprint(*row[1:])) for row in query)
+
+    def _is_unchanged(self, number, updated_at, comments_count=None):
+        """Check whether a listed pull request is the one stored.
+
+        Sub-collections only change when updated_at does; the number
+        of comments, when the listing has it, guards against pull
+        requests stored partially. Called by the workers, which don't
+        touch the database.
+        """
+        fingerprint = self._fingerprints.get(number)
+
+        if fingerprint is None:
+            return False
+        elif comments_count is None:
+            return fingerprint.updated_at == self.unmarshal_timestamp(updated_at)
+
+        return (fingerprint.updated_at, fingerprint.comments_count) == \
+            (self.unmarshal_timestamp(updated_at), comments_count)
+
+    def _store_pull_request(self, data, db_repo):
+        db_pr = self._fetch_pull_request(data)
+
+        if 'events' not in data.cached:
+            self._fetch_issue_events(data.events, db_pr,
+                                     new_only=bool(data.skipped_events))
+
+        db_pr.repo_id = db_repo.id
+
+        db_pr.comments_count = len(data.comments)
+        db_pr.review_comments_count = len(data.review_comments)
+        db_pr.commits_count = len(data.commits)
+        db_pr.events_count = data.skipped_events + len(data.events)
+
+        if data.events:
+            db_pr.last_event_id = max(self._event_id(e) for e in data.events)
+
+        self.skipped_events += data.skipped_events
+        self.skipped_event_pages += data.skipped_event_pages
+
+        self._fingerprints[db_pr.number] = Fingerprint(db_pr.updated_at,
+                                                       db_pr.comments_count,
+                                                       db_pr.review_comments_count,
+                                                       db_pr.events_count,
+                                                       db_pr.last_event_id)
+
+        self._cache_entries += data.cache_entries
+
+        return db_pr
+
+    def _save_cache(self, session):
+        # Responses are only cached once the data built
+        # from them has been committed by the caller
+        entries = self._cache_entries
+        self._cache_entries = []
+
+        if self.cache and entries:
+            self.cache.save(entries)
+
+    def _discard_cache(self, session):
+        self._cache_entries = []
+
+    def _insert_events(self, session):
+        """Insert the events queued since the last commit in one batch"""
+
+        if not self._pending_events:
+            return
+
+        # New pull requests get their ids
+        session.flush()
+
+        rows = OrderedDict()
+
+        for db_pr, pr_rows in self._pending_events:
+            for row in pr_rows:
+                row['pull_request_id'] = db_pr.id
+                rows[(db_pr.id, row['event_id'])] = row
+
+        self._pending_events = []
+
+        bulk_insert(session.connection(), Event.__table__, rows.values())
+        self.new_events += len(rows)
+
+    def _discard_events(self, session):
+        self._pending_events = []
+
+    def _queue_children(self, model, db_pr, rows):
+        """Queue rows of a table that belongs to a pull request.
+
+        They are upserted on the unique key of the model when the
+        session is committed, in one statement per table.
+        """
+        self._pending_children.append((model, db_pr, rows))
+        self._count_pending(len(rows))
+
+    def _count_pending(self, rows):
+        # Rows written on commit, which BatchWriter can't see
+        # among the objects of the session, count for its batches
+        info = self.session.info
+        info['pending_rows'] = info.get('pending_rows', 0) + rows
+
+    def _upsert_children(self, session):
+        """Upsert the rows queued since the last commit"""
+
+        if not self._pending_children:
+            return
+
+        # New pull requests get their ids
+        session.flush()
+
+        tables = OrderedDict()
+
+        for model, db_pr, pr_rows in self._pending_children:
+            rows = tables.setdefault(model, OrderedDict())
+
+            for row in pr_rows:
+                row['pull_request_id'] = db_pr.id
+                rows[tuple(row[k] for k in model.unique_key)] = row
+
+        self._pending_children = []
+
+        for model, rows in tables.items():
+            bulk_upsert(session.connection(), model.__table__,
+                        rows.values(), model.unique_key)
+
+    def _discard_children(self, session):
+        self._pending_children = []
+
+    def _reset_pending(self, session):
+        session.info.pop('pending_rows', None)
+
+    def _hydrate_items(self, items):
+        """Retrieve the data of the pull requests of a listing.
+
+        Yields pairs of item and a callable that returns its
+        PullRequestData (or None when the item is not a pull request).
+        With more than one worker, up to twice the number of workers
+        items are retrieved concurrently while the caller maps the
+        previous ones into the database, preserving the listing order.
+        Database objects are never touched by the workers.
+        """
+        if self.workers == 1:
+            for item in items:
+                yield item, lambda item=item: self._hydrate_pull_request(item)
+            return
+
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        running = 0
+
+        try:
+            for item in items:
+                # Plain issues are not sent to the workers
+                if self._is_pull_request(item):
+                    result = pool.apply_async(self._hydrate_pull_request,
+                                              (item,)).get
+                    running += 1
+                else:
+                    result = lambda: None
+
+                pending.append((item, result))
+
+                while running >= 2 * self.workers:
+                    item, result = pending.popleft()
+
+                    if self._is_pull_request(item):
+                        running -= 1
+                    yield item, result
+
+            while pending:
+                item, result = pending.popleft()
+                yield item, result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _count_skipped(self, item, data):
+        """Count a listed item that is not stored.
+
+        The hydration of unchanged pull requests and plain issues
+        is skipped, which saves its requests.
+        """
+        if data is UNCHANGED:
+            self.unchanged_prs += 1
+            self.saved_requests += self.HYDRATION_REQUESTS
+        else:
+            self.skipped_issues += 1
+
+            if not self._is_pull_request(item):
+                self.saved_requests += 1
+
+    def _hydrate_collection(self, data, name, iterator):
+        if not self.cache:
+            return list(iterator)
+
+        with self.cache.record() as rec:
+            items = list(iterator)
+
+        data.cache_entries += rec.entries
+
+        if rec.cached:
+            data.cached.add(name)
+        return items
+
+    def _get(self, url, params=None):
+        """Send a GET request to the platform.
+
+        Returns the response, or None when the resource does not
+        exist. Rejections and server errors that persisted after
+        the retries of the scheduler raise a BackendError.
+        """
+        response = self.http.get(url, params=params)
+        status = response.status_code
+
+        if status == 404:
+            return None
+        elif self.scheduler.is_exhausted(response) or status == 429:
+            raise RateLimitExceeded("%s - Rate limit exceeded. " % self.LABEL)
+        elif status in (401, 403):
+            raise BackendError("%s - Authentication failed (%s) on %s"
+                               % (self.LABEL, status, url))
+        elif status >= 500:
+            raise ServerError("%s - Error %s on %s" % (self.LABEL, status, url))
+        elif status >= 400:
+            raise BackendError("%s - Error %s on %s" % (self.LABEL, status, url))
+        return response
+
+    def _json(self, response):
+        return response.json()
+
+    def _paginate(self, url, params=None):
+        """Items of a listing, following the 'next' links of its pages"""
+
+        while url:
+            response = self._get(url, params)
+
+            if response is None:
+                return
+
+            for item in self._json(response):
+                yield item
+
+            url = response.links.get('next', {}).get('url')
+            params = None
+
+    def _fetch_issue_events(self, events, db_pr, new_only=False):
+        """Queue the events of a pull request to be inserted.
+
+        Events are never updated, so they are inserted in a single
+        batch before the session is committed, once every pull
+        request has its id. Events already stored are dropped,
+        unless all of them are known to be new.
+        """
+        rows = [self._event_row(event) for event in events]
+
+        if rows and db_pr.id and not new_only:
+            with self.session.no_autoflush:
+                stored = set(row[0] for row in
+                             self.session.query(Event.event_id).\
+                             filter(Event.pull_request_id == db_pr.id))
+
+            rows = [row for row in rows if row['event_id'] not in stored]
+
+        if rows:
+            self._pending_events.append((db_pr, rows))
+            self._count_pending(len(rows))
+        return rows
+
+    def _load_users(self):
+        """Fill the cache with the users stored, in pages"""
+        if self._users_loaded:
+            return
+
+        columns = [User.id, User.login] + [getattr(User, f) for f in self.USER_FIELDS]
+        last_id = 0
+        loaded = 0
+        complete = False
+
+        while loaded < self.users.size:
+            rows = self.session.query(*columns).\
+                filter(User.forge_id == self.forge_id,
+                       User.id > last_id).\
+                order_by(User.id).limit(self.USERS_PER_PAGE).all()
+
+            for row in rows:
+                self.users.set(row.login, self._user_row(row))
+                last_id = row.id
+
+            loaded += len(rows)
+
+            if len(rows) < self.USERS_PER_PAGE:
+                complete = loaded <= self.users.size
+                break
+
+        self.users.complete = complete
+        self._users_loaded = True
+
+    def _fetch_users(self, users):
+        """Find or insert the users not found in the cache.
+
+        Users unknown to the cache are looked up in the database,
+        unless the cache has all of them. The new ones are inserted
+        at once.
+        """
+        logins = {}
+
+        for user in users:
+            if user and user.login not in self.users:
+                logins[user.login] = user
+
+        found = set()
+
+        if logins and not self.users.complete:
+            found = self._find_users(logins.keys())
+
+        new_users = [user for login, user in logins.items()
+                     if login not in found]
+
+        if new_users:
+            self._insert_users(new_users)
+
+        for user in users:
+            if user:
+                self._update_user(user)
+
+    def _find_users(self, logins):
+        columns = [User.id, User.login] + [getattr(User, f) for f in self.USER_FIELDS]
+        found = set()
+
+        query = self.session.query(*columns).\
+            filter(User.forge_id == self.forge_id,
+                   User.login.in_(logins))
+
+        for row in query:
+            self.users.set(row.login, self._user_row(row))
+            found.add(row.login)
+        return found
+
+    def _insert_users(self, users):
+        rows = [{'login' : user.login,
+                 'forge_id' : self.forge_id,
+                 'email' : user.email,
+                 'avatar_url' : user.avatar_url,
+                 'url' : user.url,
+                 'type' : user.type}
+                for user in users]
+
+        bulk_insert(self.session.connection(), User.__table__, rows)
+        self._find_users([user.login for user in users])
+
+    def _user_row(self, row):
+        user_row = dict((f, getattr(row, f)) for f in self.USER_FIELDS)
+        user_row['id'] = row.id
+        return user_row
+
+    def _update_user(self, user):
+        fields = {'avatar_url' : user.avatar_url,
+                  'url' : user.url,
+                  'type' : user.type}
+
+        # Profiles usually hide the email; keep the one from commits
+        if user.email:
+            fields['email'] = user.email
+
+        self._set_user_fields(user.login, fields)
+
+    def _update_user_identity(self, login, name, email):
+        self._set_user_fields(login, {'name' : name, 'email' : email})
+
+    def _set_user_fields(self, login, fields):
+        row = self.users.get(login)
+
+        if not row:
+            return
+
+        changed = [f for f in fields if row[f] != fields[f]]
+
+        if changed:
+            row.update(fields)
+            self.users.mark_dirty(login)
+
+    def _write_users(self):
+        """Write the changes of the users at once.
+
+        Changed users stay in the cache until they are written,
+        on each commit of the session and at the end of a fetch.
+        Each user is updated at most once, with the last values seen.
+        """
+        dirty = self.users.dirty()
+
+        if not dirty:
+            return
+
+        table = User.__table__
+        stmt = table.update().where(table.c.id == bindparam('user_id'))
+
+        rows = []
+
+        for row in dirty:
+            params = dict((f, row[f]) for f in self.USER_FIELDS)
+            params['user_id'] = row['id']
+            rows.append(params)
+
+        self.session.execute(stmt, rows)
+        self.users.clean()
+
+    def _flush_users(self, session):
+        self._write_users()
+
+    def _user_id(self, user):
+        if not user:
+            return None
+
+        row = self.users.get(user.login)
+
+        if not row:
+            self._fetch_users([user])
+            row = self.users.get(user.login)
+        return row['id']
+
+    def unmarshal_timestamp(self, ts):
+        return parse_timestamp(ts)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import datetime
+import json
+import urllib
+
+import requests
+
+from pullpo.backends import BackendError
+from pullpo.backends.core import ForgeBackend, ForgeUser, PullRequestData,\
+    UNCHANGED
+from pullpo.db.model import Commit, Comment, ReviewComment, PullRequest
+
+
+# Prefix of the JSON responses of Gerrit, sent against XSSI attacks
+XSSI_PREFIX = ")]}'"
+
+# Details of the changes requested on listings
+CHANGE_OPTIONS = ('DETAILED_ACCOUNTS', 'MESSAGES', 'ALL_REVISIONS',
+                  'ALL_COMMITS')
+
+
+class GerritBackend(ForgeBackend):
+    """Gerrit backend based on the REST API.
+
+    Changes are stored as pull requests; their messages are stored
+    as comments, the comments on files as review comments and their
+    patch sets as commits, linked to the users that uploaded them.
+    Gerrit has no events with identifiers, so none is stored.
+
+    Changes are listed together with their messages and patch sets,
+    from the newest updated one, so only their file comments are
+    requested apart. Repositories are the projects named
+    'owner/repository'. With a user and a password, requests are
+    authenticated using the '/a/' endpoints.
+    """
+
+    LABEL = 'Gerrit'
+
+    def __init__(self, url, session, user=None, password=None, **kwargs):
+        self.url = url.rstrip('/')
+
+        http = requests.Session()
+
+        if user:
+            http.auth = (user, password)
+            self.api_url = self.url + '/a'
+        else:
+            self.api_url = self.url
+
+        super(GerritBackend, self).__init__('gerrit', session, http,
+                                            **kwargs)
+
+    def _json(self, response):
+        content = response.content
+
+        if content.startswith(XSSI_PREFIX):
+            content = content[len(XSSI_PREFIX):]
+        return json.loads(content)
+
+    def _paginate(self, url, params=None):
+        """Items of a listing of changes, requested in pages.
+
+        Gerrit flags the last item of a page with '_more_changes'
+        when more are available, which are skipped with 'S'.
+        """
+        params = dict(params or {})
+
+        while True:
+            response = self._get(url, params)
+
+            if response is None:
+                return
+
+            items = self._json(response)
+
+            for item in items:
+                yield item
+
+            if not items or not items[-1].get('_more_changes'):
+                return
+
+            params['S'] = params.get('S', 0) + len(items)
+
+    def _fetch_repositories_list(self, owner, repository=None):
+        if repository:
+            project = owner + '/' + repository
+            response = self._get('%s/projects/%s' % (self.api_url, quote(project)))
+
+            if response is None:
+                raise BackendError("Gerrit - Repository %s:%s does not exist."
+                                   % (owner, repository))
+            return [self._json(response)['name']]
+
+        response = self._get(self.api_url + '/projects/', {'p' : owner + '/'})
+        projects = sorted(self._json(response)) if response is not None else []
+
+        if not projects:
+            raise BackendError("Gerrit - Owner %s does not exist." % owner)
+        return projects
+
+    def _fetch(self, owner, project, since=None, newest=False):
+        db_repo = self._store_repository(owner, project,
+                                         project.rsplit('/', 1)[-1],
+                                         '%s/q/project:%s' % (self.url, project))
+
+        # Changes are always sorted from the newest updated one
+        state, since, page = self._start_crawl(db_repo, since, True)
+
+        self._fingerprints = self._load_fingerprints(db_repo)
+
+        query = 'project:' + project
+
+        if since:
+            query += ' after:"%s"' % since.strftime('%Y-%m-%d %H:%M:%S')
+
+        params = {'q' : query,
+                  'o' : CHANGE_OPTIONS,
+                  'n' : self.ISSUES_PER_PAGE,
+                  'S' : (page - 1) * self.ISSUES_PER_PAGE}
+
+        changes = self._paginate(self.api_url + '/changes/', params)
+
+        for db_pr in self._crawl(db_repo, state, since, page, changes):
+            yield db_pr
+
+    def _updated_at(self, change):
+        return change['updated']
+
+    def _item_number(self, change):
+        return change['_number']
+
+    def _hydrate_pull_request(self, change):
+        if self._is_unchanged(change['_number'], change['updated'],
+                              len(self._messages(change))):
+            return UNCHANGED
+
+        data = PullRequestData(change, change)
+        data.merged = change['status'] == 'MERGED'
+        data.comments = self._messages(change)
+        data.commits = sorted(change.get('revisions', {}).items(),
+                              key=lambda r: r[1]['_number'])
+
+        url = '%s/changes/%s/comments' % (self.api_url, change['_number'])
+        response = self._get(url)
+        files = self._json(response) if response is not None else {}
+
+        # Comments refer to the number of their patch set
+        shas = dict((revision['_number'], sha) for sha, revision in data.commits)
+
+        for path in sorted(files):
+            for comment in files[path]:
+                comment['commit_id'] = shas.get(comment.get('patch_set'))
+                data.review_comments.append(comment)
+
+        data.review_comments.sort(key=lambda c: c['updated'])
+        return data
+
+    def _messages(self, change):
+        # Messages without author are written by Gerrit
+        return [message for message in change.get('messages', [])
+                if message.get('author')]
+
+    def _fetch_pull_request(self, data):
+        change = data.pr
+
+        # Resolve all the users of this change at once
+        accounts = self._pull_request_users(data)
+        self._fetch_users([self._user(account) for account in accounts])
+
+        for account in accounts:
+            self._set_user_fields(self._login(account),
+                                  {'name' : account.get('name')})
+
+        db_pr = PullRequest().as_unique(self.session,
+                                        github_id=change['_number'],
+                                        forge_id=self.forge_id)
+
+        if not db_pr.id:
+            data.cached.clear()
+
+            db_pr.number = change['_number']
+            db_pr.created_at = self.unmarshal_timestamp(change['created'])
+
+        updated_at = self.unmarshal_timestamp(change['updated'])
+
+        if db_pr.updated_at != updated_at:
+            current = change.get('revisions', {}).get(change.get('current_revision'))
+
+            db_pr.title = change['subject']
+            db_pr.body = current['commit']['message'] if current else None
+            db_pr.state = 'open' if change['status'] == 'NEW' else 'closed'
+            db_pr.updated_at = updated_at
+            db_pr.additions = change.get('insertions')
+            db_pr.deletions = change.get('deletions')
+
+            if change['status'] != 'NEW':
+                db_pr.closed_at = self.unmarshal_timestamp(change.get('submitted') or
+                                                           change['updated'])
+            if data.merged:
+                db_pr.merged_at = self.unmarshal_timestamp(change.get('submitted'))
+                db_pr.merge_commit_sha = change.get('current_revision')
+                db_pr.merged = True
+
+            db_pr.user_id = self._user_id(self._user(change['owner']))
+            db_pr.merged_by_id = self._user_id(self._user(change.get('submitter')))
+
+        self._fetch_comments(data.comments, db_pr)
+        self._fetch_review_comments(data.review_comments, db_pr)
+        self._fetch_commits(data.commits, db_pr)
+
+        return db_pr
+
+    def _pull_request_users(self, data):
+        change = data.pr
+        accounts = [change['owner'], change.get('submitter')]
+
+        accounts += [message['author'] for message in data.comments]
+        accounts += [comment.get('author') for comment in data.review_comments]
+        accounts += [revision.get('uploader') for sha, revision in data.commits]
+
+        return [account for account in accounts if account]
+
+    def _login(self, account):
+        # Accounts may lack a user name
+        return account.get('username') or account.get('email') or \
+            'account-%s' % account['_account_id']
+
+    def _user(self, account):
+        if not account:
+            return None
+
+        return ForgeUser(login=self._login(account),
+                         email=account.get('email'),
+                         avatar_url=None,
+                         url=None,
+                         type='User')
+
+    def _fetch_comments(self, messages, db_pr):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'user_id' : self._user_id(self._user(message['author'])),
+                 'created_at' : self.unmarshal_timestamp(message['date'])}
+                for message in messages]
+
+        db_comments = Comment.as_unique_all(self.session, keys)
+
+        for message, db_comment in zip(messages, db_comments):
+            # Messages can't be edited
+            if not db_comment.updated_at:
+                db_comment.body = message['message']
+                db_comment.updated_at = self.unmarshal_timestamp(message['date'])
+            db_comment.pull_request = db_pr
+        return db_comments
+
+    def _fetch_review_comments(self, comments, db_pr):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'commit_id' : comment['commit_id'],
+                 'user_id' : self._user_id(self._user(comment.get('author'))),
+                 'created_at' : self.unmarshal_timestamp(comment['updated'])}
+                for comment in comments]
+
+        db_reviews = ReviewComment.as_unique_all(self.session, keys)
+
+        for comment, db_review in zip(comments, db_reviews):
+            updated_at = self.unmarshal_timestamp(comment['updated'])
+
+            if db_review.updated_at != updated_at:
+                db_review.body = comment.get('message')
+                db_review.updated_at = updated_at
+                db_review.original_commit_id = comment['commit_id']
+            db_review.pull_request = db_pr
+        return db_reviews
+
+    def _fetch_commits(self, revisions, db_pr):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'sha' : sha}
+                for sha, revision in revisions]
+
+        db_commits = Commit.as_unique_all(self.session, keys)
+
+        for (sha, revision), db_commit in zip(revisions, db_commits):
+            commit = revision.get('commit', {})
+
+            db_commit.author_date = self.unmarshal_timestamp(commit.get('author', {}).get('date'))
+            db_commit.commit_date = self.unmarshal_timestamp(commit.get('committer', {}).get('date'))
+            db_commit.author_id = self._user_id(self._user(revision.get('uploader')))
+            db_commit.pull_request = db_pr
+        return db_commits
+
+    def unmarshal_timestamp(self, ts):
+        # Gerrit sends UTC dates like '2015-01-01 00:00:00.000000000'
+        if ts is None:
+            return None
+        return datetime.datetime.strptime(ts[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def quote(name):
+    """Encode the name of a project to be used on URLs"""
+    return urllib.quote(name, safe='')
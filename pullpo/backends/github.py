@@ -21,97 +21,262 @@
 #
 
 import github3
+from github3.issues.event import IssueEvent
 
-from pullpo.backends import Backend, BackendError
-from pullpo.db.model import User, Commit, Comment, Event, ReviewComment,\
-    Repository, PullRequest
+from pullpo.backends import BackendError
+from pullpo.backends.core import ForgeBackend, PullRequestData,\
+    RateLimitExceeded, UNCHANGED
+from pullpo.db.model import Commit, Comment, ReviewComment, PullRequest
 
 
-class GitHubRateLimitExceeded(BackendError):
+GITHUB_URL = 'https://github.com'
+
+
+class GitHubRateLimitExceeded(RateLimitExceeded):
     """Rate limit exceeded error"""
 
 
-class GitHubBackend(Backend):
+def raw_data(obj):
+    """JSON payload a github3 object was built from"""
+    return obj._json_data
+
+
+class GitHubBackend(ForgeBackend):
+    """GitHub backend based on the REST API.
+
+    Pull requests are enumerated using the issues listing, which
+    can be filtered by date, or using the pulls listing ('listing'
+    set to 'pulls'), which doesn't include plain issues but is always
+    crawled from the newest updated pull request.
+
+    fetch() yields the pull requests once they are mapped into the
+    session, together with the state of the crawl. The caller decides
+    when to commit them; the responses used to build them are cached
+    after the session is committed.
+
+    Requests, workers, users and crawl states are handled by
+    ForgeBackend; this class maps the github3 objects.
+    """
+
+    LABEL = 'GitHub'
 
-    PULL_REQUESTS_COUNT = 5
+    EVENTS_PER_PAGE = 100
 
-    def __init__(self, user, password, token, session, enterprise_url=None):
-        super(GitHubBackend, self).__init__('github')
+    # The pull request, its comments, review comments, commits
+    # and events
+    HYDRATION_REQUESTS = 5
 
-        if token:
-            kwargs = {'token' : token}
+    SKIPPED_ERRORS = (github3.exceptions.ServerError,)
+
+    def __init__(self, user, password, token, session, enterprise_url=None,
+                 workers=1, cache_path=None, cache_size=512 * 1024 * 1024,
+                 share=1, listing='issues', users_cache_size=10000,
+                 adapter=None, record=None):
+        # Several tokens can be given to share the load among them
+        if isinstance(token, basestring):
+            tokens = [token]
+        else:
+            tokens = list(token or [])
+
+        if tokens:
+            kwargs = {'token' : tokens[0]}
         else:
             kwargs = {'username' : user,
                       'password' : password}
 
         if enterprise_url:
             self.gh = github3.GitHubEnterprise(enterprise_url, **kwargs)
+            self.url = enterprise_url.rstrip('/')
         else:
             self.gh = github3.login(**kwargs)
+            self.url = GITHUB_URL
+
+        self.listing = listing
 
-        self.USERS_CACHE = {}
-        self.session = session
+        super(GitHubBackend, self).__init__('github', session, self.gh.session,
+                                            tokens, workers=workers,
+                                            cache_path=cache_path,
+                                            cache_size=cache_size,
+                                            share=share,
+                                            users_cache_size=users_cache_size,
+                                            adapter=adapter, record=record)
 
     def fetch(self, owner, repository=None, since=None, newest=False):
         try:
             self._check_owner(owner)
 
-            repositories = self._fetch_repositories_list(owner, repository)
+            for r in super(GitHubBackend, self).fetch(owner, repository,
+                                                      since, newest):
+                yield r
+        except github3.exceptions.ForbiddenError, e:
+            raise GitHubRateLimitExceeded(e.message)
+        except github3.exceptions.AuthenticationFailed, e:
+            raise BackendError("GitHub - " + e.message)
+
+    def fetch_pull_requests(self, owner, repository, numbers):
+        """Retrieve some pull requests of a repository.
+
+        Used to update the pull requests notified by webhooks. The
+        state of the crawl of the repository is created when missing,
+        but not modified. Numbers of plain issues or deleted pull
+        requests are skipped.
+        """
+        try:
+            repo = self._fetch_repositories_list(owner, repository)[0]
+            self._load_forge()
+            db_repo = self._fetch_repository(owner, repo)
+
+            # Without a crawl state, the next crawl would take these
+            # pull requests for the newest ones of a previous crawl
+            self._fetch_crawl_state(db_repo)
+
+            self._load_users()
+
+            issues = [repo.issue(number) for number in numbers]
+            issues = [issue for issue in issues
+                      if not isinstance(issue, github3.null.NullObject)]
+
+            self._fingerprints = self._load_fingerprints(db_repo, numbers=numbers)
+
+            for issue, result in self._hydrate_items(issues):
+                data = result()
 
-            for repo in repositories:
-                for r in  self._fetch(owner, repo, since, newest):
-                    yield r
+                if data and data is not UNCHANGED:
+                    yield self._store_pull_request(data, db_repo)
+                else:
+                    self._count_skipped(issue, data)
+
+            self._write_users()
+        except github3.exceptions.ForbiddenError, e:
+            raise GitHubRateLimitExceeded(e.message)
+        except github3.exceptions.AuthenticationFailed, e:
+            raise BackendError("GitHub - " + e.message)
+
+    def repositories(self, owner):
+        """List the repositories of an owner"""
+        try:
+            self._check_owner(owner)
+            return self._fetch_repositories_list(owner)
         except github3.exceptions.ForbiddenError, e:
             raise GitHubRateLimitExceeded(e.message)
         except github3.exceptions.AuthenticationFailed, e:
             raise BackendError("GitHub - " + e.message)
 
     def _fetch(self, owner, repository, since=None, newest=False):
-        db_repo = Repository().as_unique(self.session,
-                                         owner=owner,
-                                         repository=repository)
+        db_repo = self._fetch_repository(owner, repository)
 
-        if not db_repo.id:
-            db_repo.name = repository.name
-            db_repo.url = repository.html_url
+        # The pulls listing can't be filtered by date
+        if self.listing == 'pulls':
+            newest = True
 
         direction = 'asc'
 
         if newest:
             direction = 'desc'
 
-        issues = repository.issues(state='all', sort='updated',
-                                   direction=direction, since=since)
+        state, since, page = self._start_crawl(db_repo, since, newest)
 
-        count = self.PULL_REQUESTS_COUNT
+        self._fingerprints = self._load_fingerprints(db_repo)
 
-        for issue in issues:
-            try:
-                db_pr = self._fetch_pull_request(issue)
-
-                # Check if the issue is a pull request
-                if not db_pr:
-                    continue
-
-                # Events are stored in issue object
-                for event in issue.events():
-                    db_event = self._fetch_issue_event(event)
-                    db_pr.events.append(db_event)
-
-                db_repo.prs.append(db_pr)
+        if self.listing == 'pulls':
+            issues = repository.pull_requests(state='all', sort='updated',
+                                              direction=direction)
+        else:
+            issues = repository.issues(state='all', sort='updated',
+                                       direction=direction, since=since)
+        issues.params['per_page'] = self.ISSUES_PER_PAGE
+        issues.params['page'] = page
+
+        if self.listing == 'pulls':
+            issues = self._updated_since(issues, since)
+
+        for db_pr in self._crawl(db_repo, state, since, page, issues):
+            yield db_pr
+
+    def _fetch_repository(self, owner, repository):
+        return self._store_repository(owner, repository.full_name,
+                                      repository.name, repository.html_url)
+
+    def _updated_since(self, items, since):
+        # Items are sorted from the newest updated one
+        for item in items:
+            if since and self.unmarshal_timestamp(item.updated_at) < since:
+                return
+            yield item
+
+    def _is_pull_request(self, issue):
+        # Issues listings flag pull requests with the 'pull_request' key
+        if isinstance(issue, github3.pulls.PullRequest):
+            return True
+        return bool(issue.pull_request_urls)
+
+    def _hydrate_pull_request(self, issue):
+        if not self._is_pull_request(issue):
+            return None
 
-                count = count - 1
+        if isinstance(issue, github3.pulls.PullRequest):
+            # Pull requests of the listing lack the number of comments
+            if self._is_unchanged(issue.number, issue.updated_at):
+                return UNCHANGED
+        elif self._is_unchanged(issue.number, issue.updated_at,
+                                issue.comments_count):
+            return UNCHANGED
+
+        if isinstance(issue, github3.pulls.PullRequest):
+            # Listed pull requests lack some of the fields stored
+            pr = issue.refresh()
+            url = pr._build_url('events', base_url=pr.issue_url)
+            events = lambda: pr._iter(-1, url, IssueEvent)
+        else:
+            pr = issue.pull_request()
+            events = issue.events
 
-                if not count:
-                    count = self.PULL_REQUESTS_COUNT
-                    yield db_repo
-            except github3.exceptions.ServerError, e:
-                import sys
-                msg = "Cannot retrieve pull request #%s. Skipping it. Error: %s\n" \
-                    % (issue.number, str(e))
-                sys.stderr.write(msg)
+        if not pr:
+            return None
 
-        yield db_repo
+        data = PullRequestData(issue, pr)
+        data.merged = bool(pr.merged or pr.merged_at)
+        data.comments = self._hydrate_collection(data, 'comments',
+                                                 pr.issue_comments())
+        data.review_comments = self._hydrate_collection(data, 'review_comments',
+                                                        pr.review_comments())
+        data.commits = self._hydrate_collection(data, 'commits',
+                                                pr.commits())
+        data.events = self._hydrate_events(data, issue.number, events)
+
+        return data
+
+    def _hydrate_events(self, data, number, listing):
+        """Retrieve the events of a pull request that are not stored.
+
+        Events never change and are listed from the oldest one, so
+        the listing starts on the page of the newest event stored and
+        the ones up to it are dropped. When that event is not found
+        on the page, as when events were removed, every page is
+        retrieved. 'listing' returns a new iterator over the events.
+        """
+        fingerprint = self._fingerprints.get(number)
+
+        if fingerprint and fingerprint.last_event_id:
+            count = fingerprint.events_count
+            last_id = fingerprint.last_event_id
+            page = (count - 1) // self.EVENTS_PER_PAGE + 1
+
+            events = listing()
+            events.params['per_page'] = self.EVENTS_PER_PAGE
+            events.params['page'] = page
+            events = self._hydrate_collection(data, 'events', events)
+
+            if last_id in [raw_data(e)['id'] for e in events]:
+                data.skipped_events = count
+                data.skipped_event_pages = page - 1
+                return [e for e in events if raw_data(e)['id'] > last_id]
+
+            data.cached.discard('events')
+
+        events = listing()
+        events.params['per_page'] = self.EVENTS_PER_PAGE
+        return self._hydrate_collection(data, 'events', events)
 
     def _check_owner(self, owner):
         user = self.gh.user(owner)
@@ -134,16 +299,22 @@ class GitHubBackend(Backend):
 
         return repositories
 
-    def _fetch_pull_request(self, issue):
-        pr = issue.pull_request()
+    def _fetch_pull_request(self, data):
+        issue = data.issue
+        pr = data.pr
 
-        if not pr:
-            return None
+        # Resolve all the users of this pull request at once
+        self._fetch_users(self._pull_request_users(data))
 
         db_pr = PullRequest().as_unique(self.session,
-                                        github_id=pr.id)
+                                        github_id=pr.id,
+                                        forge_id=self.forge_id)
 
+        # Cached responses were already stored unless
+        # the pull request was not in the database
         if not db_pr.id:
+            data.cached.clear()
+
             db_pr.number = pr.number
             db_pr.created_at = self.unmarshal_timestamp(pr.created_at)
 
@@ -160,143 +331,120 @@ class GitHubBackend(Backend):
             db_pr.merged_at = self.unmarshal_timestamp(pr.merged_at)
             db_pr.mergeable_state = pr.mergeable_state
 
-            if pr.is_merged():
-                d = pr.as_dict()
+            # Merged flag was read from the pull request
+            # instead of requesting its merge status
+            if not data.merged:
+                self.saved_requests += 1
+
+            if data.merged:
+                d = raw_data(pr)
                 db_pr.merge_commit_sha = d[u'merge_commit_sha']
                 db_pr.additions = d[u'additions']
                 db_pr.deletions = d[u'deletions']
                 db_pr.changed_files = d[u'changed_files']
                 db_pr.merged = True
 
-            db_pr.user = self._fetch_user(pr.user)
+            db_pr.user_id = self._user_id(pr.user)
 
             if pr.merged_by:
-                db_pr.merged_by = self._fetch_user(pr.merged_by)
+                db_pr.merged_by_id = self._user_id(pr.merged_by)
             if pr.assignee:
-                db_pr.assignee = self._fetch_user(pr.assignee)
+                db_pr.assignee_id = self._user_id(pr.assignee)
 
-        for comment in pr.issue_comments():
-            db_comment = self._fetch_comment(comment, db_pr.id)
-            db_pr.comments.append(db_comment)
-
-        for review in pr.review_comments():
-            db_review = self._fetch_review_comment(review, db_pr.id)
-            db_pr.review_comments.append(db_review)
-
-        for commit in pr.commits():
-            db_commit = self._fetch_commit(commit, db_pr.id)
-            db_pr.commits.append(db_commit)
+        if 'comments' not in data.cached:
+            self._fetch_comments(data.comments, db_pr)
+        if 'review_comments' not in data.cached:
+            self._fetch_review_comments(data.review_comments, db_pr)
+        if 'commits' not in data.cached:
+            self._fetch_commits(data.commits, db_pr)
 
         return db_pr
 
-    def _fetch_issue_event(self, event):
-        e = event.as_dict()
-        event_id = e['id']
-
-        db_event = Event().as_unique(self.session,
-                                     event_id=event_id)
-        db_event.event_id = event_id
-        db_event.event = event.event
-        db_event.created_at = self.unmarshal_timestamp(event.created_at)
-        db_event.commit_id = event.commit_id
-        db_event.actor = self._fetch_user(event.actor)
-
-        if event.event in ('labeled', 'unlabeled'):
-            db_event.extra = e['label']['name']
-        return db_event
-
-    def _fetch_user(self, user):
-        if not user:
-            return None
-
-        if user.login not in self.USERS_CACHE:
-            db_user = User().as_unique(self.session, login=user.login)
-            db_user.email = user.email
-            db_user.avatar_url = user.avatar_url
-            db_user.url = user.url
-            db_user.type = user.type
+    def _pull_request_users(self, data):
+        pr = data.pr
+        users = [pr.user, pr.merged_by, pr.assignee]
 
-            self.USERS_CACHE[user.login] = db_user
-        else:
-            db_user = self.USERS_CACHE[user.login]
-
-        return db_user
+        users += [comment.user for comment in data.comments]
+        users += [review.user for review in data.review_comments]
 
-    def _fetch_comment(self, comment, pr_id):
-        created_at = self.unmarshal_timestamp(comment.created_at)
-        updated_at = self.unmarshal_timestamp(comment.updated_at)
-        user = self._fetch_user(comment.user)
+        for commit in data.commits:
+            users += [commit.author, commit.committer]
 
-        if user:
-            user_id = user.id
-        else:
-            user_id = None
-
-        db_comment = Comment().as_unique(self.session, pull_request_id=pr_id,
-                                         user_id=user_id,
-                                         created_at=created_at)
-
-        if db_comment.updated_at != updated_at:
-            db_comment.body = comment.body
-            db_comment.url = comment.url
-            db_comment.updated_at = updated_at
-            db_comment.user = user
-        return db_comment
-
-    def _fetch_review_comment(self, review, pr_id):
-        created_at = self.unmarshal_timestamp(review.created_at)
-        updated_at = self.unmarshal_timestamp(review.updated_at)
-        user = self._fetch_user(review.user)
-
-        if user:
-            user_id = user.id
-        else:
-            user_id = None
+        users += [event.actor for event in data.events]
 
-        db_review = ReviewComment().as_unique(self.session, pull_request_id=pr_id,
-                                              commit_id=review.commit_id,
-                                              user_id=user_id,
-                                              created_at=created_at)
+        return users
 
-        if db_review.updated_at != updated_at:
-            db_review.body = review.body
-            db_review.url = review.url
-            db_review.updated_at = updated_at
-            db_review.user = user
-            db_review.original_commit_id = review.original_commit_id
-        return db_review
+    def _event_row(self, event):
+        e = raw_data(event)
 
-    def _fetch_commit(self, commit, pr_id):
-        db_commit = Commit().as_unique(self.session, pull_request_id=pr_id,
-                                       sha=commit.sha)
+        row = {'event_id' : e['id'],
+               'event' : event.event,
+               'created_at' : self.unmarshal_timestamp(event.created_at),
+               'commit_id' : event.commit_id,
+               'actor_id' : self._user_id(event.actor),
+               'extra' : None,
+               'pull_request_id' : None}
 
-        d = commit.as_dict()
+        if event.event in ('labeled', 'unlabeled'):
+            row['extra'] = e['label']['name']
+        return row
+
+    def _event_id(self, event):
+        return raw_data(event)['id']
+
+    def _authorize(self, request, token):
+        request.headers['Authorization'] = 'token ' + token
+
+    def _fetch_comments(self, comments, db_pr):
+        rows = [self._comment_row(comment) for comment in comments]
+        self._queue_children(Comment, db_pr, rows)
+        return rows
+
+    def _comment_row(self, comment):
+        return {'pull_request_id' : None,
+                'user_id' : self._user_id(comment.user),
+                'created_at' : self.unmarshal_timestamp(comment.created_at),
+                'updated_at' : self.unmarshal_timestamp(comment.updated_at),
+                'body' : comment.body,
+                'url' : comment.url}
+
+    def _fetch_review_comments(self, reviews, db_pr):
+        rows = [self._review_comment_row(review) for review in reviews]
+        self._queue_children(ReviewComment, db_pr, rows)
+        return rows
+
+    def _review_comment_row(self, review):
+        return {'pull_request_id' : None,
+                'commit_id' : review.commit_id,
+                'user_id' : self._user_id(review.user),
+                'created_at' : self.unmarshal_timestamp(review.created_at),
+                'updated_at' : self.unmarshal_timestamp(review.updated_at),
+                'body' : review.body,
+                'url' : review.url,
+                'original_commit_id' : review.original_commit_id}
+
+    def _fetch_commits(self, commits, db_pr):
+        rows = [self._commit_row(commit) for commit in commits]
+        self._queue_children(Commit, db_pr, rows)
+        return rows
+
+    def _commit_row(self, commit):
+        d = raw_data(commit)
 
         author = d['commit']['author']
-        db_commit.author_date = self.unmarshal_timestamp(author['date'])
-        db_commit.author = self._fetch_user(commit.author)
-
-        if db_commit.author:
-            db_commit.author.name = author['name']
-            db_commit.author.email = author['email']
-
         committer = d['commit']['committer']
-        db_commit.commit_date = self.unmarshal_timestamp(committer['date'])
-        db_commit.committer = self._fetch_user(commit.committer)
-
-        if db_commit.committer:
-            db_commit.committer.name = committer['name']
-            db_commit.committer.email = committer['email']
 
-        return db_commit
-
-    def unmarshal_timestamp(self, ts):
-        import datetime
-        import dateutil.parser
-
-        if ts is None:
-            return None
-        elif isinstance(ts, datetime.datetime):
-            return ts.replace(tzinfo=None)
-        else:
-            return dateutil.parser.parse(ts).replace(tzinfo=None)
+        row = {'pull_request_id' : None,
+               'sha' : commit.sha,
+               'author_date' : self.unmarshal_timestamp(author['date']),
+               'author_id' : self._user_id(commit.author),
+               'commit_date' : self.unmarshal_timestamp(committer['date']),
+               'committer_id' : self._user_id(commit.committer)}
+
+        if row['author_id']:
+            self._update_user_identity(commit.author.login,
+                                       author['name'], author['email'])
+        if row['committer_id']:
+            self._update_user_identity(commit.committer.login,
+                                       committer['name'], committer['email'])
+        return row
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import github3
+from github3.issues.comment import IssueComment
+from github3.issues.event import IssueEvent
+from github3.pulls import ReviewComment
+from github3.repos.commit import RepoCommit
+
+from pullpo.backends import BackendError
+from pullpo.backends.core import PullRequestData, UNCHANGED
+from pullpo.backends.github import GitHubBackend
+
+
+PULL_REQUESTS_QUERY = """
+query($owner: String!, $name: String!, $count: Int!, $cursor: String,
+      $comments: Int!, $reviews: Int!, $commits: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $count, after: $cursor,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage }
+      edges {
+        cursor
+        node {
+          databaseId number title body state merged mergeStateStatus
+          createdAt updatedAt closedAt mergedAt
+          additions deletions changedFiles
+          mergeCommit { oid }
+          author { ...actor }
+          mergedBy { ...actor }
+          assignees(first: 1) { nodes { ...actor } }
+          comments(first: $comments) {
+            totalCount
+            pageInfo { hasNextPage }
+            nodes {
+              databaseId body createdAt updatedAt
+              author { ...actor }
+            }
+          }
+          reviews(first: $reviews) {
+            pageInfo { hasNextPage }
+            nodes {
+              comments(first: $comments) {
+                pageInfo { hasNextPage }
+                nodes {
+                  databaseId body createdAt updatedAt
+                  commit { oid }
+                  originalCommit { oid }
+                  author { ...actor }
+                }
+              }
+            }
+          }
+          commits(first: $commits) {
+            pageInfo { hasNextPage }
+            nodes {
+              commit {
+                oid
+                author { name email date user { ...actor } }
+                committer { name email date user { ...actor } }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+
+fragment actor on Actor {
+  __typename login avatarUrl
+}
+"""
+
+
+# Preview media type needed to retrieve mergeStateStatus
+MERGE_INFO_PREVIEW = 'application/vnd.github.merge-info-preview+json'
+
+
+class GraphQLObject(object):
+    """Object built from a GraphQL node.
+
+    It mimics the attributes, the raw payload and the as_dict()
+    method of the github3 objects, so GraphQL data can be stored
+    using the same methods of GitHubBackend.
+    """
+
+    def __init__(self, data, **attrs):
+        self._json_data = data
+        self.__dict__.update(attrs)
+
+    def as_dict(self):
+        return self._json_data
+
+
+class GitHubGraphQLBackend(GitHubBackend):
+    """GitHub backend based on the GraphQL API.
+
+    Pull requests are retrieved in pages of PULL_REQUESTS_PER_PAGE,
+    each one together with its comments, review comments and commits,
+    so a single request replaces several REST requests per pull
+    request. When any of these connections has more items than the
+    ones requested, that collection is retrieved again using the REST
+    API. Issue events are always retrieved using the REST API because
+    GraphQL timeline items don't include the identifiers of the events.
+
+    Pull requests are crawled from the newest to the oldest updated
+    one, so incremental crawls stop as soon as they reach the date of
+    the previous crawl. Interrupted crawls are resumed from the cursor
+    of the last pull request stored.
+    """
+
+    PULL_REQUESTS_PER_PAGE = 50
+    COMMENTS_PER_PULL_REQUEST = 50
+    REVIEWS_PER_PULL_REQUEST = 20
+    COMMITS_PER_PULL_REQUEST = 50
+
+    def __init__(self, user, password, token, session, enterprise_url=None,
+                 **kwargs):
+        super(GitHubGraphQLBackend, self).__init__(user, password, token,
+                                                   session, enterprise_url,
+                                                   **kwargs)
+
+        base_url = self.gh.session.base_url
+
+        if base_url.endswith('/v3'):
+            self.graphql_url = base_url[:-len('/v3')] + '/graphql'
+        else:
+            self.graphql_url = base_url + '/graphql'
+
+    def _fetch(self, owner, repository, since=None, newest=False):
+        db_repo = self._fetch_repository(owner, repository)
+
+        state, since, cursor = self._start_graphql_crawl(db_repo, since)
+
+        self._fingerprints = self._load_fingerprints(db_repo)
+
+        nodes = self._fetch_pull_request_nodes(repository, since, cursor)
+
+        for node, result in self._hydrate_items(nodes):
+            try:
+                data = result()
+
+                if data is UNCHANGED:
+                    self.unchanged_prs += 1
+                    state.cursor = node.cursor
+                    continue
+
+                db_pr = self._store_pull_request(data, db_repo)
+                state.cursor = node.cursor
+                yield db_pr
+            except github3.exceptions.ServerError, e:
+                import sys
+                msg = "Cannot retrieve pull request #%s. Skipping it. Error: %s\n" \
+                    % (node.number, str(e))
+                sys.stderr.write(msg)
+
+        self._complete_crawl(state, db_repo, since, None)
+        state.cursor = None
+
+    def _start_graphql_crawl(self, db_repo, since):
+        """Find where the crawl of a repository has to start.
+
+        Returns the state of the crawl, the date where the crawl
+        stops and the cursor of the last pull request stored by
+        an interrupted crawl.
+        """
+        state = self._fetch_crawl_state(db_repo)
+        cursor = None
+
+        if since:
+            pass
+        elif not state.completed and state.cursor:
+            since = state.since
+            cursor = state.cursor
+        elif state.updated_at:
+            since = state.updated_at
+        elif not state.id:
+            since = self._last_pull_request_date(db_repo)
+
+        if not cursor:
+            state.since = since
+            state.cursor = None
+
+        state.newest = True
+        state.page = 0
+        state.completed = False
+
+        return state, since, cursor
+
+    def _fetch_pull_request_nodes(self, repository, since, cursor):
+        owner, name = repository.full_name.split('/', 1)
+
+        variables = {'owner' : owner,
+                     'name' : name,
+                     'count' : self.PULL_REQUESTS_PER_PAGE,
+                     'cursor' : cursor,
+                     'comments' : self.COMMENTS_PER_PULL_REQUEST,
+                     'reviews' : self.REVIEWS_PER_PULL_REQUEST,
+                     'commits' : self.COMMITS_PER_PULL_REQUEST}
+
+        while True:
+            data = self._query(PULL_REQUESTS_QUERY, variables)
+
+            if not data['repository']:
+                raise BackendError("GitHub - Repository %s does not exist."
+                                   % repository.full_name)
+
+            prs = data['repository']['pullRequests']
+
+            for edge in prs['edges']:
+                node = self._pull_request(repository, edge['node'])
+                node.cursor = edge['cursor']
+
+                if since and self.unmarshal_timestamp(node.updated_at) < since:
+                    return
+
+                yield node
+
+            if not prs['pageInfo']['hasNextPage'] or not prs['edges']:
+                return
+
+            variables['cursor'] = prs['edges'][-1]['cursor']
+
+    def _query(self, query, variables):
+        response = self.gh._post(self.graphql_url,
+                                 data={'query' : query,
+                                       'variables' : variables},
+                                 headers={'Accept' : MERGE_INFO_PREVIEW})
+        result = self.gh._json(response, 200)
+
+        if not result:
+            raise BackendError("GitHub - Empty response from %s"
+                               % self.graphql_url)
+        elif result.get('errors'):
+            msg = '; '.join([e.get('message', '') for e in result['errors']])
+            raise BackendError("GitHub - " + msg)
+
+        return result['data']
+
+    def _is_pull_request(self, node):
+        return True
+
+    def _hydrate_pull_request(self, node):
+        # Events and truncated collections are not requested
+        if self._is_unchanged(node.number, node.updated_at,
+                              node.comments_count):
+            return UNCHANGED
+
+        pr = node.pull_request
+        repository = node.repository
+
+        data = PullRequestData(node, pr)
+        data.merged = node.merged
+        data.comments = node.comments
+        data.review_comments = node.review_comments
+        data.commits = node.commits
+
+        # Truncated connections are retrieved using the REST API
+        if node.truncated:
+            if 'comments' in node.truncated:
+                data.comments = self._rest_collection(data, 'comments',
+                                                      repository, IssueComment,
+                                                      'issues', node.number,
+                                                      'comments')
+            if 'review_comments' in node.truncated:
+                data.review_comments = self._rest_collection(data, 'review_comments',
+                                                             repository, ReviewComment,
+                                                             'pulls', node.number,
+                                                             'comments')
+            if 'commits' in node.truncated:
+                data.commits = self._rest_collection(data, 'commits',
+                                                     repository, RepoCommit,
+                                                     'pulls', node.number,
+                                                     'commits')
+
+        url = repository._build_url('issues', node.number, 'events',
+                                    base_url=repository._api)
+        events = lambda: repository._iter(-1, url, IssueEvent)
+        data.events = self._hydrate_events(data, node.number, events)
+        return data
+
+    def _rest_collection(self, data, name, repository, cls, *path):
+        url = repository._build_url(*path, base_url=repository._api)
+        return self._hydrate_collection(data, name,
+                                        repository._iter(-1, url, cls))
+
+    def _pull_request(self, repository, node):
+        """Build the objects of a pull request node"""
+
+        api = repository._api
+        assignees = node['assignees']['nodes']
+        merge_commit = node['mergeCommit']
+
+        d = {'id' : node['databaseId'],
+             'number' : node['number'],
+             'merge_commit_sha' : merge_commit['oid'] if merge_commit else None,
+             'additions' : node['additions'],
+             'deletions' : node['deletions'],
+             'changed_files' : node['changedFiles']}
+
+        state = 'open' if node['state'] == 'OPEN' else 'closed'
+        mergeable_state = node['mergeStateStatus']
+
+        if mergeable_state:
+            mergeable_state = mergeable_state.lower()
+
+        pr = GraphQLObject(d,
+                           id=node['databaseId'],
+                           number=node['number'],
+                           title=node['title'],
+                           body=node['body'],
+                           state=state,
+                           created_at=node['createdAt'],
+                           updated_at=node['updatedAt'],
+                           closed_at=node['closedAt'],
+                           merged_at=node['mergedAt'],
+                           mergeable_state=mergeable_state,
+                           user=self._user(node['author']),
+                           merged_by=self._user(node['mergedBy']),
+                           assignee=self._user(assignees[0] if assignees else None))
+
+        truncated = set()
+
+        comments = node['comments']
+
+        if comments['pageInfo']['hasNextPage']:
+            truncated.add('comments')
+
+        reviews = node['reviews']
+        review_comments = []
+
+        if reviews['pageInfo']['hasNextPage']:
+            truncated.add('review_comments')
+
+        for review in reviews['nodes']:
+            if review['comments']['pageInfo']['hasNextPage']:
+                truncated.add('review_comments')
+            review_comments += review['comments']['nodes']
+
+        commits = node['commits']
+
+        if commits['pageInfo']['hasNextPage']:
+            truncated.add('commits')
+
+        return GraphQLObject(node,
+                             repository=repository,
+                             pull_request=pr,
+                             number=node['number'],
+                             updated_at=node['updatedAt'],
+                             comments_count=comments.get('totalCount'),
+                             merged=node['merged'],
+                             truncated=truncated,
+                             comments=[self._comment(api, c)
+                                       for c in comments['nodes']],
+                             review_comments=[self._review_comment(api, c)
+                                              for c in review_comments],
+                             commits=[self._commit(c['commit'])
+                                      for c in commits['nodes']])
+
+    def _comment(self, api, node):
+        url = api + '/issues/comments/%s' % node['databaseId']
+
+        return GraphQLObject(node,
+                             body=node['body'],
+                             url=url,
+                             created_at=node['createdAt'],
+                             updated_at=node['updatedAt'],
+                             user=self._user(node['author']))
+
+    def _review_comment(self, api, node):
+        url = api + '/pulls/comments/%s' % node['databaseId']
+        commit = node['commit']
+        original_commit = node['originalCommit']
+
+        return GraphQLObject(node,
+                             body=node['body'],
+                             url=url,
+                             created_at=node['createdAt'],
+                             updated_at=node['updatedAt'],
+                             commit_id=commit['oid'] if commit else None,
+                             original_commit_id=original_commit['oid'] if original_commit else None,
+                             user=self._user(node['author']))
+
+    def _commit(self, node):
+        author = node['author']
+        committer = node['committer']
+
+        d = {'sha' : node['oid'],
+             'commit' : {'author' : {'name' : author['name'],
+                                     'email' : author['email'],
+                                     'date' : author['date']},
+                         'committer' : {'name' : committer['name'],
+                                        'email' : committer['email'],
+                                        'date' : committer['date']}}}
+
+        return GraphQLObject(d,
+                             sha=node['oid'],
+                             author=self._user(author['user']),
+                             committer=self._user(committer['user']))
+
+    def _user(self, node):
+        if not node:
+            return None
+
+        url = self.gh.session.build_url('users', node['login'])
+
+        return GraphQLObject(node,
+                             login=node['login'],
+                             email=None,
+                             avatar_url=node['avatarUrl'],
+                             url=url,
+                             type=node['__typename'])
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import urllib
+
+import requests
+
+from pullpo.backends import BackendError
+from pullpo.backends.core import ForgeBackend, ForgeUser, PullRequestData,\
+    RateLimitScheduler, UNCHANGED
+from pullpo.db.model import Commit, Comment, ReviewComment, PullRequest
+
+
+GITLAB_URL = 'https://gitlab.com'
+
+
+class GitLabRateLimitScheduler(RateLimitScheduler):
+    """Scheduler that reads the rate limit headers of GitLab"""
+
+    HEADER_PREFIX = 'RateLimit-'
+
+
+class GitLabBackend(ForgeBackend):
+    """GitLab backend based on the REST API v4.
+
+    Merge requests are stored as pull requests. They are listed
+    sorted by update date and, for each one, its notes, commits and
+    state events are retrieved. Notes on the diff are stored as review
+    comments and the rest of the notes written by users as comments;
+    notes created by GitLab are left out. Commits are not linked to
+    GitLab users, as the API only gives their names and emails.
+
+    Owners are groups, or users when no group has that name, and
+    repositories their projects. Projects are stored with their full
+    path, like 'group/subgroup/project'.
+    """
+
+    LABEL = 'GitLab'
+
+    SCHEDULER = GitLabRateLimitScheduler
+
+    NOTES_PER_PAGE = 100
+
+    # Notes, commits and state events of the merge request
+    HYDRATION_REQUESTS = 3
+
+    # Statuses of merge requests that can be merged
+    MERGE_STATUSES = {'can_be_merged' : 'clean',
+                      'cannot_be_merged' : 'dirty'}
+
+    def __init__(self, token, session, url=GITLAB_URL, **kwargs):
+        self.url = url.rstrip('/')
+        self.api_url = self.url + '/api/v4'
+
+        tokens = [token] if isinstance(token, basestring) else token
+
+        super(GitLabBackend, self).__init__('gitlab', session,
+                                            requests.Session(), tokens,
+                                            **kwargs)
+
+    def _authorize(self, request, token):
+        request.headers['PRIVATE-TOKEN'] = token
+
+    def _fetch_repositories_list(self, owner, repository=None):
+        if repository:
+            project = self._project(owner + '/' + repository)
+
+            if not project:
+                raise BackendError("GitLab - Repository %s:%s does not exist."
+                                   % (owner, repository))
+            return [project]
+
+        params = {'per_page' : self.ISSUES_PER_PAGE,
+                  'include_subgroups' : 'true'}
+
+        for kind in ('groups', 'users'):
+            url = '%s/%s/%s/projects' % (self.api_url, kind, quote(owner))
+
+            if self._get(url, {'per_page' : 1}) is not None:
+                return list(self._paginate(url, params))
+
+        raise BackendError("GitLab - Owner %s does not exist." % owner)
+
+    def _project(self, path):
+        response = self._get(self._project_url(path))
+        return self._json(response) if response is not None else None
+
+    def _project_url(self, path):
+        return '%s/projects/%s' % (self.api_url, quote(path))
+
+    def _fetch(self, owner, project, since=None, newest=False):
+        db_repo = self._store_repository(owner, project['path_with_namespace'],
+                                         project['name'], project['web_url'])
+
+        state, since, page = self._start_crawl(db_repo, since, newest)
+
+        self._fingerprints = self._load_fingerprints(db_repo)
+
+        params = {'state' : 'all',
+                  'scope' : 'all',
+                  'order_by' : 'updated_at',
+                  'sort' : 'desc' if newest else 'asc',
+                  'per_page' : self.ISSUES_PER_PAGE,
+                  'page' : page}
+
+        if since:
+            params['updated_after'] = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        url = self._project_url(project['path_with_namespace']) + '/merge_requests'
+        mrs = self._paginate(url, params)
+
+        for db_pr in self._crawl(db_repo, state, since, page, mrs):
+            yield db_pr
+
+    def _updated_at(self, mr):
+        return mr['updated_at']
+
+    def _item_number(self, mr):
+        return mr['iid']
+
+    def _hydrate_pull_request(self, mr):
+        # Notes count both comments and review comments
+        if self._is_unchanged(mr['iid'], mr['updated_at'],
+                              mr.get('user_notes_count')):
+            return UNCHANGED
+
+        url = '%s/projects/%s/merge_requests/%s' % (self.api_url,
+                                                    mr['project_id'], mr['iid'])
+        params = {'per_page' : self.NOTES_PER_PAGE}
+
+        data = PullRequestData(mr, mr)
+        data.merged = mr['state'] == 'merged'
+
+        notes = self._hydrate_collection(data, 'notes',
+                                         self._paginate(url + '/notes',
+                                                        dict(params, sort='asc')))
+        notes = [note for note in notes if not note['system']]
+
+        data.comments = [note for note in notes if note.get('type') != 'DiffNote']
+        data.review_comments = [note for note in notes if note.get('type') == 'DiffNote']
+        data.commits = self._hydrate_collection(data, 'commits',
+                                                self._paginate(url + '/commits',
+                                                               params))
+        data.events = self._hydrate_collection(data, 'events',
+                                               self._paginate(url + '/resource_state_events',
+                                                              params))
+
+        # Notes are requested once for both collections
+        if 'notes' in data.cached:
+            data.cached.update(('comments', 'review_comments'))
+        return data
+
+    def _is_unchanged(self, number, updated_at, notes_count):
+        fingerprint = self._fingerprints.get(number)
+
+        if fingerprint is None or notes_count is None:
+            return False
+
+        stored = fingerprint.comments_count + fingerprint.review_comments_count
+
+        return (fingerprint.updated_at, stored) == \
+            (self.unmarshal_timestamp(updated_at), notes_count)
+
+    def _fetch_pull_request(self, data):
+        mr = data.pr
+
+        # Resolve all the users of this merge request at once
+        users = self._pull_request_users(data)
+        self._fetch_users([self._user(user) for user in users])
+
+        for user in users:
+            self._set_user_fields(user['username'], {'name' : user['name']})
+
+        db_pr = PullRequest().as_unique(self.session, github_id=mr['id'],
+                                        forge_id=self.forge_id)
+
+        if not db_pr.id:
+            data.cached.clear()
+
+            db_pr.number = mr['iid']
+            db_pr.created_at = self.unmarshal_timestamp(mr['created_at'])
+
+        updated_at = self.unmarshal_timestamp(mr['updated_at'])
+
+        if db_pr.updated_at != updated_at:
+            db_pr.title = mr['title']
+            db_pr.body = mr['description']
+            db_pr.state = 'open' if mr['state'] == 'opened' else 'closed'
+            db_pr.updated_at = updated_at
+            db_pr.closed_at = self.unmarshal_timestamp(mr.get('closed_at') or
+                                                       mr.get('merged_at'))
+            db_pr.merged_at = self.unmarshal_timestamp(mr.get('merged_at'))
+            db_pr.mergeable_state = self.MERGE_STATUSES.get(mr.get('merge_status'),
+                                                            mr.get('merge_status'))
+
+            if data.merged:
+                db_pr.merge_commit_sha = mr.get('merge_commit_sha') or \
+                    mr.get('squash_commit_sha')
+                db_pr.merged = True
+
+            db_pr.user_id = self._user_id(self._user(mr['author']))
+            db_pr.merged_by_id = self._user_id(self._user(self._merged_by(mr)))
+            db_pr.assignee_id = self._user_id(self._user(mr.get('assignee')))
+
+        if 'comments' not in data.cached:
+            self._fetch_comments(data.comments, db_pr, mr['web_url'])
+        if 'review_comments' not in data.cached:
+            self._fetch_review_comments(data.review_comments, db_pr,
+                                        mr['web_url'])
+        if 'commits' not in data.cached:
+            self._fetch_commits(data.commits, db_pr)
+
+        return db_pr
+
+    def _pull_request_users(self, data):
+        mr = data.pr
+        users = [mr['author'], mr.get('assignee'), self._merged_by(mr)]
+
+        users += [note['author'] for note in data.comments]
+        users += [note['author'] for note in data.review_comments]
+        users += [event.get('user') for event in data.events]
+
+        return [user for user in users if user]
+
+    def _merged_by(self, mr):
+        # merged_by was replaced by merge_user on GitLab 14.7
+        return mr.get('merge_user') or mr.get('merged_by')
+
+    def _user(self, user):
+        if not user:
+            return None
+
+        return ForgeUser(login=user['username'],
+                         email=user.get('public_email') or None,
+                         avatar_url=user.get('avatar_url'),
+                         url=user.get('web_url'),
+                         type='User')
+
+    def _fetch_comments(self, notes, db_pr, web_url):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'user_id' : self._user_id(self._user(note['author'])),
+                 'created_at' : self.unmarshal_timestamp(note['created_at'])}
+                for note in notes]
+
+        db_comments = Comment.as_unique_all(self.session, keys)
+
+        for note, db_comment in zip(notes, db_comments):
+            updated_at = self.unmarshal_timestamp(note['updated_at'])
+
+            if db_comment.updated_at != updated_at:
+                db_comment.body = note['body']
+                db_comment.url = '%s#note_%s' % (web_url, note['id'])
+                db_comment.updated_at = updated_at
+            db_comment.pull_request = db_pr
+        return db_comments
+
+    def _fetch_review_comments(self, notes, db_pr, web_url):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'commit_id' : note['position']['head_sha'],
+                 'user_id' : self._user_id(self._user(note['author'])),
+                 'created_at' : self.unmarshal_timestamp(note['created_at'])}
+                for note in notes]
+
+        db_reviews = ReviewComment.as_unique_all(self.session, keys)
+
+        for note, db_review in zip(notes, db_reviews):
+            updated_at = self.unmarshal_timestamp(note['updated_at'])
+
+            if db_review.updated_at != updated_at:
+                db_review.body = note['body']
+                db_review.url = '%s#note_%s' % (web_url, note['id'])
+                db_review.updated_at = updated_at
+                db_review.original_commit_id = note['position']['base_sha']
+            db_review.pull_request = db_pr
+        return db_reviews
+
+    def _fetch_commits(self, commits, db_pr):
+        keys = [{'pull_request_id' : db_pr.id,
+                 'sha' : commit['id']}
+                for commit in commits]
+
+        db_commits = Commit.as_unique_all(self.session, keys)
+
+        for commit, db_commit in zip(commits, db_commits):
+            db_commit.author_date = self.unmarshal_timestamp(commit['authored_date'])
+            db_commit.commit_date = self.unmarshal_timestamp(commit['committed_date'])
+            db_commit.pull_request = db_pr
+        return db_commits
+
+    def _event_row(self, event):
+        return {'event_id' : event['id'],
+                'event' : event['state'],
+                'created_at' : self.unmarshal_timestamp(event['created_at']),
+                'commit_id' : None,
+                'actor_id' : self._user_id(self._user(event.get('user'))),
+                'extra' : None,
+                'pull_request_id' : None}
+
+    def _event_id(self, event):
+        return event['id']
+
+
+def quote(path):
+    """Encode a path to be used as the id of a GitLab group or project"""
+    return urllib.quote(path, safe='')
@@ -0,0 +1,884 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import datetime
+import gzip
+import httplib
+import json
+import re
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Query parameters that don't identify a request
+CREDENTIALS = ('access_token', 'client_id', 'client_secret')
+
+
+def request_key(method, url, body=None):
+    """Key that identifies a request on an archive.
+
+    Query parameters are sorted, so the same request matches
+    regardless of the order they were sent.
+    """
+    parts = urlparse.urlsplit(url)
+    params = [(k, v) for k, v in urlparse.parse_qsl(parts.query, True)
+              if k not in CREDENTIALS]
+    query = urllib.urlencode(sorted(params))
+    url = urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path,
+                               query, ''))
+
+    if method == 'GET':
+        body = None
+
+    return '%s %s %s' % (method, url, body or '')
+
+
+class ResponseArchive(object):
+    """Archive of the GitHub responses seen during a run.
+
+    Archives are gzip files with one JSON object per response.
+    In 'w' mode, responses are appended as they are added; in
+    'r' mode, they are served again by response(). When the same
+    request was recorded several times, its responses are served
+    in the same order and the last one is repeated afterwards.
+    """
+
+    # Headers needed to rebuild a response
+    HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+
+        self._entries = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+        if mode == 'w':
+            self._file = gzip.open(path, 'wb')
+        else:
+            self._load()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def add(self, request, response):
+        entry = {'key' : request_key(request.method, request.url, request.body),
+                 'status' : response.status_code,
+                 'headers' : dict((h, response.headers[h]) for h in self.HEADERS
+                                  if h in response.headers),
+                 'content' : response.content.decode('utf-8', 'replace')}
+
+        line = json.dumps(entry) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._entries.setdefault(entry['key'], []).append(entry)
+
+    def response(self, request):
+        """Status, headers and content recorded for a request or None"""
+
+        key = request_key(request.method, request.url, request.body)
+
+        with self._lock:
+            entries = self._entries.get(key)
+
+            if not entries:
+                return None
+
+            n = self._served.get(key, 0)
+            self._served[key] = n + 1
+
+        entry = entries[min(n, len(entries) - 1)]
+
+        return entry['status'], entry['headers'], entry['content'].encode('utf-8')
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _load(self):
+        with gzip.open(self.path, 'rb') as f:
+            for line in f:
+                entry = json.loads(line)
+                self._entries.setdefault(entry['key'], []).append(entry)
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+    """HTTP adapter that records the responses of another adapter"""
+
+    def __init__(self, adapter, archive):
+        super(RecordingAdapter, self).__init__()
+        self.adapter = adapter
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+
+        # Rejections of the rate limit are retried; don't keep them
+        if response.status_code != 403 or \
+                response.headers.get('X-RateLimit-Remaining') != '0':
+            self.archive.add(request, response)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """HTTP adapter that serves responses without using the network.
+
+    Responses are taken from 'source', a ResponseArchive or any
+    object with the same response() method, like SyntheticRepository.
+    Each response is delayed 'latency' seconds to simulate the time
+    taken by GitHub. Requests unknown to the source get a 404.
+    """
+
+    def __init__(self, source, latency=0.0):
+        super(ReplayAdapter, self).__init__()
+        self.source = source
+        self.latency = latency
+        self.requests = 0
+        self.missing = 0
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+        result = self.source.response(request)
+        self.requests += 1
+
+        if result is None:
+            self.missing += 1
+            result = (404, {'Content-Type' : 'application/json'},
+                      '{"message": "Not Found"}')
+
+        status, headers, content = result
+
+        response = requests.models.Response()
+        response.status_code = status
+        response.reason = httplib.responses.get(status, '')
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+
+class SyntheticRepository(object):
+    """Source of responses of a generated repository.
+
+    Serves the REST endpoints used by GitHubBackend for a repository
+    with 'pull_requests' pull requests and 'issues' plain issues,
+    interleaved on the listing. Each pull request has the given
+    number of comments, review comments, commits and events, written
+    by 'users' different users. Half of the pull requests are merged.
+
+    The same arguments always generate the same data, so runs
+    against a synthetic repository can be compared.
+    """
+
+    START = datetime.datetime(2015, 1, 1)
+
+    def __init__(self, owner, repository, base_url, pull_requests=100,
+                 issues=0, comments=5, review_comments=5, commits=3,
+                 events=3, users=50):
+        self.owner = owner
+        self.repository = repository
+        self.base_url = base_url.rstrip('/')
+        self.comments = comments
+        self.review_comments = review_comments
+        self.commits = commits
+        self.events = events
+        self.users = max(users, 1)
+
+        self.total = pull_requests + issues
+        self.numbers = range(1, self.total + 1)
+
+        # Plain issues are spread among the pull requests
+        step = float(self.total) / issues if issues else 0
+        self.plain = set(int(i * step) + 1 for i in range(issues))
+
+        self._repo_url = self.base_url + '/repos/%s/%s' % (owner, repository)
+
+    def response(self, request):
+        url = urlparse.urlsplit(request.url)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = url.path
+        base_path = urlparse.urlsplit(self.base_url).path
+
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path):]
+
+        if request.method != 'GET':
+            return None
+
+        m = re.match(r'^/users/([^/]+)$', path)
+        if m:
+            return self._json(self._user(m.group(1)))
+
+        m = re.match(r'^/users/([^/]+)/repos$', path)
+        if m and m.group(1) == self.owner:
+            return self._page(request.url, [self._repo()], params)
+
+        prefix = '/repos/%s/%s' % (self.owner, self.repository)
+
+        if not path.startswith(prefix):
+            return None
+
+        path = path[len(prefix):]
+
+        if path == '':
+            return self._json(self._repo())
+        elif path == '/issues':
+            return self._listing(request.url, self._issues(params), params)
+        elif path == '/pulls':
+            prs = [self._pull_request(n) for n in self.numbers
+                   if n not in self.plain]
+            return self._listing(request.url, prs, params)
+
+        m = re.match(r'^/issues/(\d+)$', path)
+        if m and 1 <= int(m.group(1)) <= self.total:
+            return self._json(self._issue(int(m.group(1))))
+
+        m = re.match(r'^/pulls/(\d+)$', path)
+        if m and self._is_pull_request(int(m.group(1))):
+            return self._json(self._pull_request(int(m.group(1))))
+
+        m = re.match(r'^/(issues|pulls)/(\d+)/(comments|commits|events)$', path)
+        if m and self._is_pull_request(int(m.group(2))):
+            items = self._children(int(m.group(2)), m.group(1), m.group(3))
+            return self._page(request.url, items, params)
+
+        return None
+
+    def payloads(self, name, number):
+        """Payloads of the comments, review_comments, commits or events
+        of a pull request"""
+
+        kinds = {'comments' : ('issues', 'comments'),
+                 'review_comments' : ('pulls', 'comments'),
+                 'commits' : ('pulls', 'commits'),
+                 'events' : ('issues', 'events')}
+
+        return self._children(number, *kinds[name])
+
+    def _is_pull_request(self, number):
+        return 1 <= number <= self.total and number not in self.plain
+
+    def _date(self, hours):
+        date = self.START + datetime.timedelta(hours=hours)
+        return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _json(self, data, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        return 200, headers, json.dumps(data)
+
+    def _listing(self, url, items, params):
+        if params.get('direction', 'desc') == 'desc':
+            items = items[::-1]
+        return self._page(url, items, params)
+
+    def _page(self, url, items, params):
+        per_page = int(params.get('per_page', 30))
+        page = int(params.get('page', 1))
+        chunk = items[(page - 1) * per_page:page * per_page]
+
+        headers = {}
+
+        if page * per_page < len(items):
+            params = dict(params, page=page + 1, per_page=per_page)
+            next_url = url.split('?', 1)[0] + '?' + urllib.urlencode(sorted(params.items()))
+            headers['Link'] = '<%s>; rel="next"' % next_url
+
+        return self._json(chunk, headers)
+
+    def _user(self, login):
+        return {'login' : login,
+                'id' : abs(hash(login)) % 10000000,
+                'type' : 'User',
+                'email' : None,
+                'avatar_url' : 'https://avatars.example.com/' + login,
+                'url' : self.base_url + '/users/' + login}
+
+    def _author(self, number):
+        return self._user('user%d' % (number % self.users))
+
+    def _reviewer(self, number, i):
+        return self._user('user%d' % ((number + i + 1) % self.users))
+
+    def _repo(self):
+        return {'id' : 1,
+                'name' : self.repository,
+                'full_name' : '%s/%s' % (self.owner, self.repository),
+                'owner' : self._user(self.owner),
+                'url' : self._repo_url,
+                'html_url' : 'https://github.com/%s/%s' % (self.owner, self.repository),
+                'size' : len(self.numbers),
+                'open_issues_count' : len(self.numbers)}
+
+    def _issues(self, params):
+        since = params.get('since')
+        issues = []
+
+        for n in self.numbers:
+            issue = self._issue(n)
+
+            if not since or issue['updated_at'] >= since:
+                issues.append(issue)
+        return issues
+
+    def _issue(self, n):
+        issue = {'id' : 1000000 + n,
+                 'number' : n,
+                 'title' : 'Issue %d' % n,
+                 'body' : 'Description of issue %d' % n,
+                 'state' : 'open',
+                 'created_at' : self._date(n),
+                 'updated_at' : self._date(n + 1),
+                 'closed_at' : None,
+                 'user' : self._author(n),
+                 'assignee' : None,
+                 'labels' : [],
+                 'milestone' : None,
+                 'comments' : self.comments,
+                 'url' : self._repo_url + '/issues/%d' % n,
+                 'html_url' : 'https://github.com/%s/%s/issues/%d'
+                              % (self.owner, self.repository, n)}
+
+        if n not in self.plain:
+            issue['pull_request'] = {'url' : self._repo_url + '/pulls/%d' % n}
+        return issue
+
+    def _pull_request(self, n):
+        url = self._repo_url + '/pulls/%d' % n
+        issue_url = self._repo_url + '/issues/%d' % n
+        merged = n % 2 == 0
+        ref = {'ref' : 'master', 'sha' : 'sha', 'label' : 'master',
+               'repo' : None, 'user' : None}
+
+        return {'id' : 2000000 + n,
+                'number' : n,
+                'title' : 'Pull request %d' % n,
+                'body' : 'Description of pull request %d' % n,
+                'state' : 'closed' if merged else 'open',
+                'created_at' : self._date(n),
+                'updated_at' : self._date(n + 1),
+                'closed_at' : self._date(n + 1) if merged else None,
+                'merged_at' : self._date(n + 1) if merged else None,
+                'merged' : merged,
+                'mergeable' : True,
+                'mergeable_state' : 'clean',
+                'merge_commit_sha' : '%040x' % n,
+                'additions' : n % 100,
+                'deletions' : n % 10,
+                'changed_files' : n % 5 + 1,
+                'user' : self._author(n),
+                'merged_by' : self._reviewer(n, 0) if merged else None,
+                'assignee' : None,
+                'milestone' : None,
+                'locked' : False,
+                'head' : ref,
+                'base' : ref,
+                'url' : url,
+                'html_url' : 'https://github.com/%s/%s/pull/%d'
+                             % (self.owner, self.repository, n),
+                'issue_url' : issue_url,
+                'comments_url' : issue_url + '/comments',
+                'review_comments_url' : url + '/comments',
+                'commits_url' : url + '/commits',
+                'statuses_url' : url + '/statuses',
+                'diff_url' : url + '.diff',
+                'patch_url' : url + '.patch',
+                '_links' : {'comments' : {'href' : issue_url + '/comments'},
+                            'review_comments' : {'href' : url + '/comments'},
+                            'commits' : {'href' : url + '/commits'}}}
+
+    def _children(self, n, kind, name):
+        if name == 'comments' and kind == 'issues':
+            return [self._comment(n, i) for i in range(self.comments)]
+        elif name == 'comments':
+            return [self._review_comment(n, i) for i in range(self.review_comments)]
+        elif name == 'commits' and kind == 'pulls':
+            return [self._commit(n, i) for i in range(self.commits)]
+        elif name == 'events' and kind == 'issues':
+            return [self._event(n, i) for i in range(self.events)]
+        return []
+
+    def _comment(self, n, i):
+        comment_id = n * 1000 + i
+
+        return {'id' : comment_id,
+                'body' : 'Comment %d on #%d' % (i, n),
+                'url' : self._repo_url + '/issues/comments/%d' % comment_id,
+                'html_url' : 'https://github.com/comments/%d' % comment_id,
+                'created_at' : self._date(n + 1 + i),
+                'updated_at' : self._date(n + 1 + i),
+                'user' : self._reviewer(n, i)}
+
+    def _review_comment(self, n, i):
+        comment_id = n * 1000 + 500 + i
+        sha = '%038x%02d' % (n, i % self.commits if self.commits else 0)
+
+        return {'id' : comment_id,
+                'body' : 'Review comment %d on #%d' % (i, n),
+                'url' : self._repo_url + '/pulls/comments/%d' % comment_id,
+                'html_url' : 'https://github.com/comments/%d' % comment_id,
+                'pull_request_url' : self._repo_url + '/pulls/%d' % n,
+                'created_at' : self._date(n + 1 + i),
+                'updated_at' : self._date(n + 1 + i),
+                'commit_id' : sha,
+                'original_commit_id' : sha,
+                'path' : 'file%d' % i,
+                'position' : i,
+                'original_position' : i,
+                'diff_hunk' : '',
+                'user' : self._reviewer(n, i),
+                '_links' : {}}
+
+    def _commit(self, n, i):
+        author = self._author(n)
+        person = {'name' : author['login'].title(),
+                  'email' : author['login'] + '@example.com',
+                  'date' : self._date(n)}
+
+        return {'sha' : '%038x%02d' % (n, i),
+                'url' : self._repo_url + '/commits/%038x%02d' % (n, i),
+                'html_url' : '',
+                'comments_url' : '',
+                'author' : author,
+                'committer' : author,
+                'parents' : [],
+                'commit' : {'author' : person,
+                            'committer' : person,
+                            'message' : 'Commit %d of #%d' % (i, n),
+                            'tree' : {'sha' : '', 'url' : ''},
+                            'url' : '',
+                            'comment_count' : 0}}
+
+    def _event(self, n, i):
+        names = ('labeled', 'referenced', 'closed', 'reopened')
+
+        return {'id' : n * 1000 + i,
+                'event' : names[i % len(names)],
+                'created_at' : self._date(n + 1 + i),
+                'commit_id' : None,
+                'actor' : self._reviewer(n, i),
+                'label' : {'name' : 'bug', 'color' : 'f00'},
+                'url' : self._repo_url + '/issues/events/%d' % (n * 1000 + i)}
+
+
+class SyntheticGitLabProject(SyntheticRepository):
+    """Source of responses of a generated GitLab project.
+
+    Serves the endpoints used by GitLabBackend with the pull requests
+    of SyntheticRepository as merge requests. Comments and review
+    comments are notes, together with one note written by GitLab per
+    merge request, and events are state events. Plain issues are not
+    served. 'base_url' is the URL of the API, ending in '/api/v4'.
+    """
+
+    def response(self, request):
+        url = urlparse.urlsplit(request.url)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = self._path(url)
+
+        if request.method != 'GET':
+            return None
+
+        full_name = urllib.quote('%s/%s' % (self.owner, self.repository), safe='')
+
+        if path in ('/groups/%s/projects' % self.owner,
+                    '/users/%s/projects' % self.owner):
+            return self._page(request.url, [self._repo()], params)
+        elif path == '/projects/' + full_name:
+            return self._json(self._repo())
+
+        prefix = '/projects/1/merge_requests'
+
+        if path == '/projects/%s/merge_requests' % full_name:
+            mrs = [self._merge_request(n) for n in self.numbers
+                   if n not in self.plain]
+            since = params.get('updated_after')
+
+            if since:
+                mrs = [mr for mr in mrs if mr['updated_at'] >= since[:19]]
+            if params.get('sort', 'desc') == 'desc':
+                mrs = mrs[::-1]
+            return self._page(request.url, mrs, params)
+
+        m = re.match(r'^%s/(\d+)/(notes|commits|resource_state_events)$' % prefix, path)
+        if m and self._is_pull_request(int(m.group(1))):
+            n = int(m.group(1))
+            items = {'notes' : self._notes,
+                     'commits' : self._mr_commits,
+                     'resource_state_events' : self._state_events}[m.group(2)](n)
+            return self._page(request.url, items, params)
+
+        return None
+
+    def _path(self, url):
+        base_path = urlparse.urlsplit(self.base_url).path
+
+        # Project paths are sent encoded
+        path = url.path
+
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path):]
+        return path
+
+    def _date(self, hours):
+        date = self.START + datetime.timedelta(hours=hours)
+        return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def _user(self, login):
+        return {'id' : abs(hash(login)) % 10000000,
+                'username' : login,
+                'name' : login.title(),
+                'state' : 'active',
+                'avatar_url' : 'https://avatars.example.com/' + login,
+                'web_url' : 'https://gitlab.example.com/' + login}
+
+    def _repo(self):
+        return {'id' : 1,
+                'name' : self.repository,
+                'path' : self.repository,
+                'path_with_namespace' : '%s/%s' % (self.owner, self.repository),
+                'web_url' : 'https://gitlab.example.com/%s/%s'
+                            % (self.owner, self.repository)}
+
+    def _merge_request(self, n):
+        merged = n % 2 == 0
+
+        return {'id' : 2000000 + n,
+                'iid' : n,
+                'project_id' : 1,
+                'title' : 'Merge request %d' % n,
+                'description' : 'Description of merge request %d' % n,
+                'state' : 'merged' if merged else 'opened',
+                'created_at' : self._date(n),
+                'updated_at' : self._date(n + 1),
+                'closed_at' : None,
+                'merged_at' : self._date(n + 1) if merged else None,
+                'merge_status' : 'can_be_merged',
+                'merge_commit_sha' : '%040x' % n if merged else None,
+                'author' : self._author(n),
+                'assignee' : None,
+                'merge_user' : self._reviewer(n, 0) if merged else None,
+                'user_notes_count' : self.comments + self.review_comments,
+                'web_url' : 'https://gitlab.example.com/%s/%s/-/merge_requests/%d'
+                            % (self.owner, self.repository, n)}
+
+    def _notes(self, n):
+        notes = [{'id' : n * 1000 + 999,
+                  'type' : None,
+                  'system' : True,
+                  'body' : 'added 1 commit',
+                  'author' : self._author(n),
+                  'created_at' : self._date(n),
+                  'updated_at' : self._date(n)}]
+
+        for i in range(self.comments):
+            notes.append({'id' : n * 1000 + i,
+                          'type' : None,
+                          'system' : False,
+                          'body' : 'Comment %d on !%d' % (i, n),
+                          'author' : self._reviewer(n, i),
+                          'created_at' : self._date(n + 1 + i),
+                          'updated_at' : self._date(n + 1 + i)})
+
+        for i in range(self.review_comments):
+            sha = '%038x%02d' % (n, i % self.commits if self.commits else 0)
+            notes.append({'id' : n * 1000 + 500 + i,
+                          'type' : 'DiffNote',
+                          'system' : False,
+                          'body' : 'Review comment %d on !%d' % (i, n),
+                          'author' : self._reviewer(n, i),
+                          'created_at' : self._date(n + 1 + i),
+                          'updated_at' : self._date(n + 1 + i),
+                          'position' : {'base_sha' : sha, 'start_sha' : sha,
+                                        'head_sha' : sha, 'new_path' : 'file%d' % i,
+                                        'new_line' : i}})
+        return notes
+
+    def _mr_commits(self, n):
+        author = self._author(n)
+
+        return [{'id' : '%038x%02d' % (n, i),
+                 'short_id' : ('%038x%02d' % (n, i))[:8],
+                 'title' : 'Commit %d of !%d' % (i, n),
+                 'message' : 'Commit %d of !%d' % (i, n),
+                 'author_name' : author['name'],
+                 'author_email' : author['username'] + '@example.com',
+                 'authored_date' : self._date(n),
+                 'committer_name' : author['name'],
+                 'committer_email' : author['username'] + '@example.com',
+                 'committed_date' : self._date(n)}
+                for i in range(self.commits)]
+
+    def _state_events(self, n):
+        names = ('closed', 'reopened', 'merged')
+
+        return [{'id' : n * 1000 + i,
+                 'user' : self._reviewer(n, i),
+                 'created_at' : self._date(n + 1 + i),
+                 'resource_type' : 'MergeRequest',
+                 'resource_id' : 2000000 + n,
+                 'state' : names[i % len(names)]}
+                for i in range(self.events)]
+
+
+class SyntheticGerritProject(SyntheticRepository):
+    """Source of responses of a generated Gerrit project.
+
+    Serves the endpoints used by GerritBackend with the pull requests
+    of SyntheticRepository as changes. Comments are messages, review
+    comments are comments on files and commits are patch sets. Gerrit
+    has no events, so they are not served. 'base_url' is the URL of
+    the server; requests to its '/a/' endpoints are served too.
+    """
+
+    def response(self, request):
+        url = urlparse.urlsplit(request.url)
+        params = urlparse.parse_qs(url.query)
+        path = url.path
+        base_path = urlparse.urlsplit(self.base_url).path.rstrip('/')
+
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path):]
+        if path.startswith('/a/'):
+            path = path[len('/a'):]
+
+        if request.method != 'GET':
+            return None
+
+        project = '%s/%s' % (self.owner, self.repository)
+
+        if path == '/projects/':
+            if project.startswith(params.get('p', [''])[0]):
+                return self._gerrit_json({project : self._project()})
+            return self._gerrit_json({})
+        elif path == '/projects/' + urllib.quote(project, safe=''):
+            return self._gerrit_json(self._project())
+        elif path == '/changes/':
+            return self._changes(params)
+
+        m = re.match(r'^/changes/(\d+)/comments$', path)
+        if m and self._is_pull_request(int(m.group(1))):
+            return self._gerrit_json(self._file_comments(int(m.group(1))))
+
+        return None
+
+    def _gerrit_json(self, data):
+        headers = {'Content-Type' : 'application/json; charset=utf-8'}
+        return 200, headers, ")]}'\n" + json.dumps(data)
+
+    def _changes(self, params):
+        query = params.get('q', [''])[0]
+        limit = int(params.get('n', [25])[0])
+        start = int(params.get('S', [0])[0])
+
+        m = re.search(r'project:(\S+)', query)
+
+        if not m or m.group(1) != '%s/%s' % (self.owner, self.repository):
+            return self._gerrit_json([])
+
+        changes = [self._change(n) for n in self.numbers if n not in self.plain]
+
+        m = re.search(r'after:"([^"]+)"', query)
+
+        if m:
+            changes = [c for c in changes if c['updated'][:19] >= m.group(1)]
+
+        # Newest updated changes go first
+        changes = changes[::-1]
+        page = changes[start:start + limit]
+
+        if page and start + limit < len(changes):
+            page[-1]['_more_changes'] = True
+
+        return self._gerrit_json(page)
+
+    def _date(self, hours):
+        date = self.START + datetime.timedelta(hours=hours)
+        return date.strftime('%Y-%m-%d %H:%M:%S.000000000')
+
+    def _user(self, login):
+        return {'_account_id' : abs(hash(login)) % 10000000,
+                'name' : login.title(),
+                'email' : login + '@example.com',
+                'username' : login}
+
+    def _project(self):
+        return {'id' : urllib.quote('%s/%s' % (self.owner, self.repository), safe=''),
+                'name' : '%s/%s' % (self.owner, self.repository),
+                'state' : 'ACTIVE'}
+
+    def _change(self, n):
+        merged = n % 2 == 0
+        author = self._author(n)
+        person = {'name' : author['name'],
+                  'email' : author['email'],
+                  'date' : self._date(n)}
+
+        revisions = {}
+
+        for i in range(max(self.commits, 1)):
+            revisions['%038x%02d' % (n, i)] = {
+                '_number' : i + 1,
+                'uploader' : author,
+                'created' : self._date(n),
+                'commit' : {'author' : person,
+                            'committer' : person,
+                            'subject' : 'Change %d' % n,
+                            'message' : 'Change %d\n\nPatch set %d' % (n, i + 1)}}
+
+        change = {'id' : '%s~%s~master~I%039x' % (self.owner, self.repository, n),
+                  '_number' : n,
+                  'project' : '%s/%s' % (self.owner, self.repository),
+                  'branch' : 'master',
+                  'subject' : 'Change %d' % n,
+                  'status' : 'MERGED' if merged else 'NEW',
+                  'created' : self._date(n),
+                  'updated' : self._date(n + 1),
+                  'insertions' : n % 100,
+                  'deletions' : n % 10,
+                  'owner' : author,
+                  'current_revision' : '%038x%02d' % (n, max(self.commits, 1) - 1),
+                  'revisions' : revisions,
+                  'messages' : [{'id' : '%d-%d' % (n, i),
+                                 'author' : self._reviewer(n, i),
+                                 'date' : self._date(n + 1 + i),
+                                 'message' : 'Patch Set 1:\n\nComment %d on %d' % (i, n),
+                                 '_revision_number' : 1}
+                                for i in range(self.comments)]}
+
+        if merged:
+            change['submitted'] = self._date(n + 1)
+            change['submitter'] = self._reviewer(n, 0)
+        return change
+
+    def _file_comments(self, n):
+        files = {}
+
+        for i in range(self.review_comments):
+            files.setdefault('file%d' % (i % 3), []).append(
+                {'id' : '%d-%d' % (n, 500 + i),
+                 'author' : self._reviewer(n, i),
+                 'patch_set' : i % max(self.commits, 1) + 1,
+                 'line' : i,
+                 'updated' : self._date(n + 1 + i),
+                 'message' : 'Review comment %d on %d' % (i, n)})
+        return files
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP server that serves the responses of a source.
+
+    Sources are the ones of ReplayAdapter, like SyntheticRepository,
+    so backends can be measured against a server, connections and
+    serialization included. Requests keep their headers, so sources
+    can tell the tokens apart. Each response is delayed 'latency'
+    seconds. Requests unknown to the source get a 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, source=None, address=('127.0.0.1', 0), latency=0.0):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.source = source
+        self.latency = latency
+        self.requests = 0
+        self.missing = 0
+        self.url = 'http://%s:%s' % self.server_address
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def response(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+
+        result = self.source.response(request)
+
+        with self._lock:
+            self.requests += 1
+
+            if result is None:
+                self.missing += 1
+
+        if result is None:
+            result = (404, {'Content-Type' : 'application/json'},
+                      '{"message": "Not Found"}')
+        return result
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serve the requests of a MockServer"""
+
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and content are written apart; with Nagle's algorithm,
+    # the content waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        request = requests.Request('GET', self.server.url + self.path,
+                                   headers=dict(self.headers.items())).prepare()
+        status, headers, content = self.server.response(request)
+
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
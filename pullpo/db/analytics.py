@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import datetime
+
+from sqlalchemy import or_, tuple_
+from sqlalchemy.sql import func, select
+
+from pullpo.db.bulk import bulk_insert, bulk_upsert
+from pullpo.db.model import Repository, PullRequest, Comment, ReviewComment,\
+    Commit, User, PullRequestMetrics, PullRequestReviewer, RepositoryWeek
+
+
+def week_of(date):
+    """Monday of the week of a date"""
+
+    if not date:
+        return None
+
+    date = date.date() if isinstance(date, datetime.datetime) else date
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def seconds(start, end):
+    if not start or not end:
+        return None
+
+    delta = end - start
+    return delta.days * 86400 + delta.seconds
+
+
+class Analytics(object):
+    """Review metrics of the stored pull requests.
+
+    Metrics are kept on three tables: one row per pull request,
+    one per pull request and reviewer, and one per repository and
+    week. refresh() only computes again the pull requests stored or
+    updated since the previous refresh, and then the weeks of those
+    pull requests, so it can be run after each crawl. Queries read
+    the precomputed rows and don't touch the crawled tables.
+
+    A reviewer is anyone but the author who commented on the pull
+    request. The first review is the first of these comments. Each
+    commit that received review comments counts as a review round.
+
+    Weeks start on Monday. Pull requests count as opened, merged or
+    closed without merging on the week of each date. Merge times are
+    added to the week of the merge; first review times, review rounds
+    and review comments to the week the pull request was opened.
+    """
+
+    def __init__(self, session, chunk_size=500):
+        self.session = session
+        self.chunk_size = chunk_size
+
+    def refresh(self, owner=None, repository=None, forge=None):
+        """Update the metrics of the pull requests changed since the last
+        refresh. Returns the number of pull requests refreshed.
+
+        The same owners and repositories can be stored for several
+        forges; 'forge', its id or its URL, limits the refresh to one.
+        A repository is only found together with its owner.
+        """
+
+        if repository and not owner:
+            raise ValueError("The owner of repository %s is needed" % repository)
+
+        query = self.session.query(PullRequest.id).\
+            outerjoin(PullRequestMetrics,
+                      PullRequestMetrics.pull_request_id == PullRequest.id).\
+            filter(or_(PullRequestMetrics.id == None,
+                       PullRequestMetrics.pr_updated_at != PullRequest.updated_at))
+
+        if repository:
+            query = query.filter(PullRequest.repo_id ==
+                                 self._repo_id(owner, repository, forge))
+        elif owner or forge:
+            query = query.join(Repository, PullRequest.repo_id == Repository.id).\
+                filter(*Repository.filters(owner, forge=forge))
+
+        ids = [row[0] for row in query]
+        weeks = set()
+
+        try:
+            for i in range(0, len(ids), self.chunk_size):
+                weeks |= self._refresh_pull_requests(ids[i:i + self.chunk_size])
+
+            self._refresh_weeks(weeks)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        return len(ids)
+
+    def pull_request(self, owner, repository, number, forge=None):
+        """Metrics of a pull request or None when it was not found"""
+
+        return self.session.query(PullRequestMetrics).\
+            join(PullRequest, PullRequestMetrics.pull_request_id == PullRequest.id).\
+            filter(PullRequest.repo_id == self._repo_id(owner, repository, forge),
+                   PullRequest.number == number).first()
+
+    def weeks(self, owner, repository, since=None, until=None, forge=None):
+        """Metrics of a repository per week, from the oldest week"""
+
+        query = self.session.query(RepositoryWeek).\
+            filter(RepositoryWeek.repo_id == self._repo_id(owner, repository, forge))
+        query = self._between(query, RepositoryWeek.week, since, until)
+
+        return [self._week(row) for row in query.order_by(RepositoryWeek.week)]
+
+    def summary(self, owner, repository, since=None, until=None, forge=None):
+        """Metrics of a repository for the weeks between two dates"""
+
+        c = RepositoryWeek
+        query = self.session.query(func.sum(c.opened), func.sum(c.merged),
+                                   func.sum(c.closed), func.sum(c.time_to_merge),
+                                   func.sum(c.time_to_first_review),
+                                   func.sum(c.reviewed), func.sum(c.review_rounds),
+                                   func.sum(c.review_comments)).\
+            filter(c.repo_id == self._repo_id(owner, repository, forge))
+        query = self._between(query, c.week, since, until)
+
+        row = [int(value or 0) for value in query.one()]
+
+        return self._metrics(None, *row)
+
+    def reviewer_load(self, owner, repository, since=None, until=None,
+                      limit=None, forge=None):
+        """Pull requests reviewed and comments written by each reviewer,
+        from the busiest one, as (login, pull requests, comments) tuples"""
+
+        c = PullRequestReviewer
+        prs = func.count(c.id)
+        query = self.session.query(User.login, prs, func.sum(c.comments)).\
+            join(User, c.user_id == User.id).\
+            filter(c.repo_id == self._repo_id(owner, repository, forge)).\
+            group_by(User.login).\
+            order_by(prs.desc(), User.login)
+        query = self._between(query, c.week, since, until)
+
+        if limit:
+            query = query.limit(limit)
+
+        return [(login, int(n), int(comments or 0)) for login, n, comments in query]
+
+    def _repo_id(self, owner, repository, forge=None):
+        return Repository.find_id(self.session, owner, repository, forge)
+
+    def _between(self, query, column, since, until):
+        if since:
+            query = query.filter(column >= week_of(since))
+        if until:
+            query = query.filter(column <= week_of(until))
+        return query
+
+    def _week(self, row):
+        return self._metrics(row.week, row.opened, row.merged, row.closed,
+                             row.time_to_merge, row.time_to_first_review,
+                             row.reviewed, row.review_rounds,
+                             row.review_comments)
+
+    def _metrics(self, week, opened, merged, closed, time_to_merge,
+                 time_to_first_review, reviewed, review_rounds,
+                 review_comments):
+        def avg(total, n):
+            return float(total) / n if n else None
+
+        return {'week' : week,
+                'opened' : opened,
+                'merged' : merged,
+                'closed' : closed,
+                'reviewed' : reviewed,
+                'review_comments' : review_comments,
+                'time_to_merge' : avg(time_to_merge, merged),
+                'time_to_first_review' : avg(time_to_first_review, reviewed),
+                'review_rounds' : avg(review_rounds, opened)}
+
+    def _refresh_pull_requests(self, ids):
+        """Compute the metrics of a chunk of pull requests.
+
+        Returns the (repository, week) pairs affected, both by the
+        old metrics and by the new ones.
+        """
+        conn = self.session.connection()
+        metrics = PullRequestMetrics.__table__
+        reviewers = PullRequestReviewer.__table__
+
+        weeks = set()
+
+        old = select([metrics.c.repo_id, metrics.c.created_week,
+                      metrics.c.merged_week, metrics.c.closed_week]).\
+            where(metrics.c.pull_request_id.in_(ids))
+
+        for row in conn.execute(old):
+            weeks.update((row[0], week) for week in row[1:] if week)
+
+        prs = conn.execute(select([PullRequest.id, PullRequest.repo_id,
+                                   PullRequest.user_id, PullRequest.created_at,
+                                   PullRequest.updated_at, PullRequest.merged_at,
+                                   PullRequest.closed_at, PullRequest.merged]).\
+                           where(PullRequest.id.in_(ids))).fetchall()
+
+        # Comments and review comments, by pull request
+        activity = dict((pr.id, []) for pr in prs)
+
+        for row in conn.execute(select([Comment.pull_request_id, Comment.user_id,
+                                        Comment.created_at]).\
+                                where(Comment.pull_request_id.in_(ids))):
+            activity[row[0]].append((row[1], row[2], False, None))
+
+        for row in conn.execute(select([ReviewComment.pull_request_id,
+                                        ReviewComment.user_id,
+                                        ReviewComment.created_at,
+                                        ReviewComment.original_commit_id]).\
+                                where(ReviewComment.pull_request_id.in_(ids))):
+            activity[row[0]].append((row[1], row[2], True, row[3]))
+
+        commits = dict(conn.execute(select([Commit.pull_request_id,
+                                            func.count(Commit.id)]).\
+                                    where(Commit.pull_request_id.in_(ids)).\
+                                    group_by(Commit.pull_request_id)).fetchall())
+
+        metric_rows = []
+        reviewer_rows = []
+
+        for pr in prs:
+            row, pr_reviewers = self._pull_request_metrics(pr, activity[pr.id])
+            row['commits'] = commits.get(pr.id, 0)
+
+            metric_rows.append(row)
+            reviewer_rows += pr_reviewers
+
+            weeks.update((pr.repo_id, row[name]) for name in
+                         ('created_week', 'merged_week', 'closed_week')
+                         if row[name])
+
+        conn.execute(reviewers.delete().where(reviewers.c.pull_request_id.in_(ids)))
+
+        bulk_upsert(conn, metrics, metric_rows, ['pull_request_id'])
+        bulk_insert(conn, reviewers, reviewer_rows)
+
+        return weeks
+
+    def _pull_request_metrics(self, pr, activity):
+        first_review = None
+        rounds = set()
+        comments = 0
+        review_comments = 0
+        reviewers = {}
+
+        for user_id, created_at, review, commit_id in activity:
+            if review:
+                review_comments += 1
+            else:
+                comments += 1
+
+            if user_id == pr.user_id or not created_at:
+                continue
+
+            if commit_id:
+                rounds.add(commit_id)
+
+            if not first_review or created_at < first_review:
+                first_review = created_at
+
+            first, n = reviewers.get(user_id, (created_at, 0))
+            reviewers[user_id] = (min(first, created_at), n + 1)
+
+        merged_at = pr.merged_at if pr.merged or pr.merged_at else None
+        closed_at = pr.closed_at if not merged_at else None
+
+        row = {'pull_request_id' : pr.id,
+               'repo_id' : pr.repo_id,
+               'user_id' : pr.user_id,
+               'pr_updated_at' : pr.updated_at,
+               'created_at' : pr.created_at,
+               'merged_at' : merged_at,
+               'closed_at' : closed_at,
+               'created_week' : week_of(pr.created_at),
+               'merged_week' : week_of(merged_at),
+               'closed_week' : week_of(closed_at),
+               'time_to_merge' : seconds(pr.created_at, merged_at),
+               'time_to_first_review' : seconds(pr.created_at, first_review),
+               'review_rounds' : len(rounds),
+               'reviewers' : len(reviewers),
+               'comments' : comments,
+               'review_comments' : review_comments}
+
+        reviewer_rows = [{'pull_request_id' : pr.id,
+                          'repo_id' : pr.repo_id,
+                          'user_id' : user_id,
+                          'week' : week_of(first),
+                          'comments' : n}
+                         for user_id, (first, n) in reviewers.items()]
+
+        return row, reviewer_rows
+
+    def _refresh_weeks(self, weeks):
+        """Aggregate again the metrics of some (repository, week) pairs"""
+
+        if not weeks:
+            return
+
+        conn = self.session.connection()
+        table = RepositoryWeek.__table__
+
+        keys = list(weeks)
+        totals = dict((key, {'repo_id' : key[0], 'week' : key[1],
+                             'opened' : 0, 'merged' : 0, 'closed' : 0,
+                             'time_to_merge' : 0, 'time_to_first_review' : 0,
+                             'reviewed' : 0, 'review_rounds' : 0,
+                             'review_comments' : 0})
+                      for key in keys)
+
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+
+            for week, rows in self._week_rows(conn, chunk):
+                for row in rows:
+                    key = (row.repo_id, getattr(row, week))
+
+                    if key not in totals:
+                        continue
+
+                    t = totals[key]
+
+                    if week == 'created_week':
+                        t['opened'] += 1
+                        t['review_rounds'] += row.review_rounds or 0
+                        t['review_comments'] += row.review_comments or 0
+
+                        if row.time_to_first_review is not None:
+                            t['reviewed'] += 1
+                            t['time_to_first_review'] += row.time_to_first_review
+                    elif week == 'merged_week':
+                        t['merged'] += 1
+                        t['time_to_merge'] += row.time_to_merge or 0
+                    else:
+                        t['closed'] += 1
+
+            conn.execute(table.delete().\
+                         where(tuple_(table.c.repo_id, table.c.week).in_(chunk)))
+
+        rows = [t for t in totals.values()
+                if t['opened'] or t['merged'] or t['closed']]
+
+        bulk_insert(conn, table, rows)
+
+    def _week_rows(self, conn, keys):
+        m = PullRequestMetrics.__table__
+
+        for week in ('created_week', 'merged_week', 'closed_week'):
+            column = m.c[week]
+            query = select([m.c.repo_id, column, m.c.review_rounds,
+                            m.c.review_comments, m.c.time_to_merge,
+                            m.c.time_to_first_review]).\
+                where(tuple_(m.c.repo_id, column).in_(keys))
+
+            yield week, conn.execute(query)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import datetime
+from cStringIO import StringIO
+
+from sqlalchemy.sql import and_
+
+
+def bulk_insert(conn, table, rows):
+    """Insert a list of rows using the fastest method of the dialect.
+
+    PostgreSQL connections using psycopg2 load the rows with COPY;
+    other dialects send them with a single executemany. Every row
+    must have the same keys; columns not given take their server
+    default, not the one defined on the model.
+    """
+    if not rows:
+        return
+
+    if conn.dialect.name == 'postgresql' and conn.dialect.driver == 'psycopg2':
+        _copy(conn, table, rows)
+    else:
+        conn.execute(table.insert(), rows)
+
+
+def bulk_upsert(conn, table, rows, keys):
+    """Insert a list of rows, updating the ones whose keys already exist.
+
+    'keys' are the columns of a unique index of the table. MySQL,
+    PostgreSQL and SQLite do it in one statement; other dialects, or
+    versions of SQLAlchemy without it, fall back to an update and, if
+    nothing matched, an insert per row. As NULL values never collide
+    on a unique index, rows with a NULL key are matched that way too.
+    """
+    if not rows:
+        return
+
+    name = conn.dialect.name
+    columns = [c for c in rows[0] if c not in keys]
+    insert = _dialect_insert(name)
+
+    if not insert:
+        _upsert_rows(conn, table, rows, keys)
+        return
+
+    nulls = [row for row in rows if None in [row[k] for k in keys]]
+
+    if nulls:
+        _upsert_rows(conn, table, nulls, keys)
+        rows = [row for row in rows if None not in [row[k] for k in keys]]
+
+        if not rows:
+            return
+
+    stmt = insert(table)
+
+    if name == 'mysql':
+        stmt = stmt.on_duplicate_key_update(
+            dict((c, stmt.inserted[c]) for c in columns))
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_=dict((c, stmt.excluded[c]) for c in columns))
+
+    conn.execute(stmt, rows)
+
+
+def _upsert_rows(conn, table, rows, keys):
+    for row in rows:
+        where = and_(*[table.c[k] == row[k] for k in keys])
+        result = conn.execute(table.update().where(where).values(row))
+
+        if not result.rowcount:
+            conn.execute(table.insert(), row)
+
+
+def _dialect_insert(name):
+    """Insert construct of a dialect with upsert support, if any"""
+
+    try:
+        if name == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+        elif name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif name == 'sqlite':
+            # Available since SQLAlchemy 1.4
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return None
+    except ImportError:
+        return None
+    return insert
+
+
+def _copy(conn, table, rows):
+    columns = list(rows[0])
+    data = StringIO()
+
+    for row in rows:
+        data.write('\t'.join([_copy_value(row[c]) for c in columns]))
+        data.write('\n')
+    data.seek(0)
+
+    cursor = conn.connection.cursor()
+
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN'
+                           % (table.name, ', '.join(columns)), data)
+    finally:
+        cursor.close()
+
+
+def _copy_value(value):
+    """Format a value for the text format of COPY"""
+
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+
+    return value.replace('\\', '\\\\').replace('\t', '\\t').\
+        replace('\n', '\\n').replace('\r', '\\r')
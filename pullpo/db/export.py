@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import csv
+import datetime
+import json
+import os
+import time
+import warnings
+from collections import OrderedDict
+
+from sqlalchemy import Boolean, Date, DateTime, Integer
+from sqlalchemy.sql import and_, or_, select
+
+from pullpo.db.model import Base, PullRequest
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Tables exported incrementally and the column that sets
+# the month partition of their rows
+TABLES = OrderedDict([('pull_requests', 'created_at'),
+                      ('comments', 'created_at'),
+                      ('review_comments', 'created_at'),
+                      ('commits', 'commit_date'),
+                      ('events', 'created_at')])
+
+# Small tables rewritten whole on every export
+LOOKUPS = ('forges', 'repositories', 'people')
+
+# Tables without an updated_at column whose rows are rewritten
+# when their pull request is fetched again
+UPDATED_WITH_PULL_REQUEST = ('commits',)
+
+# Formats, also used as file extensions
+FORMATS = ('parquet', 'arrow', 'csv')
+
+STATE_FILE = '_export.json'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Exporter(object):
+    """Export the dataset to files for offline analysis.
+
+    Rows of each table in TABLES are streamed with a server-side
+    cursor, 'chunk_size' at a time, and written to Parquet, Arrow IPC
+    or CSV files partitioned by repository and month of creation:
+
+        <path>/comments/repo_id=3/month=2015-04/part-00002-0.parquet
+
+    The tables in LOOKUPS are written whole to <path>/<table>.<format>.
+
+    The first export writes every row. Later ones only write the rows
+    added since the previous export or, for tables with an updated_at
+    column, updated in GitHub after the newest one exported for their
+    repository. Commits have no such column; they are written again
+    when their pull request was updated after the ones exported by the
+    previous export. Updated rows are written again on new files, so
+    keep the row of the highest part number for each id.
+
+    Parquet and Arrow need pyarrow. Without a format, the one of the
+    previous exports to 'path' is used; new directories get Parquet
+    files or, when pyarrow is not installed, CSV files and a warning.
+    """
+
+    def __init__(self, engine, path, format=None, chunk_size=50000,
+                 max_open_files=64):
+        if format is None:
+            format = self._default_format(path)
+        if format not in FORMATS:
+            raise ValueError("Unknown export format %s" % format)
+        if format != 'csv' and pyarrow is None:
+            raise ValueError("pyarrow is required to export %s files" % format)
+
+        self.engine = engine
+        self.path = path
+        self.format = format
+        self.chunk_size = chunk_size
+        self.max_open_files = max_open_files
+
+    def export(self):
+        """Export the tables and return rows, files, bytes and
+        elapsed seconds of each one"""
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        state = self._load_state()
+        export_id = state['exports'] + 1
+        report = OrderedDict()
+
+        for name in LOOKUPS:
+            report[name] = self._export_lookup(name)
+
+        for name in TABLES:
+            report[name], state['tables'][name] = \
+                self._export_table(name, state['tables'].get(name), export_id)
+
+        # Pull requests exported from now on have been updated
+        # after the rows of these tables written by this export
+        for name in UPDATED_WITH_PULL_REQUEST:
+            state['tables'][name]['updated_at'] = \
+                dict(state['tables']['pull_requests']['updated_at'])
+
+        # Written last, so a failed export is repeated entirely
+        state['exports'] = export_id
+        self._save_state(state)
+
+        return report
+
+    def _export_lookup(self, name):
+        table = Base.metadata.tables[name]
+        path = os.path.join(self.path, '%s.%s' % (name, self.format))
+        started = time.time()
+
+        # Replace the previous file only once the new one is complete
+        f = _open_file(self.format, path + '.tmp', table.columns)
+        n = 0
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).\
+                execute(select([table]))
+
+            for rows in _chunks(result, self.chunk_size):
+                f.write(rows)
+                n += len(rows)
+
+        f.close()
+        os.rename(path + '.tmp', path)
+
+        return {'rows' : n, 'files' : 1, 'bytes' : f.size,
+                'elapsed' : time.time() - started}
+
+    def _export_table(self, name, previous, export_id):
+        table = Base.metadata.tables[name]
+        started = time.time()
+
+        query, columns, repo_column = self._query(table)
+
+        if previous:
+            query = query.where(self._changed(table, repo_column, previous))
+
+        names = [c.name for c in columns]
+        id_idx = names.index('id')
+        repo_idx = names.index('repo_id')
+        month_idx = names.index(TABLES[name])
+        updated_idx = names.index('updated_at') if 'updated_at' in names else None
+
+        state = previous or {'id' : 0, 'updated_at' : {}}
+        files = _PartitionFiles(self.format, os.path.join(self.path, name),
+                                columns, export_id, self.max_open_files)
+        n = 0
+
+        try:
+            with self.engine.connect() as conn:
+                result = conn.execution_options(stream_results=True).\
+                    execute(query)
+
+                for rows in _chunks(result, self.chunk_size):
+                    for row in rows:
+                        month = row[month_idx]
+                        month = month.strftime('%Y-%m') if month else 'unknown'
+
+                        files.add((row[repo_idx], month), row)
+
+                        state['id'] = max(state['id'], row[id_idx])
+
+                        if updated_idx is not None and row[updated_idx]:
+                            self._update_watermark(state, row[repo_idx],
+                                                   row[updated_idx])
+                    files.flush()
+                    n += len(rows)
+        finally:
+            files.close()
+
+        return ({'rows' : n, 'files' : files.opened, 'bytes' : files.size,
+                 'elapsed' : time.time() - started}, state)
+
+    def _query(self, table):
+        """Query of the rows of a table, including the repository"""
+
+        if 'repo_id' in table.c:
+            return select([table]), list(table.columns), table.c.repo_id
+
+        # Children are linked to the repository by their pull request
+        pr = PullRequest.__table__
+        columns = list(table.columns) + [pr.c.repo_id]
+        query = select(columns).\
+            select_from(table.join(pr, table.c.pull_request_id == pr.c.id))
+
+        return query, columns, pr.c.repo_id
+
+    def _changed(self, table, repo_column, previous):
+        cond = [table.c.id > previous['id']]
+
+        if 'updated_at' in table.c:
+            column = table.c.updated_at
+        elif table.name in UPDATED_WITH_PULL_REQUEST:
+            column = PullRequest.__table__.c.updated_at
+        else:
+            return or_(*cond)
+
+        for repo_id, updated_at in previous['updated_at'].items():
+            updated_at = datetime.datetime.strptime(updated_at, TIMESTAMP_FORMAT)
+            cond.append(and_(repo_column == int(repo_id),
+                             column > updated_at))
+        return or_(*cond)
+
+    def _update_watermark(self, state, repo_id, updated_at):
+        watermarks = state['updated_at']
+        updated_at = updated_at.strftime(TIMESTAMP_FORMAT)
+
+        # Timestamps of this format compare as strings
+        if updated_at > watermarks.get(str(repo_id), ''):
+            watermarks[str(repo_id)] = updated_at
+
+    def _default_format(self, path):
+        try:
+            with open(os.path.join(path, STATE_FILE)) as f:
+                return json.load(f)['format']
+        except IOError:
+            pass
+
+        if pyarrow is None:
+            warnings.warn("pyarrow is not installed; exporting CSV files")
+            return 'csv'
+        return 'parquet'
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.path, STATE_FILE)) as f:
+                state = json.load(f)
+        except IOError:
+            return {'exports' : 0, 'format' : self.format, 'tables' : {}}
+
+        if state['format'] != self.format:
+            raise ValueError("%s has %s files; use the same format or another directory"
+                             % (self.path, state['format']))
+        return state
+
+    def _save_state(self, state):
+        path = os.path.join(self.path, STATE_FILE)
+
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+class _PartitionFiles(object):
+    """Files of the partitions of a table written by an export.
+
+    Rows are buffered until flush() is called, so each file gets
+    large row groups. When more than 'max_open' files are open, the
+    one used least recently is closed; new rows of its partition go
+    to a new file.
+    """
+
+    def __init__(self, format, path, columns, export_id, max_open):
+        self.format = format
+        self.path = path
+        self.columns = columns
+        self.export_id = export_id
+        self.max_open = max_open
+        self.opened = 0
+        self.size = 0
+
+        self._files = OrderedDict()
+        self._buffers = {}
+
+    def add(self, partition, row):
+        self._buffers.setdefault(partition, []).append(row)
+
+    def flush(self):
+        for partition, rows in self._buffers.items():
+            self._file(partition).write(rows)
+        self._buffers = {}
+
+    def close(self):
+        for partition in self._files.keys():
+            self._close(partition)
+
+    def _file(self, partition):
+        f = self._files.pop(partition, None)
+
+        if f is None:
+            if len(self._files) >= self.max_open:
+                self._close(next(iter(self._files)))
+
+            repo_id, month = partition
+            path = os.path.join(self.path, 'repo_id=%s' % repo_id,
+                                'month=%s' % month)
+
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+            name = 'part-%05d-%d.%s' % (self.export_id, self.opened, self.format)
+            f = _open_file(self.format, os.path.join(path, name), self.columns)
+            self.opened += 1
+
+        # Most recently used go last
+        self._files[partition] = f
+        return f
+
+    def _close(self, partition):
+        f = self._files.pop(partition)
+        f.close()
+        self.size += f.size
+
+
+def _open_file(format, path, columns):
+    if format == 'csv':
+        return _CSVFile(path, columns)
+    elif format == 'parquet':
+        return _ParquetFile(path, columns)
+    else:
+        return _ArrowFile(path, columns)
+
+
+class _CSVFile(object):
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.size = 0
+        self._fd = open(path, 'wb')
+        self._writer = csv.writer(self._fd)
+        self._writer.writerow([c.name for c in columns])
+
+    def write(self, rows):
+        self._writer.writerows([[_csv_value(v) for v in row] for row in rows])
+
+    def close(self):
+        self._fd.close()
+        self.size = os.path.getsize(self.path)
+
+
+class _ParquetFile(object):
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.size = 0
+        self._schema = _arrow_schema(columns)
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema,
+                                                     compression='snappy')
+
+    def write(self, rows):
+        arrays = _arrow_arrays(self._schema, rows)
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                           self._schema.names))
+
+    def close(self):
+        self._writer.close()
+        self.size = os.path.getsize(self.path)
+
+
+class _ArrowFile(object):
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.size = 0
+        self._schema = _arrow_schema(columns)
+        self._sink = pyarrow.OSFile(path, 'wb')
+        self._writer = pyarrow.RecordBatchFileWriter(self._sink, self._schema)
+
+    def write(self, rows):
+        arrays = _arrow_arrays(self._schema, rows)
+        self._writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays,
+                                                                 self._schema.names))
+
+    def close(self):
+        self._writer.close()
+        self._sink.close()
+        self.size = os.path.getsize(self.path)
+
+
+def _arrow_schema(columns):
+    fields = []
+
+    for column in columns:
+        if isinstance(column.type, Boolean):
+            t = pyarrow.bool_()
+        elif isinstance(column.type, Integer):
+            t = pyarrow.int64()
+        elif isinstance(column.type, DateTime):
+            t = pyarrow.timestamp('s')
+        elif isinstance(column.type, Date):
+            t = pyarrow.date32()
+        else:
+            t = pyarrow.string()
+        fields.append(pyarrow.field(column.name, t))
+    return pyarrow.schema(fields)
+
+
+def _arrow_arrays(schema, rows):
+    return [pyarrow.array([row[i] for row in rows], type=field.type)
+            for i, field in enumerate(schema)]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _chunks(result, size):
+    while True:
+        rows = result.fetchmany(size)
+
+        if not rows:
+            return
+        yield rows
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import calendar
+import heapq
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy.sql import select
+
+from pullpo.db.model import Repository, PullRequest, Comment, ReviewComment, User
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def timestamp(date):
+    """Seconds since the epoch of a naive UTC datetime"""
+
+    return calendar.timegm(date.utctimetuple())
+
+
+class ReviewGraph(object):
+    """Pull requests, their authors and their reviewers held in arrays.
+
+    Users and pull requests are coded with consecutive integers
+    following the order of their ids, so the code of an id is found
+    by bisection instead of keeping a dict per row. Dates are stored
+    as seconds since the epoch.
+
+    The comments and review comments of each pull request are stored
+    sorted by date in the 'activity' arrays; the ones of the pull
+    request coded 'p' go from activity_offsets[p] to
+    activity_offsets[p + 1]. In the same way, the 'edge' arrays keep,
+    for each author, the reviewers that commented on their pull
+    requests, with the number of pull requests and comments. A
+    reviewer is anyone but the author who commented on a pull request.
+
+    Every array is an array.array. When numpy is installed, edges,
+    response times and workloads are aggregated with vectorized
+    operations over views of the arrays; otherwise, with loops.
+    """
+
+    def __init__(self):
+        self.logins = []
+        self.user_ids = array('l')
+
+        self.pr_ids = array('l')
+        self.pr_authors = array('l')
+        self.pr_created = array('d')
+
+        self.activity_offsets = array('l', [0])
+        self.activity_users = array('l')
+        self.activity_times = array('d')
+        self.activity_review = array('b')
+
+        self.edge_offsets = array('l', [0])
+        self.edge_reviewers = array('l')
+        self.edge_prs = array('l')
+        self.edge_comments = array('l')
+
+    @classmethod
+    def load(cls, session, owner=None, repository=None, forge=None):
+        """Load the pull requests of some repositories, or all of them.
+
+        Repositories are selected by owner, name and 'forge', given
+        by its id or its URL. A repository name stored for several
+        forges raises a ValueError unless the forge is given. Rows
+        are read with core queries, without building any ORM object,
+        and sorted by the database.
+        """
+        graph = cls()
+        conn = session.connection()
+
+        if repository:
+            scope = [PullRequest.repo_id == Repository.find_id(session, owner,
+                                                               repository, forge)]
+        elif owner or forge:
+            scope = [PullRequest.repo_id == Repository.id] + \
+                Repository.filters(owner, forge=forge)
+        else:
+            scope = []
+
+        for user_id, login in conn.execute(select([User.id, User.login]).\
+                                           order_by(User.id)):
+            graph.user_ids.append(user_id)
+            graph.logins.append(login)
+
+        query = select([PullRequest.id, PullRequest.user_id,
+                        PullRequest.created_at]).order_by(PullRequest.id)
+
+        for pr_id, user_id, created_at in conn.execute(graph._filter(query, scope)):
+            graph.pr_ids.append(pr_id)
+            graph.pr_authors.append(graph._user_code(user_id))
+            graph.pr_created.append(timestamp(created_at) if created_at else 0)
+
+        activity = heapq.merge(graph._activity(conn, Comment, 0, scope),
+                               graph._activity(conn, ReviewComment, 1, scope))
+        graph._load_activity(activity)
+        graph._build_edges()
+
+        return graph
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays, in bytes"""
+
+        arrays = [value for value in self.__dict__.values()
+                  if isinstance(value, array)]
+
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def response_times(self, since=None, until=None):
+        """Seconds from the creation of each pull request created
+        between 'since' and 'until' to its first comment by a reviewer.
+
+        Returns two arrays: the ids of the pull requests that had
+        any reviewer and their response times.
+        """
+        since, until = self._window(since, until)
+
+        if numpy is not None:
+            return self._numpy_response_times(since, until)
+
+        ids = array('l')
+        seconds = array('d')
+
+        offsets = self.activity_offsets
+        users = self.activity_users
+        times = self.activity_times
+
+        for p in xrange(len(self.pr_ids)):
+            created = self.pr_created[p]
+
+            if created < since or created >= until:
+                continue
+
+            author = self.pr_authors[p]
+
+            for i in xrange(offsets[p], offsets[p + 1]):
+                if users[i] >= 0 and users[i] != author:
+                    ids.append(self.pr_ids[p])
+                    seconds.append(times[i] - created)
+                    break
+        return ids, seconds
+
+    def review_pairs(self, limit=None):
+        """Pairs of author and reviewer, with the number of pull
+        requests of the author the reviewer commented on and the
+        number of comments, sorted by pull requests"""
+
+        pairs = []
+
+        for author in xrange(len(self.logins)):
+            for e in xrange(self.edge_offsets[author], self.edge_offsets[author + 1]):
+                pairs.append((self.logins[author],
+                              self.logins[self.edge_reviewers[e]],
+                              self.edge_prs[e], self.edge_comments[e]))
+
+        pairs.sort(key=lambda pair: (-pair[2], -pair[3]))
+
+        return pairs[:limit] if limit else pairs
+
+    def reviewers_of(self, login):
+        """Reviewers of the pull requests of a user, with the number
+        of pull requests and comments of each one"""
+
+        try:
+            author = self.logins.index(login)
+        except ValueError:
+            return []
+
+        return [(self.logins[self.edge_reviewers[e]],
+                 self.edge_prs[e], self.edge_comments[e])
+                for e in xrange(self.edge_offsets[author],
+                                self.edge_offsets[author + 1])]
+
+    def workload(self, since=None, until=None, limit=None):
+        """Pull requests of others each user commented on, and the
+        number of comments, between 'since' and 'until'.
+
+        Returns tuples of login, pull requests and comments, from
+        the busiest reviewer.
+        """
+        since, until = self._window(since, until)
+
+        if numpy is not None:
+            prs, comments = self._numpy_workload(since, until)
+        else:
+            prs, comments = self._workload(since, until)
+
+        load = [(self.logins[u], int(prs[u]), int(comments[u]))
+                for u in xrange(len(self.logins)) if comments[u]]
+        load.sort(key=lambda row: (-row[1], -row[2]))
+
+        return load[:limit] if limit else load
+
+    def _workload(self, since, until):
+        prs = array('l', [0]) * len(self.logins)
+        comments = array('l', [0]) * len(self.logins)
+
+        offsets = self.activity_offsets
+        users = self.activity_users
+        times = self.activity_times
+
+        for p in xrange(len(self.pr_ids)):
+            author = self.pr_authors[p]
+            seen = set()
+
+            for i in xrange(offsets[p], offsets[p + 1]):
+                user = users[i]
+
+                if user < 0 or user == author or not since <= times[i] < until:
+                    continue
+
+                comments[user] += 1
+
+                if user not in seen:
+                    seen.add(user)
+                    prs[user] += 1
+
+        return prs, comments
+
+    def _numpy_response_times(self, since, until):
+        pr_of, users, times = self._numpy_activity()
+        authors = view(self.pr_authors)
+        created = view(self.pr_created)
+
+        reviews = numpy.flatnonzero((users >= 0) & (users != authors[pr_of]))
+
+        # Activity is sorted by date, so the first review
+        # of each pull request is its first occurrence
+        prs, first = numpy.unique(pr_of[reviews], return_index=True)
+        first = reviews[first]
+
+        selected = (created[prs] >= since) & (created[prs] < until)
+        prs = prs[selected]
+
+        return (to_array('l', view(self.pr_ids)[prs]),
+                to_array('d', times[first[selected]] - created[prs]))
+
+    def _numpy_workload(self, since, until):
+        n_users = len(self.logins)
+        pr_of, users, times = self._numpy_activity()
+        authors = view(self.pr_authors)
+
+        selected = (users >= 0) & (users != authors[pr_of]) & \
+            (times >= since) & (times < until)
+        pr_of = pr_of[selected]
+        users = users[selected]
+
+        comments = numpy.bincount(users, minlength=n_users)
+        pairs = numpy.unique(pr_of * n_users + users)
+        prs = numpy.bincount(pairs % n_users, minlength=n_users)
+
+        return prs, comments
+
+    def _numpy_activity(self):
+        """Pull request code, user and date of each activity"""
+
+        counts = numpy.diff(view(self.activity_offsets))
+        pr_of = numpy.repeat(numpy.arange(len(self.pr_ids)), counts)
+
+        return pr_of, view(self.activity_users), view(self.activity_times)
+
+    def _filter(self, query, scope):
+        for cond in scope:
+            query = query.where(cond)
+        return query
+
+    def _activity(self, conn, model, review, scope):
+        query = select([model.pull_request_id, model.created_at, model.user_id]).\
+            where(model.pull_request_id == PullRequest.id).\
+            where(model.created_at != None).\
+            order_by(model.pull_request_id, model.created_at)
+
+        for pr_id, created_at, user_id in conn.execute(self._filter(query, scope)):
+            yield pr_id, created_at, user_id, review
+
+    def _load_activity(self, activity):
+        offsets = self.activity_offsets
+        p = 0
+
+        # Both are sorted by the id of the pull request
+        for pr_id, created_at, user_id, review in activity:
+            while self.pr_ids[p] != pr_id:
+                offsets.append(len(self.activity_users))
+                p += 1
+
+            self.activity_users.append(self._user_code(user_id))
+            self.activity_times.append(timestamp(created_at))
+            self.activity_review.append(review)
+
+        while len(offsets) <= len(self.pr_ids):
+            offsets.append(len(self.activity_users))
+
+    def _build_edges(self):
+        if numpy is not None:
+            self._numpy_build_edges()
+            return
+
+        edges = {}
+        offsets = self.activity_offsets
+
+        for p in xrange(len(self.pr_ids)):
+            author = self.pr_authors[p]
+
+            if author < 0:
+                continue
+
+            seen = set()
+
+            for i in xrange(offsets[p], offsets[p + 1]):
+                reviewer = self.activity_users[i]
+
+                if reviewer < 0 or reviewer == author:
+                    continue
+
+                edge = edges.setdefault((author, reviewer), [0, 0])
+                edge[1] += 1
+
+                if reviewer not in seen:
+                    seen.add(reviewer)
+                    edge[0] += 1
+
+        author = 0
+
+        for (a, reviewer), (prs, comments) in sorted(edges.items()):
+            while author < a:
+                self.edge_offsets.append(len(self.edge_reviewers))
+                author += 1
+
+            self.edge_reviewers.append(reviewer)
+            self.edge_prs.append(prs)
+            self.edge_comments.append(comments)
+
+        while len(self.edge_offsets) <= len(self.logins):
+            self.edge_offsets.append(len(self.edge_reviewers))
+
+    def _numpy_build_edges(self):
+        n_users = len(self.logins)
+        pr_of, users, times = self._numpy_activity()
+        authors = view(self.pr_authors)[pr_of]
+
+        selected = (authors >= 0) & (users >= 0) & (users != authors)
+        pr_of = pr_of[selected]
+        users = users[selected]
+        authors = authors[selected]
+
+        # Comments per pair, and pull requests per pair counted
+        # on the distinct pairs of pull request and reviewer
+        keys, comments = numpy.unique(authors * n_users + users,
+                                      return_counts=True)
+
+        pairs = numpy.unique(pr_of * n_users + users)
+        reviewers = pairs % n_users
+        pair_keys = view(self.pr_authors)[pairs // n_users] * n_users + reviewers
+        prs = numpy.bincount(numpy.searchsorted(keys, pair_keys),
+                             minlength=len(keys))
+
+        self.edge_offsets = to_array('l', numpy.searchsorted(keys // n_users,
+                                                             numpy.arange(n_users + 1)))
+        self.edge_reviewers = to_array('l', keys % n_users)
+        self.edge_prs = to_array('l', prs)
+        self.edge_comments = to_array('l', comments)
+
+    def _user_code(self, user_id):
+        if user_id is None:
+            return -1
+
+        code = bisect_left(self.user_ids, user_id)
+
+        if code == len(self.user_ids) or self.user_ids[code] != user_id:
+            return -1
+        return code
+
+    def _window(self, since, until):
+        since = timestamp(since) if since else float('-inf')
+        until = timestamp(until) if until else float('inf')
+        return since, until
+
+
+def view(values):
+    """numpy array sharing the buffer of an array.array"""
+
+    if not values:
+        return numpy.zeros(0, values.typecode)
+    return numpy.frombuffer(values, values.typecode)
+
+
+def to_array(typecode, values):
+    """array.array with the values of a numpy array"""
+
+    result = array(typecode)
+    result.fromstring(numpy.asarray(values, typecode).tostring())
+    return result
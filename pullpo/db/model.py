@@ -20,9 +20,11 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
-from sqlalchemy import Column, Boolean, DateTime, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, BigInteger, Boolean, Date, DateTime, Integer, String,\
+    Text, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import select
 
 
 Base = declarative_base()
@@ -30,6 +32,11 @@ Base = declarative_base()
 
 class UniqueObject(object):
 
+    # Columns that identify an object, in the same order
+    # used by unique_filter. The first one is used to
+    # retrieve the candidates on batched lookups.
+    unique_key = ()
+
     @classmethod
     def unique_filter(cls, query, *arg, **kw):
         raise NotImplementedError
@@ -44,6 +51,35 @@ class UniqueObject(object):
                     arg, kw
                )
 
+    @classmethod
+    def as_unique_all(cls, session, kws):
+        return _unique_all(
+                    session,
+                    cls,
+                    cls.unique_key,
+                    cls,
+                    kws
+               )
+
+
+class Forge(UniqueObject, Base):
+    __tablename__ = 'forges'
+
+    id = Column(Integer, primary_key=True)
+    # Type of forge, like 'github', 'gitlab' or 'gerrit'
+    kind = Column(String(32))
+    url = Column(String(256))
+
+    __table_args__ = (Index('ix_forges_url', 'url', unique=True,
+                            mysql_length={'url' : 255}),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('url',)
+
+    @classmethod
+    def unique_filter(cls, query, url):
+        return query.filter(Forge.url == url)
+
 
 class User(UniqueObject, Base):
     __tablename__ = 'people'
@@ -56,11 +92,20 @@ class User(UniqueObject, Base):
     avatar_url = Column(String(256))
     type = Column(String(32))
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    # Logins are only unique within a forge
+    forge_id = Column(Integer,
+                      ForeignKey('forges.id', ondelete='CASCADE'))
+
+    __table_args__ = (Index('ix_people_login_forge_id',
+                            'login', 'forge_id', unique=True),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('login', 'forge_id')
 
     @classmethod
-    def unique_filter(cls, query, login):
-        return query.filter(User.login == login)
+    def unique_filter(cls, query, login, forge_id):
+        return query.filter(User.login == login,
+                            User.forge_id == forge_id)
 
 
 class Repository(UniqueObject, Base):
@@ -72,15 +117,64 @@ class Repository(UniqueObject, Base):
     name = Column(String(128))
     url = Column(String(256))
 
+    forge_id = Column(Integer,
+                      ForeignKey('forges.id', ondelete='CASCADE'))
+
     prs = relationship('PullRequest', backref='repositories',
                        cascade="save-update, merge, delete")
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_repositories_owner_repository_forge_id',
+                            'owner', 'repository', 'forge_id', unique=True,
+                            mysql_length={'owner' : 64}),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('owner', 'repository', 'forge_id')
 
     @classmethod
-    def unique_filter(cls, query, owner, repository):
+    def unique_filter(cls, query, owner, repository, forge_id):
         return query.filter(Repository.owner == owner,
-                            Repository.repository == repository)
+                            Repository.repository == repository,
+                            Repository.forge_id == forge_id)
+
+    @classmethod
+    def filters(cls, owner=None, repository=None, forge=None):
+        """Conditions matching the repositories of 'owner', or only
+        'repository' when it is given, stored for 'forge', given by
+        its id or its URL. Without 'forge', every forge matches.
+        """
+        if repository and not owner:
+            raise ValueError("The owner of repository %s is needed" % repository)
+
+        conds = []
+
+        if owner:
+            conds.append(Repository.owner == owner)
+        if repository:
+            conds.append(Repository.repository == owner + '/' + repository)
+
+        if isinstance(forge, (int, long)):
+            conds.append(Repository.forge_id == forge)
+        elif forge:
+            forges = select([Forge.id]).where(Forge.url == forge.rstrip('/'))
+            conds.append(Repository.forge_id.in_(forges))
+        return conds
+
+    @classmethod
+    def find_id(cls, session, owner, repository, forge=None):
+        """Id of a repository.
+
+        Raises ValueError when the repository was not found or when,
+        without 'forge', it is stored for several forges.
+        """
+        ids = [row[0] for row in session.query(Repository.id).\
+               filter(*cls.filters(owner, repository, forge))]
+
+        if not ids:
+            raise ValueError("Repository %s/%s not found" % (owner, repository))
+        elif len(ids) > 1:
+            raise ValueError("Repository %s/%s is stored for several forges; "
+                             "give the forge" % (owner, repository))
+        return ids[0]
 
 
 class PullRequest(UniqueObject, Base):
@@ -103,9 +197,24 @@ class PullRequest(UniqueObject, Base):
     deletions = Column(Integer)
     changed_files = Column(Integer)
 
+    # Sizes of the sub-collections last stored; together with
+    # updated_at, they tell whether the pull request changed
+    comments_count = Column(Integer)
+    review_comments_count = Column(Integer)
+    commits_count = Column(Integer)
+    events_count = Column(Integer)
+
+    # Events are listed from the oldest one; new ones
+    # are retrieved from the page of this one on
+    last_event_id = Column(Integer)
+
     repo_id = Column(Integer,
                      ForeignKey('repositories.id', ondelete='CASCADE'))
 
+    # Ids of pull requests are only unique within a forge
+    forge_id = Column(Integer,
+                      ForeignKey('forges.id', ondelete='CASCADE'))
+
     user_id = Column(Integer,
                      ForeignKey('people.id', ondelete='CASCADE'),)
     assignee_id = Column(Integer,
@@ -115,24 +224,33 @@ class PullRequest(UniqueObject, Base):
 
     repository = relationship('Repository', backref='pull_requests')
 
+    # Children are loaded on access; readers that need them
+    # for many pull requests ask for them with loader options
     comments = relationship('Comment',
-                            cascade="save-update, merge, delete")
+                            cascade="save-update, merge, delete, expunge")
     review_comments = relationship('ReviewComment',
-                                   lazy='joined', cascade="save-update, merge, delete")
+                                   cascade="save-update, merge, delete, expunge")
     commits = relationship('Commit',
-                           cascade="save-update, merge, delete")
+                           cascade="save-update, merge, delete, expunge")
     events = relationship('Event',
-                          cascade="save-update, merge, delete")
+                          cascade="save-update, merge, delete, expunge")
 
     user = relationship('User', foreign_keys=[user_id])
     assignee = relationship('User', foreign_keys=[assignee_id])
     merged_by = relationship('User', foreign_keys=[merged_by_id])
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_pull_requests_github_id_forge_id',
+                            'github_id', 'forge_id', unique=True),
+                      Index('ix_pull_requests_repo_id_updated_at',
+                            'repo_id', 'updated_at'),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('github_id', 'forge_id')
 
     @classmethod
-    def unique_filter(cls, query, github_id):
-        return query.filter(PullRequest.github_id == github_id)
+    def unique_filter(cls, query, github_id, forge_id):
+        return query.filter(PullRequest.github_id == github_id,
+                            PullRequest.forge_id == forge_id)
 
 
 class Comment(UniqueObject, Base):
@@ -151,7 +269,12 @@ class Comment(UniqueObject, Base):
     pull_request = relationship('PullRequest')
     user = relationship('User', foreign_keys=[user_id])
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_comments_pull_request_id_user_id_created_at',
+                            'pull_request_id', 'user_id', 'created_at',
+                            unique=True),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('pull_request_id', 'user_id', 'created_at')
 
     @classmethod
     def unique_filter(cls, query, pull_request_id, user_id, created_at):
@@ -178,7 +301,13 @@ class ReviewComment(UniqueObject, Base):
     pull_request = relationship('PullRequest')
     user = relationship('User', foreign_keys=[user_id])
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_review_comments_pull_request_id_commit_id',
+                            'pull_request_id', 'commit_id', 'user_id',
+                            'created_at', unique=True,
+                            mysql_length={'commit_id' : 64}),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('pull_request_id', 'commit_id', 'user_id', 'created_at')
 
     @classmethod
     def unique_filter(cls, query, pull_request_id, commit_id, user_id, created_at):
@@ -206,7 +335,12 @@ class Commit(UniqueObject, Base):
     author = relationship('User', foreign_keys=[author_id])
     committer = relationship('User', foreign_keys=[committer_id])
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_commits_pull_request_id_sha',
+                            'pull_request_id', 'sha', unique=True,
+                            mysql_length={'sha' : 64}),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('pull_request_id', 'sha')
 
     @classmethod
     def unique_filter(cls, query, pull_request_id, sha):
@@ -230,11 +364,129 @@ class Event(UniqueObject, Base):
     pull_request = relationship('PullRequest')
     actor = relationship('User')
 
-    __table_args__ = {'mysql_charset': 'utf8'}
+    # Ids of events are only unique within a forge
+    __table_args__ = (Index('ix_events_pull_request_id_event_id',
+                            'pull_request_id', 'event_id', unique=True),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('pull_request_id', 'event_id')
+
+    @classmethod
+    def unique_filter(cls, query, pull_request_id, event_id):
+        return query.filter(Event.pull_request_id == pull_request_id,
+                            Event.event_id == event_id)
+
+
+class CrawlState(UniqueObject, Base):
+    __tablename__ = 'crawl_states'
+
+    id = Column(Integer, primary_key=True)
+    # Lower bound, direction and pages stored of the crawl in progress
+    since = Column(DateTime())
+    newest = Column(Boolean(), default=False)
+    page = Column(Integer, default=0)
+    # Cursor of the last pull request stored, on GraphQL crawls
+    cursor = Column(String(256))
+    # Every issue updated before this date is stored
+    updated_at = Column(DateTime())
+    completed = Column(Boolean(), default=False)
+    repo_id = Column(Integer,
+                     ForeignKey('repositories.id', ondelete='CASCADE'))
+
+    repository = relationship('Repository')
+
+    __table_args__ = (Index('ix_crawl_states_repo_id', 'repo_id', unique=True),
+                      {'mysql_charset': 'utf8'})
+
+    unique_key = ('repo_id',)
 
     @classmethod
-    def unique_filter(cls, query, event_id):
-        return query.filter(Event.event_id == event_id)
+    def unique_filter(cls, query, repo_id):
+        return query.filter(CrawlState.repo_id == repo_id)
+
+
+class PullRequestMetrics(Base):
+    __tablename__ = 'pull_request_metrics'
+
+    id = Column(Integer, primary_key=True)
+    # Date of the pull request when these metrics were computed
+    pr_updated_at = Column(DateTime())
+    created_at = Column(DateTime())
+    merged_at = Column(DateTime())
+    closed_at = Column(DateTime())
+    # Mondays of the weeks the pull request was opened, merged or closed
+    created_week = Column(Date())
+    merged_week = Column(Date())
+    closed_week = Column(Date())
+    # Times in seconds since the pull request was opened
+    time_to_merge = Column(Integer)
+    time_to_first_review = Column(Integer)
+    review_rounds = Column(Integer, default=0)
+    reviewers = Column(Integer, default=0)
+    comments = Column(Integer, default=0)
+    review_comments = Column(Integer, default=0)
+    commits = Column(Integer, default=0)
+    pull_request_id = Column(Integer,
+                             ForeignKey('pull_requests.id', ondelete='CASCADE'))
+    repo_id = Column(Integer,
+                     ForeignKey('repositories.id', ondelete='CASCADE'))
+    user_id = Column(Integer,
+                     ForeignKey('people.id', ondelete='CASCADE'),)
+
+    pull_request = relationship('PullRequest')
+
+    __table_args__ = (Index('ix_pull_request_metrics_pull_request_id',
+                            'pull_request_id', unique=True),
+                      Index('ix_pull_request_metrics_repo_id_created_week',
+                            'repo_id', 'created_week'),
+                      {'mysql_charset': 'utf8'})
+
+
+class PullRequestReviewer(Base):
+    __tablename__ = 'pull_request_reviewers'
+
+    id = Column(Integer, primary_key=True)
+    # Monday of the week of the first review of the user
+    week = Column(Date())
+    comments = Column(Integer, default=0)
+    pull_request_id = Column(Integer,
+                             ForeignKey('pull_requests.id', ondelete='CASCADE'))
+    repo_id = Column(Integer,
+                     ForeignKey('repositories.id', ondelete='CASCADE'))
+    user_id = Column(Integer,
+                     ForeignKey('people.id', ondelete='CASCADE'),)
+
+    user = relationship('User')
+
+    __table_args__ = (Index('ix_pull_request_reviewers_pull_request_id_user_id',
+                            'pull_request_id', 'user_id', unique=True),
+                      Index('ix_pull_request_reviewers_repo_id_week',
+                            'repo_id', 'week'),
+                      {'mysql_charset': 'utf8'})
+
+
+class RepositoryWeek(Base):
+    __tablename__ = 'repository_weeks'
+
+    id = Column(Integer, primary_key=True)
+    week = Column(Date())
+    opened = Column(Integer, default=0)
+    merged = Column(Integer, default=0)
+    closed = Column(Integer, default=0)
+    # Sums and counts, so averages of several weeks can be computed
+    time_to_merge = Column(BigInteger, default=0)
+    time_to_first_review = Column(BigInteger, default=0)
+    reviewed = Column(Integer, default=0)
+    review_rounds = Column(Integer, default=0)
+    review_comments = Column(Integer, default=0)
+    repo_id = Column(Integer,
+                     ForeignKey('repositories.id', ondelete='CASCADE'))
+
+    repository = relationship('Repository')
+
+    __table_args__ = (Index('ix_repository_weeks_repo_id_week',
+                            'repo_id', 'week', unique=True),
+                      {'mysql_charset': 'utf8'})
 
 
 def _unique(session, cls, queryfunc, constructor, arg, kw):
@@ -249,3 +501,45 @@ def _unique(session, cls, queryfunc, constructor, arg, kw):
 
         session.add(obj)
     return obj
+
+
+def _unique_all(session, cls, columns, constructor, kws, chunk_size=500):
+    """Batched version of _unique.
+
+    Existing objects are retrieved filtering by the first column
+    of the key with IN queries of chunk_size values, so resolving
+    the children of a pull request costs one query per table.
+    Objects are returned in the same order as kws; repeated keys
+    return the same object.
+    """
+    def obj_key(obj):
+        return tuple(getattr(obj, column) for column in columns)
+
+    def kw_key(kw):
+        return tuple(kw[column] for column in columns)
+
+    first = getattr(cls, columns[0])
+    values = list(set(kw[columns[0]] for kw in kws
+                      if kw[columns[0]] is not None))
+    found = {}
+
+    with session.no_autoflush:
+        for i in range(0, len(values), chunk_size):
+            q = session.query(cls).filter(first.in_(values[i:i + chunk_size]))
+
+            for obj in q:
+                found.setdefault(obj_key(obj), obj)
+
+        objs = []
+
+        for kw in kws:
+            key = kw_key(kw)
+            obj = found.get(key)
+
+            if not obj:
+                obj = constructor(**kw)
+                found[key] = obj
+
+            session.add(obj)
+            objs.append(obj)
+    return objs
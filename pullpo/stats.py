@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import bisect
+import re
+import threading
+import time
+import urlparse
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+# Upper bounds, in milliseconds, of the buckets of the histograms
+BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Timing(object):
+    """Number, total time and histogram of the timings of an operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+
+    def percentile(self, p):
+        """Upper bound, in milliseconds, of the bucket of a percentile"""
+
+        target = self.count * p
+        seen = 0
+
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+
+            if seen >= target:
+                return min(bound, self.max * 1000)
+        return self.max * 1000
+
+    def as_dict(self):
+        return {'count' : self.count,
+                'total' : self.total,
+                'avg_ms' : self.total * 1000 / self.count if self.count else 0,
+                'p95_ms' : self.percentile(0.95),
+                'max_ms' : self.max * 1000,
+                'buckets' : dict(('<=%s' % bound, n) for bound, n
+                                 in zip(BUCKETS + ('inf',), self.buckets) if n)}
+
+
+class Stats(object):
+    """Counters and timings of a run, grouped by category.
+
+    Nothing is measured until the objects to measure are instrumented
+    with the instrument_* methods. These replace methods and add event
+    listeners, so runs without a Stats object don't execute any code
+    of this module.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, category, name, seconds):
+        with self._lock:
+            timings = self.timings.setdefault(category, {})
+
+            if name not in timings:
+                timings[name] = Timing()
+            timings[name].add(seconds)
+
+    def count(self, category, name, n=1):
+        with self._lock:
+            counters = self.counters.setdefault(category, {})
+            counters[name] = counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, category, name):
+        started = time.time()
+
+        try:
+            yield
+        finally:
+            self.record(category, name, time.time() - started)
+
+    def timed(self, category, name, func):
+        def wrapper(*args, **kwargs):
+            started = time.time()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(category, name, time.time() - started)
+        return wrapper
+
+    def iterate(self, category, name, iterable):
+        """Time how long each item of an iterable takes to be produced"""
+
+        it = iter(iterable)
+
+        while True:
+            started = time.time()
+
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+
+            self.record(category, name, time.time() - started)
+            yield item
+
+    def instrument(self, obj, category, names):
+        """Time the calls to some methods or functions of an object"""
+
+        for name in names:
+            setattr(obj, name, self.timed(category, name.lstrip('_'),
+                                          getattr(obj, name)))
+
+    def instrument_http(self, http_session, category):
+        """Time the requests sent by a requests session, by type.
+
+        Timings are recorded under 'category', usually the name of
+        the backend that owns the session. The transport adapter
+        under the rate limit scheduler is measured, so waits for
+        the rate limit are not included.
+        """
+        adapters = set(http_session.adapters.values())
+
+        for adapter in adapters:
+            adapter = getattr(adapter, 'adapter', adapter)
+            send = adapter.send
+
+            def timed_send(request, send=send, **kwargs):
+                started = time.time()
+
+                try:
+                    return send(request, **kwargs)
+                finally:
+                    self.record(category, request_type(request),
+                                time.time() - started)
+
+            adapter.send = timed_send
+
+    def instrument_engine(self, engine):
+        """Time the statements run by an engine, by type and table"""
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('stats_started', []).append(time.time())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info['stats_started'].pop()
+            name = statement_type(statement)
+
+            self.record('db', name, time.time() - started)
+
+            if executemany:
+                self.count('db', name + ' rows', len(parameters))
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    def instrument_session(self, session):
+        """Time the flushes of an ORM session"""
+
+        started = []
+
+        def before(session, context, instances):
+            started.append(time.time())
+
+        def after(session, context):
+            if started:
+                self.record('db', 'flush', time.time() - started.pop())
+
+        event.listen(session, 'before_flush', before)
+        event.listen(session, 'after_flush_postexec', after)
+
+    def as_dict(self):
+        with self._lock:
+            timings = dict((category, dict((name, t.as_dict())
+                                           for name, t in timings.items()))
+                           for category, timings in self.timings.items())
+            counters = dict((category, dict(counters))
+                            for category, counters in self.counters.items())
+
+        return {'elapsed' : time.time() - self.started,
+                'timings' : timings,
+                'counters' : counters}
+
+    def report(self):
+        """Summary of the stats as text lines"""
+
+        data = self.as_dict()
+        lines = ["Stats - %.2fs elapsed" % data['elapsed']]
+
+        for category in sorted(data['timings']):
+            timings = data['timings'][category]
+
+            lines.append("  %-44s %8s %9s %8s %8s %9s"
+                         % (category, 'count', 'total(s)', 'avg(ms)',
+                            'p95(ms)', 'max(ms)'))
+
+            # Most expensive operations go first
+            for name in sorted(timings, key=lambda n: -timings[n]['total']):
+                t = timings[name]
+                lines.append("    %-42s %8d %9.2f %8.2f %8.1f %9.1f"
+                             % (name[:42], t['count'], t['total'], t['avg_ms'],
+                                t['p95_ms'], t['max_ms']))
+
+        for category in sorted(data['counters']):
+            for name, n in sorted(data['counters'][category].items()):
+                lines.append("  %s %s: %s" % (category, name, n))
+
+        return lines
+
+
+def request_type(request):
+    """Method and path of a request, without identifiers"""
+
+    path = urlparse.urlsplit(request.url).path
+
+    # API prefixes of GitHub Enterprise and GitLab
+    path = re.sub(r'^/api/v\d+', '', path)
+
+    path = re.sub(r'^/repos/[^/]+/[^/]+', '/repos/:repo', path)
+    path = re.sub(r'^/users/[^/]+', '/users/:user', path)
+    path = re.sub(r'/\d+(?=/|$)', '/:n', path)
+
+    return request.method + ' ' + path
+
+
+def statement_type(statement):
+    """Verb and table of a SQL statement"""
+
+    verb = statement.split(None, 1)[0].upper() if statement.strip() else ''
+    m = re.search(r'\b(?:FROM|INTO|UPDATE)\s+[`"]?(\w+)', statement, re.I)
+
+    if m:
+        return verb + ' ' + m.group(1)
+    return verb
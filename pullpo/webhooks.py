@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+
+
+# Webhook events that may change the data of a pull request
+EVENTS = ('pull_request', 'pull_request_review_comment',
+          'issue_comment', 'issues')
+
+
+def pull_request_key(event, payload):
+    """Owner, repository and number of the pull request of a webhook.
+
+    Returns None when the event is not about a pull request.
+    """
+    if event in ('pull_request', 'pull_request_review_comment'):
+        number = payload['pull_request']['number']
+    elif event in ('issue_comment', 'issues'):
+        issue = payload['issue']
+
+        # Plain issues are not stored
+        if 'pull_request' not in issue:
+            return None
+        number = issue['number']
+    else:
+        return None
+
+    owner, repository = payload['repository']['full_name'].split('/', 1)
+
+    return owner, repository, number
+
+
+class EventQueue(object):
+    """Queue of the pull requests notified by webhooks.
+
+    Pull requests are handed out once 'delay' seconds have passed
+    since their first event. Events received for a pull request
+    that is already waiting are coalesced into the queued one, so
+    bursts of events cause a single update.
+    """
+
+    def __init__(self, delay=5):
+        self.delay = delay
+        self.received = 0
+        self.coalesced = 0
+
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key):
+        with self._cond:
+            self.received += 1
+
+            if key in self._pending:
+                self.coalesced += 1
+            else:
+                self._pending[key] = time.time()
+                self._cond.notify()
+
+    def get(self, timeout=None):
+        """Wait for pull requests ready to be updated.
+
+        Returns the list of ready ones, or an empty list when
+        none was ready after 'timeout' seconds.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = [key for key, received in self._pending.items()
+                         if now - received >= self.delay]
+
+                if ready:
+                    for key in ready:
+                        del self._pending[key]
+                    return ready
+
+                waits = []
+
+                if deadline is not None:
+                    waits.append(deadline - now)
+                if self._pending:
+                    waits.append(min(self._pending.values()) + self.delay - now)
+
+                if waits and min(waits) <= 0:
+                    return []
+
+                self._cond.wait(min(waits) if waits else None)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receive GitHub webhooks and queue their pull requests"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if not self._is_signed(body):
+            return self._reply(401, 'Invalid signature')
+
+        event = self.headers.get('X-GitHub-Event')
+
+        if event == 'ping':
+            return self._reply(200, 'pong')
+        elif event not in EVENTS:
+            return self._reply(202, 'Ignored')
+
+        try:
+            key = pull_request_key(event, json.loads(body))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self._reply(400, 'Invalid payload')
+
+        if not key:
+            return self._reply(202, 'Ignored')
+
+        self.server.queue.put(key)
+        self._reply(202, 'Queued')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _is_signed(self, body):
+        secret = self.server.secret
+
+        if not secret:
+            return True
+
+        signature = self.headers.get('X-Hub-Signature-256')
+        digest = hashlib.sha256
+
+        if not signature:
+            signature = self.headers.get('X-Hub-Signature')
+            digest = hashlib.sha1
+
+        if not signature or '=' not in signature:
+            return False
+
+        expected = hmac.new(secret, body, digest).hexdigest()
+        return hmac.compare_digest(signature.split('=', 1)[1], expected)
+
+    def _reply(self, code, message):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """HTTP server that puts the pull requests of the webhooks on a queue"""
+
+    daemon_threads = True
+
+    def __init__(self, address, queue, secret=None):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.queue = queue
+        self.secret = secret
+
+
+class Ingester(object):
+    """Apply the queued webhooks to the database.
+
+    Pull requests taken from the queue are retrieved again from
+    GitHub and stored with the backend, which only writes the rows
+    that changed. Every 'sweep_interval' seconds, the repositories
+    given and the ones seen on webhooks are crawled incrementally
+    to catch deliveries that were lost.
+
+    The backend and the writer are only used from the thread that
+    calls run().
+    """
+
+    def __init__(self, backend, writer, queue, repositories=(),
+                 sweep_interval=3600):
+        self.backend = backend
+        self.writer = writer
+        self.queue = queue
+        self.repositories = set(repositories)
+        self.sweep_interval = sweep_interval
+        self.updated = 0
+        self.sweeps = 0
+
+        self._stopped = threading.Event()
+        self._next_sweep = time.time() + sweep_interval if sweep_interval else None
+
+    def run(self):
+        while not self._stopped.is_set():
+            if self._next_sweep is not None:
+                timeout = max(self._next_sweep - time.time(), 0)
+            else:
+                timeout = 1
+
+            keys = self.queue.get(timeout=min(timeout, 1))
+
+            if keys:
+                self.update(keys)
+
+            if self._next_sweep is not None and time.time() >= self._next_sweep:
+                self.sweep()
+                self._next_sweep = time.time() + self.sweep_interval
+
+    def stop(self):
+        self._stopped.set()
+
+    def update(self, keys):
+        """Retrieve and store some pull requests"""
+
+        numbers = OrderedDict()
+
+        for owner, repository, number in keys:
+            numbers.setdefault((owner, repository), []).append(number)
+
+        for (owner, repository), prs in numbers.items():
+            self.repositories.add((owner, repository))
+
+            n = self._store(owner, repository,
+                            self.backend.fetch_pull_requests(owner, repository, prs))
+
+            if n is not None:
+                self.updated += n
+                log("Webhooks - %s/%s: %s pull requests updated"
+                    % (owner, repository, n))
+
+    def sweep(self):
+        """Crawl the known repositories since their last crawl"""
+
+        for owner, repository in sorted(self.repositories):
+            n = self._store(owner, repository,
+                            self.backend.fetch(owner, repository))
+
+            if n is not None:
+                log("Webhooks - %s/%s: sweep stored %s pull requests"
+                    % (owner, repository, n))
+        self.sweeps += 1
+
+    def _store(self, owner, repository, prs):
+        n = 0
+
+        try:
+            for pr in prs:
+                self.writer.add(pr)
+                n += 1
+            self.writer.commit()
+        except Exception, e:
+            self.writer.session.rollback()
+            self.backend.reset()
+            log("Webhooks - %s/%s: %s" % (owner, repository, str(e)),
+                sys.stderr)
+            return None
+        return n
+
+
+def log(msg, stream=sys.stdout):
+    stream.write(msg + '\n')
+    stream.flush()
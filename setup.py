@@ -30,4 +30,5 @@ setup(name="pullpo",
       author_email="metrics-grimoire@lists.libresoft.es",
       url="https://github.com/MetricsGrimoire/pullpo",
       packages=['pullpo', 'pullpo.db', 'pullpo.backends'],
-      scripts=["bin/pullpo"])
+      scripts=["bin/pullpo", "bin/pullpo-admin", "bin/pullpo-bench",
+               "bin/pullpo-webhooks"])
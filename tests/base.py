@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import unittest
+
+from pullpo.backends.replay import MockServer
+from pullpo.db.database import BatchWriter, Database
+
+
+class TestCaseDatabase(unittest.TestCase):
+    """Test case that stores data on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.db = Database(url='sqlite://')
+        self.session = self.db.connect()
+
+    def tearDown(self):
+        self.session.close()
+        self.db.dispose()
+
+    def fetch(self, backend, owner, repository, max_objects=1000, **kwargs):
+        """Fetch a repository and store it in batches.
+
+        Returns the number of pull requests stored and the writer.
+        """
+        writer = BatchWriter(self.session, max_objects=max_objects)
+        prs = 0
+
+        for pr in backend.fetch(owner, repository, **kwargs):
+            writer.add(pr)
+            prs += 1
+        writer.commit()
+
+        return prs, writer
+
+
+class TestCaseMockServer(TestCaseDatabase):
+    """Test case with a local HTTP server; tests set the source it serves"""
+
+    def setUp(self):
+        super(TestCaseMockServer, self).setUp()
+        self.server = MockServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestCaseMockServer, self).tearDown()
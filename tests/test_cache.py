@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.cache import ResponseCache
+
+
+def entry(url, size):
+    return {'url' : url,
+            'headers' : {'ETag' : '"%s"' % url},
+            'body' : 'x' * size}
+
+
+class TestResponseCache(unittest.TestCase):
+    """Unit tests for ResponseCache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get(self):
+        """Check whether saved responses are returned"""
+
+        cache = ResponseCache(self.tmpdir)
+        cache.save([entry('http://example.com/1', 10)])
+
+        cached = cache.get('http://example.com/1')
+        self.assertEqual(cached['body'], 'x' * 10)
+        self.assertEqual(cached['headers'], {'ETag' : '"http://example.com/1"'})
+        self.assertEqual(cache.get('http://example.com/2'), None)
+
+    def test_evict(self):
+        """Check whether the least recently used entries are removed"""
+
+        cache = ResponseCache(self.tmpdir, max_size=2500)
+
+        for i in range(5):
+            cache.save([entry('http://example.com/%d' % i, 1000)])
+            os.utime(cache._path(cache._key('http://example.com/%d' % i)),
+                     (i, i))
+
+        self.assertLessEqual(cache._total, 2500)
+        self.assertEqual(cache.get('http://example.com/0'), None)
+        self.assertNotEqual(cache.get('http://example.com/4'), None)
+
+    def test_evict_removed_entries(self):
+        """Check whether entries removed by other processes are skipped"""
+
+        cache = ResponseCache(self.tmpdir, max_size=2500)
+        cache.save([entry('http://example.com/1', 1000),
+                    entry('http://example.com/2', 1000)])
+
+        # Another process shares the directory
+        os.remove(cache._path(cache._key('http://example.com/1')))
+
+        cache.save([entry('http://example.com/3', 1000)])
+
+        self.assertEqual(cache.get('http://example.com/1'), None)
+        self.assertNotEqual(cache.get('http://example.com/3'), None)
+        self.assertLessEqual(cache._total, 2500)
+
+
+if __name__ == "__main__":
+    unittest.main()
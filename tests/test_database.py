@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.db.bulk import bulk_insert, bulk_upsert
+from pullpo.db.database import BatchWriter, Database, DatabaseError
+from pullpo.db.model import Comment, Forge, PullRequest, User
+
+from tests.base import TestCaseDatabase
+
+
+class TestDatabase(unittest.TestCase):
+    """Unit tests for Database"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqlite_wal(self):
+        """Check whether SQLite databases use write-ahead logging"""
+
+        path = os.path.join(self.tmpdir, 'pullpo.db')
+        db = Database(url='sqlite:///' + path)
+
+        self.assertEqual(db.dialect, 'sqlite')
+        self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertTrue(os.path.exists(path))
+        db.dispose()
+
+    def test_invalid_url(self):
+        """Check whether invalid URLs raise a DatabaseError"""
+
+        self.assertRaises(DatabaseError, Database, url='not a url')
+        self.assertRaises(DatabaseError, Database, url='nodb://localhost/pullpo')
+
+    def test_sessions_share_memory_database(self):
+        """Check whether sessions see the same in-memory database"""
+
+        db = Database(url='sqlite://')
+
+        session = db.connect()
+        session.add(User(login='jdoe'))
+        session.commit()
+        session.close()
+
+        session = db.connect()
+        self.assertEqual(session.query(User).count(), 1)
+        session.close()
+        db.dispose()
+
+
+class TestBulk(TestCaseDatabase):
+    """Unit tests for bulk inserts and upserts"""
+
+    def test_bulk_insert(self):
+        """Check whether every row is inserted"""
+
+        rows = [{'login' : 'user%d' % i, 'email' : None} for i in range(500)]
+
+        with self.db.engine.begin() as conn:
+            bulk_insert(conn, User.__table__, rows)
+            bulk_insert(conn, User.__table__, [])
+
+        self.assertEqual(self.session.query(User).count(), 500)
+
+    def test_bulk_upsert(self):
+        """Check whether existing rows are updated and new ones inserted"""
+
+        table = User.__table__
+
+        with self.db.engine.begin() as conn:
+            forge_id = conn.execute(Forge.__table__.insert().\
+                                    values(kind='github',
+                                           url='https://github.com')).inserted_primary_key[0]
+
+            rows = [{'login' : 'user%d' % i, 'forge_id' : forge_id,
+                     'email' : None} for i in range(10)]
+            bulk_upsert(conn, table, rows, ['login', 'forge_id'])
+
+            rows = [{'login' : 'user%d' % i, 'forge_id' : forge_id,
+                     'email' : 'user%d@example.com' % i} for i in range(5, 15)]
+            bulk_upsert(conn, table, rows, ['login', 'forge_id'])
+
+        users = self.session.query(User).order_by(User.id).all()
+
+        self.assertEqual(len(users), 15)
+        self.assertEqual(users[0].email, None)
+        self.assertEqual(users[5].email, 'user5@example.com')
+        self.assertEqual(users[14].email, 'user14@example.com')
+
+    def test_bulk_upsert_null_keys(self):
+        """Check whether rows with NULL keys are updated too"""
+
+        keys = ['pull_request_id', 'user_id', 'created_at']
+        created_at = datetime.datetime(2015, 1, 1)
+
+        with self.db.engine.begin() as conn:
+            for body in ('first', 'second'):
+                rows = [{'pull_request_id' : 1, 'user_id' : user_id,
+                         'created_at' : created_at, 'body' : body}
+                        for user_id in (None, 1)]
+                bulk_upsert(conn, Comment.__table__, rows, keys)
+
+        comments = self.session.query(Comment).order_by(Comment.id).all()
+
+        self.assertEqual(len(comments), 2)
+        self.assertEqual([c.body for c in comments], ['second', 'second'])
+
+
+class TestBatchWriter(TestCaseDatabase):
+    """Unit tests for BatchWriter"""
+
+    def test_batches(self):
+        """Check whether objects are committed in batches and expunged"""
+
+        writer = BatchWriter(self.session, max_objects=10)
+
+        for i in range(25):
+            writer.add(PullRequest(github_id=i, number=i, title='PR %d' % i))
+
+        self.assertEqual(writer.commits, 2)
+        self.assertEqual(len(self.session.new), 5)
+
+        writer.commit()
+
+        self.assertEqual(writer.commits, 3)
+        self.assertEqual(len(self.session.identity_map), 0)
+        self.assertEqual(self.session.query(PullRequest).count(), 25)
+
+    def test_rollback(self):
+        """Check whether failed commits are rolled back"""
+
+        writer = BatchWriter(self.session, max_objects=10)
+        writer.add(Forge(kind='github', url='https://github.com'))
+        writer.add(Forge(kind='github', url='https://github.com'))
+
+        self.assertRaises(IntegrityError, writer.commit)
+        self.assertEqual(writer.commits, 0)
+
+        writer.add(Forge(kind='gitlab', url='https://gitlab.com'))
+        writer.commit()
+
+        self.assertEqual(writer.commits, 1)
+        self.assertEqual(self.session.query(Forge).count(), 1)
+
+
+class TestUpgrade(TestCaseDatabase):
+    """Unit tests for Database.upgrade"""
+
+    def test_upgrade(self):
+        """Check whether old rows are assigned to the forge and collapsed"""
+
+        table = User.__table__
+
+        # Databases created before forges were recorded
+        # don't have the unique index on logins and forges
+        self.db.engine.execute('DROP INDEX ix_people_login_forge_id')
+
+        with self.db.engine.begin() as conn:
+            bulk_insert(conn, table, [{'login' : 'jdoe', 'email' : None},
+                                      {'login' : 'jdoe', 'email' : None},
+                                      {'login' : 'jsmith', 'email' : None}])
+
+        removed = self.db.upgrade('https://github.com')
+
+        self.assertEqual(removed['people'], 1)
+
+        forges = self.session.query(Forge).all()
+        self.assertEqual(len(forges), 1)
+        self.assertEqual(forges[0].url, 'https://github.com')
+        self.assertEqual(forges[0].kind, 'github')
+
+        users = self.session.query(User).order_by(User.login).all()
+        self.assertEqual([u.login for u in users], ['jdoe', 'jsmith'])
+        self.assertEqual([u.forge_id for u in users], [forges[0].id] * 2)
+
+        indexes = [ix['name'] for ix in inspect(self.db.engine).get_indexes('people')]
+        self.assertIn('ix_people_login_forge_id', indexes)
+
+        # Upgrading again changes nothing
+        removed = self.db.upgrade('https://github.com')
+
+        self.assertEqual(sum(removed.values()), 0)
+        self.assertEqual(self.session.query(Forge).count(), 1)
+        self.assertEqual(self.session.query(User).count(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.db import export
+from pullpo.db.export import Exporter
+from pullpo.db.model import Commit, Forge, PullRequest, Repository
+
+from tests.base import TestCaseDatabase
+
+
+class TestExporter(TestCaseDatabase):
+    """Unit tests for Exporter"""
+
+    def setUp(self):
+        super(TestExporter, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestExporter, self).tearDown()
+
+    def test_default_format(self):
+        """Check whether Parquet is the default format when pyarrow
+        is installed and CSV, with a warning, when it is not"""
+
+        pyarrow = export.pyarrow
+
+        try:
+            export.pyarrow = None
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                exporter = Exporter(self.db.engine, self.tmpdir)
+
+            self.assertEqual(exporter.format, 'csv')
+            self.assertEqual(len(caught), 1)
+
+            # Exports keep the format of the directory
+            exporter.export()
+            export.pyarrow = object()
+            self.assertEqual(Exporter(self.db.engine, self.tmpdir).format, 'csv')
+
+            path = os.path.join(self.tmpdir, 'new')
+            self.assertEqual(Exporter(self.db.engine, path).format, 'parquet')
+        finally:
+            export.pyarrow = pyarrow
+
+    def test_commits_exported_again(self):
+        """Check whether commits of updated pull requests are exported again"""
+
+        updated_at = datetime.datetime(2015, 1, 1)
+        forge = Forge(kind='github', url='https://github.com')
+        self.session.add(forge)
+        self.session.flush()
+
+        repo = Repository(owner='acme', repository='acme/proj',
+                          forge_id=forge.id)
+        prs = [PullRequest(number=i, repository=repo, created_at=updated_at,
+                           updated_at=updated_at) for i in range(2)]
+        commits = [Commit(sha='%040d' % i, pull_request=prs[i],
+                          commit_date=updated_at) for i in range(2)]
+        self.session.add_all(commits)
+        self.session.commit()
+
+        exporter = Exporter(self.db.engine, self.tmpdir, 'csv')
+        self.assertEqual(exporter.export()['commits']['rows'], 2)
+        self.assertEqual(exporter.export()['commits']['rows'], 0)
+
+        prs[1].updated_at = updated_at + datetime.timedelta(days=1)
+        commits[1].author_date = updated_at
+        self.session.commit()
+
+        report = exporter.export()
+        self.assertEqual(report['pull_requests']['rows'], 1)
+        self.assertEqual(report['commits']['rows'], 1)
+        self.assertEqual(exporter.export()['commits']['rows'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
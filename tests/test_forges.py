@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import sys
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.replay import ReplayAdapter, SyntheticRepository
+from pullpo.db.analytics import Analytics
+from pullpo.db.graph import ReviewGraph
+from pullpo.db.model import Forge, PullRequest, Repository
+
+from tests.base import TestCaseDatabase
+
+
+FORGES = (('https://github.example.com', 3),
+          ('https://github.example.org', 5))
+
+
+class TestForges(TestCaseDatabase):
+    """Same repository stored for two forges"""
+
+    def setUp(self):
+        super(TestForges, self).setUp()
+
+        for url, prs in FORGES:
+            adapter = ReplayAdapter(None)
+            backend = GitHubBackend(None, None, 'token', self.session,
+                                    enterprise_url=url, adapter=adapter)
+            adapter.source = SyntheticRepository('acme', 'proj',
+                                                 backend.gh.session.base_url,
+                                                 pull_requests=prs)
+            self.fetch(backend, 'acme', 'proj')
+
+    def test_stored_apart(self):
+        """Check whether each forge keeps its own repository"""
+
+        self.assertEqual(self.session.query(Forge).count(), 2)
+        self.assertEqual(self.session.query(Repository).count(), 2)
+        self.assertEqual(self.session.query(PullRequest).count(), 8)
+
+    def test_find_id(self):
+        """Check whether ambiguous repositories need the forge"""
+
+        self.assertRaises(ValueError, Repository.find_id,
+                          self.session, 'acme', 'proj')
+        self.assertRaises(ValueError, Repository.find_id,
+                          self.session, 'acme', 'unknown')
+
+        repo_id = Repository.find_id(self.session, 'acme', 'proj',
+                                     'https://github.example.org/')
+        forge_id = self.session.query(Repository.forge_id).\
+            filter(Repository.id == repo_id).scalar()
+
+        self.assertEqual(Repository.find_id(self.session, 'acme', 'proj',
+                                            forge_id), repo_id)
+
+    def test_analytics(self):
+        """Check whether metrics are computed and read per forge"""
+
+        analytics = Analytics(self.session)
+
+        self.assertEqual(analytics.refresh('acme', forge=FORGES[0][0]), 3)
+        self.assertEqual(analytics.refresh(), 5)
+
+        self.assertRaises(ValueError, analytics.weeks, 'acme', 'proj')
+        self.assertRaises(ValueError, analytics.summary, 'acme', 'proj')
+        self.assertRaises(ValueError, analytics.reviewer_load, 'acme', 'proj')
+        self.assertRaises(ValueError, analytics.pull_request, 'acme', 'proj', 1)
+
+        for url, prs in FORGES:
+            summary = analytics.summary('acme', 'proj', forge=url)
+            self.assertEqual(summary['opened'], prs)
+
+            m = analytics.pull_request('acme', 'proj', prs, forge=url)
+            self.assertNotEqual(m, None)
+
+        self.assertEqual(analytics.pull_request('acme', 'proj', 5,
+                                                forge=FORGES[0][0]), None)
+
+    def test_refresh_scope(self):
+        """Check whether refresh checks the repository it is given"""
+
+        analytics = Analytics(self.session)
+
+        self.assertRaises(ValueError, analytics.refresh, repository='proj')
+        self.assertRaises(ValueError, analytics.refresh, 'acme', 'proj')
+        self.assertRaises(ValueError, analytics.refresh, 'acme', 'unknown')
+
+        self.assertEqual(analytics.refresh('acme', 'proj',
+                                           forge=FORGES[1][0]), 5)
+        self.assertEqual(analytics.refresh('acme', 'proj',
+                                           forge=FORGES[1][0]), 0)
+        self.assertEqual(analytics.refresh('acme'), 3)
+
+    def test_graph(self):
+        """Check whether review graphs don't merge the forges"""
+
+        self.assertRaises(ValueError, ReviewGraph.load,
+                          self.session, 'acme', 'proj')
+
+        for url, prs in FORGES:
+            graph = ReviewGraph.load(self.session, 'acme', 'proj', forge=url)
+            self.assertEqual(len(graph.pr_ids), prs)
+
+            graph = ReviewGraph.load(self.session, forge=url)
+            self.assertEqual(len(graph.pr_ids), prs)
+
+        graph = ReviewGraph.load(self.session, 'acme')
+        self.assertEqual(len(graph.pr_ids), 8)
+
+    def test_database(self):
+        """Check whether the lookups of Database are scoped by forge"""
+
+        self.assertRaises(ValueError, self.db.get_repository,
+                          self.session, 'acme', 'proj')
+        self.assertRaises(ValueError, self.db.pull_requests,
+                          self.session, 'acme', 'proj')
+        self.assertRaises(ValueError, self.db.last_pull_request,
+                          self.session, 'acme', 'proj')
+
+        self.assertEqual(self.db.get_repository(self.session, 'acme', 'unknown'),
+                         None)
+
+        for url, prs in FORGES:
+            repo = self.db.get_repository(self.session, 'acme', 'proj', url)
+            forge = self.session.query(Forge).get(repo.forge_id)
+            self.assertEqual(forge.url, url)
+
+            stored = self.db.pull_requests(self.session, 'acme', 'proj',
+                                           children=(), forge=url)
+            self.assertEqual([pr.number for pr in stored], range(1, prs + 1))
+
+            last, = self.db.last_pull_request(self.session, 'acme', 'proj', url)
+            self.assertEqual(last, stored[-1].updated_at)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import datetime
+import re
+import sys
+import unittest
+
+from sqlalchemy import event
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.replay import ReplayAdapter, SyntheticRepository
+from pullpo.db.model import Comment, Commit, ReviewComment
+
+from tests.base import TestCaseDatabase
+
+
+CHILDREN = re.compile(r'\b(comments|review_comments|commits)\b')
+
+
+class TestGitHubBackend(TestCaseDatabase):
+    """Unit tests for GitHubBackend"""
+
+    def crawl(self, max_objects):
+        adapter = ReplayAdapter(None)
+        backend = GitHubBackend(None, None, 'token', self.session,
+                                adapter=adapter)
+        adapter.source = SyntheticRepository('acme', 'proj',
+                                             backend.gh.session.base_url,
+                                             pull_requests=40, comments=5,
+                                             review_comments=5, commits=5)
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if CHILDREN.search(statement):
+                statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', count)
+
+        try:
+            prs, writer = self.fetch(backend, 'acme', 'proj',
+                                     max_objects=max_objects)
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', count)
+
+        return prs, writer, statements
+
+    def test_children_statements(self):
+        """Check whether the children of the pull requests of a batch are
+        written with one statement per table"""
+
+        prs, writer, statements = self.crawl(200)
+
+        self.assertEqual(prs, 40)
+        self.assertGreater(writer.commits, 1)
+        self.assertLessEqual(len(statements), 3 * writer.commits)
+        self.assertLess(len(statements), prs)
+
+        self.assertEqual(self.session.query(Comment).count(), 200)
+        self.assertEqual(self.session.query(ReviewComment).count(), 200)
+        self.assertEqual(self.session.query(Commit).count(), 200)
+
+    def test_skipped_hydrations(self):
+        """Check whether skipped hydrations are counted as saved requests
+        and unchanged pull requests are not retrieved again"""
+
+        since = datetime.datetime(2000, 1, 1)
+
+        for listing, issues in (('issues', 5), ('pulls', 0)):
+            name = 'proj-' + listing
+            runs = []
+
+            for run in range(2):
+                adapter = ReplayAdapter(None)
+                backend = GitHubBackend(None, None, 'token', self.session,
+                                        listing=listing, adapter=adapter)
+                adapter.source = SyntheticRepository('acme', name,
+                                                     backend.gh.session.base_url,
+                                                     pull_requests=10,
+                                                     issues=issues)
+                prs, _ = self.fetch(backend, 'acme', name, since=since)
+                runs.append((prs, backend))
+
+            (prs, first), (unchanged, second) = runs
+
+            self.assertEqual(prs, 10)
+            self.assertEqual(first.skipped_issues, issues)
+            self.assertEqual(unchanged, 0)
+            self.assertEqual(second.unchanged_prs, 10)
+
+            # Plain issues and 10 hydrations of 5 requests
+            self.assertEqual(second.saved_requests, issues + 10 * 5)
+            self.assertEqual(second.scheduler.requests, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import os
+import sys
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.github_graphql import GitHubGraphQLBackend
+from pullpo.backends.replay import ReplayAdapter, ResponseArchive
+from pullpo.db.model import Comment, Commit, Event, Forge, PullRequest,\
+    ReviewComment, User
+
+from tests.base import TestCaseDatabase
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'data', 'graphql.json.gz')
+
+GITHUB_URL = 'https://github.example.com'
+
+
+class FixtureBackend(GitHubGraphQLBackend):
+    """Backend with the page sizes used to record the fixture.
+
+    The fixture has three pull requests, with three comments, review
+    comments, commits and events each, on two pages. Commits are
+    truncated, so they were retrieved using the REST API.
+    """
+
+    PULL_REQUESTS_PER_PAGE = 2
+    COMMENTS_PER_PULL_REQUEST = 3
+    COMMITS_PER_PULL_REQUEST = 2
+
+
+class TestGitHubGraphQLBackend(TestCaseDatabase):
+    """Crawls of GitHubGraphQLBackend on recorded responses"""
+
+    def setUp(self):
+        super(TestGitHubGraphQLBackend, self).setUp()
+        self.adapter = ReplayAdapter(ResponseArchive(FIXTURE))
+        self.backend = FixtureBackend(None, None, 'token', self.session,
+                                      enterprise_url=GITHUB_URL,
+                                      adapter=self.adapter)
+
+    def test_fetch(self):
+        """Check whether pull requests are stored from GraphQL pages"""
+
+        prs, _ = self.fetch(self.backend, 'acme', 'proj')
+
+        self.assertEqual(prs, 3)
+        self.assertEqual(self.adapter.missing, 0)
+
+        # User, repository, two GraphQL pages and, for each
+        # pull request, the requests of commits and events
+        self.assertEqual(self.adapter.requests, 10)
+
+        db_prs = self.session.query(PullRequest).order_by(PullRequest.number).all()
+        self.assertEqual([pr.number for pr in db_prs], [1, 2, 4])
+        self.assertEqual([pr.github_id for pr in db_prs], [50001, 50002, 50004])
+        self.assertEqual([pr.merged_at is not None for pr in db_prs],
+                         [False, True, True])
+
+        pr = db_prs[1]
+        self.assertEqual(pr.title, 'Issue 2')
+        self.assertEqual(pr.user.login, 'u2')
+        self.assertEqual(pr.merged_by.login, 'm')
+
+        forge = self.session.query(Forge).get(pr.forge_id)
+        self.assertEqual(forge.url, GITHUB_URL)
+
+        for model in (Comment, ReviewComment, Commit, Event):
+            self.assertEqual(self.session.query(model).count(), 9)
+
+    def test_truncated_connections(self):
+        """Check whether truncated connections are retrieved using REST"""
+
+        self.fetch(self.backend, 'acme', 'proj')
+
+        commits = self.session.query(Commit).join(PullRequest).\
+            filter(PullRequest.number == 4).order_by(Commit.sha).all()
+        self.assertEqual([c.sha for c in commits],
+                         ['sha4_0', 'sha4_1', 'sha4_2'])
+
+    def test_users(self):
+        """Check whether users are stored once per login"""
+
+        self.fetch(self.backend, 'acme', 'proj')
+
+        logins = [u.login for u in self.session.query(User)]
+        self.assertEqual(len(logins), len(set(logins)))
+        self.assertIn('c0', logins)
+        self.assertIn('e2', logins)
+
+    def test_incremental(self):
+        """Check whether a second crawl skips the stored pull requests"""
+
+        self.fetch(self.backend, 'acme', 'proj')
+        prs, _ = self.fetch(self.backend, 'acme', 'proj')
+
+        self.assertEqual(prs, 0)
+        self.assertGreater(self.backend.unchanged_prs, 0)
+        self.assertEqual(self.session.query(PullRequest).count(), 3)
+        self.assertEqual(self.session.query(Comment).count(), 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.core import UserCache
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.replay import ReplayAdapter, SyntheticRepository
+from pullpo.db.database import BatchWriter, Database
+from pullpo.db.model import Comment, Commit, Event, PullRequest, ReviewComment,\
+    User
+from pullpo.memory import MemoryLimitExceeded, peak_rss, rss
+
+from tests.base import TestCaseDatabase
+
+
+MB = 1024 * 1024
+
+
+def synthetic_backend(session, pull_requests, users, users_cache_size):
+    adapter = ReplayAdapter(None)
+    backend = GitHubBackend(None, None, 'token', session,
+                            enterprise_url='https://github.example.com',
+                            users_cache_size=users_cache_size,
+                            adapter=adapter)
+    adapter.source = SyntheticRepository('acme', 'proj',
+                                         backend.gh.session.base_url,
+                                         pull_requests=pull_requests,
+                                         comments=2, review_comments=2,
+                                         commits=2, events=2, users=users)
+    return backend
+
+
+class TestUserCache(unittest.TestCase):
+    """Unit tests for UserCache"""
+
+    def test_lru(self):
+        """Check whether the least recently used users are removed"""
+
+        cache = UserCache(size=2)
+        cache.set('jdoe', 1)
+        cache.set('jsmith', 2)
+        cache.get('jdoe')
+        cache.set('jrae', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIn('jdoe', cache)
+        self.assertNotIn('jsmith', cache)
+        self.assertEqual(cache.get('jsmith'), None)
+        self.assertEqual(cache.get('jrae'), 3)
+
+    def test_dirty(self):
+        """Check whether dirty users are kept until they are cleaned"""
+
+        cache = UserCache(size=2)
+        cache.set('jdoe', {'id' : 1})
+        cache.mark_dirty('jdoe')
+        cache.set('jsmith', {'id' : 2})
+        cache.set('jrae', {'id' : 3})
+
+        self.assertIn('jdoe', cache)
+        self.assertNotIn('jsmith', cache)
+        self.assertEqual(cache.dirty(), [{'id' : 1}])
+
+        cache.mark_dirty('jrae')
+        cache.set('jroe', {'id' : 4})
+        self.assertEqual(len(cache), 3)
+
+        cache.clean()
+        self.assertEqual(cache.dirty(), [])
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('jdoe', cache)
+
+    def test_complete(self):
+        """Check whether removing users makes the cache incomplete"""
+
+        cache = UserCache(size=2)
+        cache.set('jdoe', 1)
+        cache.set('jsmith', 2)
+        cache.complete = True
+
+        cache.set('jdoe', 1)
+        self.assertTrue(cache.complete)
+
+        cache.set('jrae', 3)
+        self.assertFalse(cache.complete)
+
+
+class TestMemoryCeiling(TestCaseDatabase):
+    """Memory used by crawls of synthetic repositories"""
+
+    PULL_REQUESTS = 600
+
+    # Growth of the resident memory allowed after the first
+    # pull requests, which load the code and fill the caches
+    MAX_GROWTH = 32 * MB
+
+    # Crawl run when PULLPO_SLOW_TESTS is set and the peak resident
+    # memory allowed for it, which includes the Python interpreter
+    LARGE_PULL_REQUESTS = 50000
+    MAX_PEAK = 512 * MB
+
+    def setUp(self):
+        # In-memory databases would grow the process
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(url='sqlite:///' + os.path.join(self.tmpdir, 'pullpo.db'))
+        self.session = self.db.connect()
+
+    def tearDown(self):
+        super(TestMemoryCeiling, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_rss_ceiling(self):
+        """Check whether the resident memory stays under the ceiling"""
+
+        if rss() is None:
+            self.skipTest("resident memory not available on this platform")
+
+        backend = synthetic_backend(self.session, self.PULL_REQUESTS,
+                                    users=5000, users_cache_size=100)
+        writer = BatchWriter(self.session, max_objects=500)
+        warmup = self.PULL_REQUESTS / 10
+        start = peak = None
+
+        for i, pr in enumerate(backend.fetch('acme', 'proj')):
+            writer.add(pr)
+
+            if i == warmup:
+                start = peak = rss()
+            elif start:
+                peak = max(peak, rss())
+        writer.commit()
+
+        self.assertEqual(self.session.query(PullRequest).count(),
+                         self.PULL_REQUESTS)
+        self.assertLess(peak - start, self.MAX_GROWTH)
+
+    def test_peak_rss(self):
+        """Check whether the peak resident memory of a large crawl
+        stays under the ceiling"""
+
+        if not os.environ.get('PULLPO_SLOW_TESTS'):
+            self.skipTest("set PULLPO_SLOW_TESTS to crawl %s pull requests"
+                          % self.LARGE_PULL_REQUESTS)
+
+        backend = synthetic_backend(self.session, self.LARGE_PULL_REQUESTS,
+                                    users=5000, users_cache_size=100)
+        writer = BatchWriter(self.session, max_objects=500)
+
+        for pr in backend.fetch('acme', 'proj'):
+            writer.add(pr)
+        writer.commit()
+
+        self.assertEqual(self.session.query(PullRequest).count(),
+                         self.LARGE_PULL_REQUESTS)
+        self.assertLess(peak_rss(), self.MAX_PEAK)
+
+    def test_users_written_on_commit(self):
+        """Check whether the changes of the users are written by each
+        commit, even when they were removed from the cache"""
+
+        backend = synthetic_backend(self.session, 50,
+                                    users=200, users_cache_size=10)
+        writer = BatchWriter(self.session, max_objects=100)
+
+        # The crawl is stopped before its end
+        for i, pr in enumerate(backend.fetch('acme', 'proj')):
+            writer.add(pr)
+
+            if i == 20:
+                break
+        writer.commit()
+
+        authors = set(c.author_id for c in self.session.query(Commit))
+        named = self.session.query(User).\
+            filter(User.id.in_(authors), User.name != None).count()
+
+        self.assertGreater(len(authors), 10)
+        self.assertEqual(named, len(authors))
+        self.assertEqual(backend.users.dirty(), [])
+        self.assertLessEqual(len(backend.users), 10)
+
+    def test_objects_released(self):
+        """Check whether stored objects and users are not kept"""
+
+        backend = synthetic_backend(self.session, 200,
+                                    users=500, users_cache_size=50)
+        writer = BatchWriter(self.session, max_objects=100)
+
+        for pr in backend.fetch('acme', 'proj'):
+            writer.add(pr)
+        writer.commit()
+
+        del pr
+        gc.collect()
+
+        models = (PullRequest, Comment, ReviewComment, Commit, Event, User)
+        alive = [obj for obj in gc.get_objects() if isinstance(obj, models)]
+
+        self.assertEqual(alive, [])
+        self.assertEqual([obj for obj in self.session.identity_map.values()
+                          if isinstance(obj, models)], [])
+        self.assertLessEqual(len(backend.users), 50)
+
+    def test_max_memory(self):
+        """Check whether batches are committed early and made smaller
+        over the memory limit, until the crawl is stopped"""
+
+        if rss() is None:
+            self.skipTest("resident memory not available on this platform")
+
+        backend = synthetic_backend(self.session, 20,
+                                    users=10, users_cache_size=100)
+        writer = BatchWriter(self.session, max_objects=64, max_time=3600,
+                             max_memory=1)
+        sizes = []
+
+        with self.assertRaises(MemoryLimitExceeded):
+            for pr in backend.fetch('acme', 'proj'):
+                writer.add(pr)
+                sizes.append(writer.max_objects)
+
+        self.assertEqual(sizes, [32, 16, 8, 4, 2, 1])
+        self.assertEqual(writer.commits, 7)
+        self.assertEqual(self.session.query(PullRequest).count(), 7)
+
+    def test_under_max_memory(self):
+        """Check whether batches are kept under the memory limit"""
+
+        if rss() is None:
+            self.skipTest("resident memory not available on this platform")
+
+        backend = synthetic_backend(self.session, 20,
+                                    users=10, users_cache_size=100)
+        writer = BatchWriter(self.session, max_objects=64, max_time=3600,
+                             max_memory=rss() + 512 * MB)
+
+        for pr in backend.fetch('acme', 'proj'):
+            writer.add(pr)
+        writer.commit()
+
+        self.assertEqual(writer.max_objects, 64)
+        self.assertEqual(self.session.query(PullRequest).count(), 20)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import math
+import sys
+import threading
+import time
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.core import RateLimitScheduler
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.replay import SyntheticRepository
+from pullpo.db.model import PullRequest
+
+from tests.base import TestCaseMockServer
+
+
+class RateLimitedSource(object):
+    """Source that applies a GitHub-like rate limit to another one.
+
+    Each token can send 'limit' requests every 'window' seconds.
+    The first window of each token has 'remaining' requests left.
+    Requests over the limit get a 403 with no budget left.
+    """
+
+    def __init__(self, source, limit, window, remaining=None):
+        self.source = source
+        self.limit = limit
+        self.window = window
+        self.remaining = limit if remaining is None else remaining
+        self.requests = {}
+        self.rejected = 0
+
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def response(self, request):
+        token = request.headers.get('Authorization')
+        now = time.time()
+
+        with self._lock:
+            budget = self._budgets.get(token)
+
+            if budget is None:
+                budget = [self.remaining, now + self.window]
+                self._budgets[token] = budget
+            elif budget[1] <= now:
+                budget[:] = [self.limit, now + self.window]
+
+            self.requests[token] = self.requests.get(token, 0) + 1
+
+            if budget[0] == 0:
+                self.rejected += 1
+                result = (403, {'Content-Type' : 'application/json'},
+                          '{"message": "API rate limit exceeded"}')
+            else:
+                budget[0] -= 1
+                result = self.source.response(request)
+
+        status, headers, content = result
+
+        headers = dict(headers)
+        headers['X-RateLimit-Limit'] = str(self.limit)
+        headers['X-RateLimit-Remaining'] = str(budget[0])
+        headers['X-RateLimit-Reset'] = str(int(math.ceil(budget[1])))
+
+        return status, headers, content
+
+
+class TestRateLimit(TestCaseMockServer):
+    """Crawls of GitHubBackend against a rate-limited server"""
+
+    def backend_for(self, source, tokens):
+        backend = GitHubBackend(None, None, tokens, self.session,
+                                enterprise_url=self.server.url)
+        self.addCleanup(backend.http.close)
+        self.server.source = RateLimitedSource(
+            SyntheticRepository('acme', 'proj', backend.gh.session.base_url,
+                                pull_requests=3, comments=1,
+                                review_comments=1, commits=1, events=1),
+            **source)
+        return backend
+
+    def test_wait_for_reset(self):
+        """Check whether the crawl waits for the budget to be renewed"""
+
+        backend = self.backend_for({'limit' : 12, 'window' : 1}, 'token')
+        prs, _ = self.fetch(backend, 'acme', 'proj')
+
+        self.assertEqual(prs, 3)
+        self.assertEqual(self.session.query(PullRequest).count(), 3)
+        self.assertGreater(backend.scheduler.waited, 0)
+        self.assertEqual(self.server.source.rejected, 0)
+
+    def test_resume_after_rejection(self):
+        """Check whether rejected requests are sent again after the reset"""
+
+        backend = self.backend_for({'limit' : 100, 'window' : 1,
+                                    'remaining' : 0}, 'token')
+        prs, _ = self.fetch(backend, 'acme', 'proj')
+
+        self.assertEqual(prs, 3)
+        self.assertEqual(self.server.source.rejected, 1)
+        self.assertEqual(backend.adapter.retried, 1)
+        self.assertGreater(backend.scheduler.waited, 0)
+
+    def test_rotate_tokens(self):
+        """Check whether requests are shared among the tokens"""
+
+        backend = self.backend_for({'limit' : 100, 'window' : 60},
+                                   ['token1', 'token2'])
+        prs, _ = self.fetch(backend, 'acme', 'proj')
+
+        self.assertEqual(prs, 3)
+
+        requests = self.server.source.requests
+        self.assertEqual(sorted(requests), ['token token1', 'token token2'])
+        self.assertLessEqual(abs(requests['token token1'] - requests['token token2']), 1)
+        self.assertEqual(backend.scheduler.waited, 0)
+        self.assertEqual(self.server.source.rejected, 0)
+
+    def test_throughput(self):
+        """Check whether the throughput counts every request sent"""
+
+        backend = self.backend_for({'limit' : 100, 'window' : 60}, 'token')
+        self.fetch(backend, 'acme', 'proj')
+
+        scheduler = backend.scheduler
+        self.assertEqual(scheduler.requests, self.server.requests)
+        self.assertGreater(scheduler.throughput, 0)
+        self.assertLessEqual(scheduler.throughput, scheduler.requests * 3600)
+
+
+class TestRateLimitScheduler(unittest.TestCase):
+    """Unit tests for RateLimitScheduler"""
+
+    def test_pacing(self):
+        """Check whether requests are spaced once the budget runs low"""
+
+        scheduler = RateLimitScheduler(['token'], threshold=0.5)
+        reset = time.time() + 100
+        scheduler._budgets['token'].update({'limit' : 100,
+                                            'remaining' : 80,
+                                            'reset' : reset})
+
+        self.assertEqual(scheduler._interval('token', time.time()), 0)
+
+        scheduler._budgets['token']['remaining'] = 10
+        interval = scheduler._interval('token', reset - 50)
+        self.assertAlmostEqual(interval, 5.0)
+
+    def test_share(self):
+        """Check whether processes sharing the tokens split the budget"""
+
+        scheduler = RateLimitScheduler(['token'], threshold=0.5, share=2)
+        reset = time.time() + 100
+        scheduler._budgets['token'].update({'limit' : 100,
+                                            'remaining' : 20,
+                                            'reset' : reset})
+
+        interval = scheduler._interval('token', reset - 50)
+        self.assertAlmostEqual(interval, 5.0)
+
+    def test_select_largest_budget(self):
+        """Check whether the token with the largest budget is chosen"""
+
+        scheduler = RateLimitScheduler(['token1', 'token2'])
+        reset = time.time() + 100
+
+        for token, remaining in (('token1', 10), ('token2', 20)):
+            scheduler._budgets[token].update({'limit' : 100,
+                                              'remaining' : remaining,
+                                              'reset' : reset})
+
+        self.assertEqual(scheduler._select(time.time()), ('token2', 0))
+
+    def test_waited_threads(self):
+        """Check whether the time waited by every thread is counted"""
+
+        scheduler = RateLimitScheduler(['token'])
+        reset = time.time() + 0.2
+        scheduler._budgets['token'].update({'limit' : 100,
+                                            'remaining' : 0,
+                                            'reset' : reset})
+
+        threads = [threading.Thread(target=scheduler.acquire)
+                   for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(scheduler.requests, 8)
+        self.assertGreaterEqual(scheduler.waited, 8 * 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
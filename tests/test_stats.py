@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import sys
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.gitlab import GitLabBackend
+from pullpo.backends.replay import ReplayAdapter, SyntheticGitLabProject,\
+    SyntheticRepository
+from pullpo.stats import Stats
+
+from tests.base import TestCaseDatabase
+
+
+class TestInstrumentHTTP(TestCaseDatabase):
+    """Timings of the requests sent by the backends"""
+
+    def test_github(self):
+        """Check whether GitHub requests are recorded under its name"""
+
+        adapter = ReplayAdapter(None)
+        backend = GitHubBackend(None, None, 'token', self.session,
+                                enterprise_url='https://github.example.com',
+                                adapter=adapter)
+        adapter.source = SyntheticRepository('acme', 'proj',
+                                             backend.gh.session.base_url,
+                                             pull_requests=2)
+
+        stats = Stats()
+        stats.instrument_http(backend.http, backend.name)
+        self.fetch(backend, 'acme', 'proj')
+
+        timings = stats.as_dict()['timings']
+        self.assertEqual(sorted(timings), ['github'])
+        self.assertIn('GET /repos/:repo/pulls/:n', timings['github'])
+        self.assertEqual(sum(t['count'] for t in timings['github'].values()),
+                         adapter.requests)
+
+    def test_gitlab(self):
+        """Check whether GitLab requests are not recorded as GitHub ones"""
+
+        adapter = ReplayAdapter(None)
+        backend = GitLabBackend('token', self.session,
+                                url='https://gitlab.example.com',
+                                adapter=adapter)
+        adapter.source = SyntheticGitLabProject('acme', 'proj',
+                                                backend.api_url,
+                                                pull_requests=2)
+
+        stats = Stats()
+        stats.instrument_http(backend.http, backend.name)
+        self.fetch(backend, 'acme', 'proj')
+
+        timings = stats.as_dict()['timings']
+        self.assertEqual(sorted(timings), ['gitlab'])
+        self.assertEqual(sum(t['count'] for t in timings['gitlab'].values()),
+                         adapter.requests)
+        self.assertTrue(all(not name.startswith('GET /api/')
+                            for name in timings['gitlab']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+import unittest
+
+import requests
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+from pullpo import webhooks
+from pullpo.backends.github import GitHubBackend
+from pullpo.backends.replay import SyntheticRepository
+from pullpo.db.database import BatchWriter
+from pullpo.db.model import PullRequest
+from pullpo.webhooks import EventQueue, Ingester, WebhookServer
+
+from tests.base import TestCaseMockServer
+
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'data', 'webhooks')
+
+SECRET = 'its-a-secret'
+
+
+def read_payload(event):
+    with open(os.path.join(PAYLOADS, event + '.json')) as f:
+        return f.read()
+
+
+class TestWebhooks(TestCaseMockServer):
+    """Webhooks posted to a local instance of the ingestion service"""
+
+    def setUp(self):
+        super(TestWebhooks, self).setUp()
+
+        self.backend = GitHubBackend(None, None, 'token', self.session,
+                                     enterprise_url=self.server.url)
+        self.addCleanup(self.backend.http.close)
+        self.server.source = SyntheticRepository('acme', 'proj',
+                                                 self.backend.gh.session.base_url,
+                                                 pull_requests=5, comments=1,
+                                                 review_comments=1, commits=1,
+                                                 events=1)
+
+        self.queue = EventQueue(delay=0)
+        self.webhooks = WebhookServer(('127.0.0.1', 0), self.queue, SECRET)
+        self.url = 'http://%s:%s/' % self.webhooks.server_address
+
+        thread = threading.Thread(target=self.webhooks.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.writer = BatchWriter(self.session)
+        self.ingester = Ingester(self.backend, self.writer, self.queue,
+                                 sweep_interval=0)
+
+        # Keep the output of the tests clean
+        self.messages = []
+        self._log = webhooks.log
+        webhooks.log = lambda msg, stream=None: self.messages.append(msg)
+
+    def tearDown(self):
+        webhooks.log = self._log
+        self.webhooks.shutdown()
+        self.webhooks.server_close()
+        super(TestWebhooks, self).tearDown()
+
+    def post(self, event, body, secret=SECRET):
+        headers = {'X-GitHub-Event' : event,
+                   'Content-Type' : 'application/json'}
+
+        if secret:
+            signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+            headers['X-Hub-Signature-256'] = 'sha256=' + signature
+
+        return requests.post(self.url, data=body, headers=headers)
+
+    def stored_numbers(self):
+        return [pr.number for pr in
+                self.session.query(PullRequest).order_by(PullRequest.number)]
+
+    def test_replies(self):
+        """Check the replies to valid, ignored and invalid deliveries"""
+
+        r = self.post('ping', '{"zen": "Keep it logically awesome."}')
+        self.assertEqual((r.status_code, r.text), (200, 'pong'))
+
+        r = self.post('pull_request', read_payload('pull_request'))
+        self.assertEqual((r.status_code, r.text), (202, 'Queued'))
+
+        r = self.post('issues', read_payload('issues'))
+        self.assertEqual((r.status_code, r.text), (202, 'Ignored'))
+
+        r = self.post('push', '{}')
+        self.assertEqual((r.status_code, r.text), (202, 'Ignored'))
+
+        r = self.post('pull_request', '{"number": 2}')
+        self.assertEqual((r.status_code, r.text), (400, 'Invalid payload'))
+
+        r = self.post('pull_request', read_payload('pull_request'), secret='wrong')
+        self.assertEqual((r.status_code, r.text), (401, 'Invalid signature'))
+
+        r = self.post('pull_request', read_payload('pull_request'), secret=None)
+        self.assertEqual(r.status_code, 401)
+
+        self.assertEqual(self.queue.received, 1)
+
+    def test_sha1_signature(self):
+        """Check whether deliveries signed with SHA-1 are accepted"""
+
+        body = read_payload('issue_comment')
+        signature = hmac.new(SECRET, body, hashlib.sha1).hexdigest()
+        r = requests.post(self.url, data=body,
+                          headers={'X-GitHub-Event' : 'issue_comment',
+                                   'X-Hub-Signature' : 'sha1=' + signature})
+
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(len(self.queue), 1)
+
+    def test_coalesce(self):
+        """Check whether events of the same pull request are coalesced"""
+
+        for event in ('pull_request', 'pull_request_review_comment',
+                      'pull_request', 'issue_comment', 'issues'):
+            self.assertEqual(self.post(event, read_payload(event)).status_code, 202)
+
+        self.assertEqual(self.queue.received, 4)
+        self.assertEqual(self.queue.coalesced, 2)
+        self.assertEqual(sorted(self.queue.get(timeout=1)),
+                         [('acme', 'proj', 2), ('acme', 'proj', 4)])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_update(self):
+        """Check whether only the notified pull requests are stored"""
+
+        self.post('pull_request', read_payload('pull_request'))
+        self.post('issue_comment', read_payload('issue_comment'))
+
+        self.ingester.update(self.queue.get(timeout=1))
+
+        self.assertEqual(self.ingester.updated, 2)
+        self.assertEqual(self.stored_numbers(), [2, 4])
+
+        # Stored pull requests that did not change are not written again
+        self.post('pull_request', read_payload('pull_request'))
+        self.ingester.update(self.queue.get(timeout=1))
+
+        self.assertEqual(self.ingester.updated, 2)
+        self.assertEqual(self.backend.unchanged_prs, 1)
+
+    def test_run(self):
+        """Check whether the service applies the deliveries it receives"""
+
+        thread = threading.Thread(target=self.ingester.run)
+        thread.start()
+
+        try:
+            self.post('pull_request_review_comment',
+                      read_payload('pull_request_review_comment'))
+
+            deadline = time.time() + 10
+
+            while not self.ingester.updated and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            self.ingester.stop()
+            thread.join()
+
+        self.assertEqual(self.ingester.updated, 1)
+        self.assertEqual(self.stored_numbers(), [2])
+
+    def test_sweep(self):
+        """Check whether sweeps crawl the repositories seen on webhooks"""
+
+        self.post('pull_request', read_payload('pull_request'))
+        self.ingester.update(self.queue.get(timeout=1))
+        self.ingester.sweep()
+
+        self.assertEqual(self.ingester.sweeps, 1)
+        self.assertEqual(self.stored_numbers(), [1, 2, 3, 4, 5])
+
+    def test_errors(self):
+        """Check whether failed updates don't stop the service"""
+
+        self.queue.put(('acme', 'unknown', 1))
+        self.ingester.update(self.queue.get(timeout=1))
+
+        self.assertEqual(self.ingester.updated, 0)
+        self.assertEqual(len(self.messages), 1)
+        self.assertIn('acme/unknown', self.messages[0])
+
+        self.post('pull_request', read_payload('pull_request'))
+        self.ingester.update(self.queue.get(timeout=1))
+
+        self.assertEqual(self.ingester.updated, 1)
+        self.assertEqual(self.stored_numbers(), [2])
+
+
+if __name__ == "__main__":
+    unittest.main()